@@ -0,0 +1,90 @@
+"""Batch upload benchmark: many small files, one request each vs one batch.
+
+Uploads the same set of small files into a room three ways: one POST
+/upload per file, one multipart/form-data POST /upload-batch, and one TAR
+POST /upload-batch, and reports files per second for each.
+
+    python bench/batch_upload.py --files 2000 --size-kb 4
+"""
+import argparse
+import io
+import json
+import os
+import tarfile
+import time
+
+from common import ServerProcess, create_room, request, room_headers
+
+BOUNDARY = "fx-bench-boundary"
+
+
+def multipart_body(files):
+    body = io.BytesIO()
+    for name, data in files:
+        body.write(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="files"; '
+                   f'filename="{name}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{BOUNDARY}--\r\n".encode())
+    return body.getvalue()
+
+
+def tar_body(files):
+    body = io.BytesIO()
+    with tarfile.open(fileobj=body, mode="w") as archive:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return body.getvalue()
+
+
+def run(count, size):
+    files = [(f"file-{i:05d}.txt", os.urandom(size)) for i in range(count)]
+    results = []
+    with ServerProcess("web") as server:
+        for method in ("single", "multipart", "tar"):
+            room = create_room(server.port)
+            headers = room_headers(room)
+            base = f"/api/room/{room['room_id']}"
+            started = time.perf_counter()
+            if method == "single":
+                for name, data in files:
+                    status, _, _ = request(server.port, "POST", f"{base}/upload", body=data,
+                                           headers=dict(headers, **{"X-Filename": name}))
+                    if status != 200:
+                        raise RuntimeError(f"upload returned {status}")
+            else:
+                if method == "multipart":
+                    body = multipart_body(files)
+                    content_type = f"multipart/form-data; boundary={BOUNDARY}"
+                else:
+                    body = tar_body(files)
+                    content_type = "application/x-tar"
+                status, _, data = request(server.port, "POST", f"{base}/upload-batch", body=body,
+                                          headers=dict(headers, **{"Content-Type": content_type}))
+                uploaded = json.loads(data).get("uploaded")
+                if status != 200 or uploaded != count:
+                    raise RuntimeError(f"batch upload returned {status}, {uploaded} files")
+            elapsed = time.perf_counter() - started
+            results.append({
+                "method": method,
+                "files": count,
+                "file_kb": round(size / 1024, 1),
+                "seconds": round(elapsed, 3),
+                "files_per_sec": round(count / elapsed, 1),
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size-kb", type=float, default=4)
+    args = parser.parse_args()
+    run(args.files, int(args.size_kb * 1024))
+
+
+if __name__ == "__main__":
+    main()
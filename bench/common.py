@@ -0,0 +1,263 @@
+"""Shared helpers for the File Exchanger benchmarks.
+
+Every benchmark boots a real server process on a free local port inside a
+temporary working directory, so the servers' relative data folders
+(shared_files / servers_data) never touch the repository.
+"""
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SERVERS = {
+    "server": REPO_ROOT / "server" / "server.py",
+    "web": REPO_ROOT / "web" / "server.py",
+}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def checkout_server(which, rev, dest):
+    """Write server.py (and its index.html) as of git revision rev into dest"""
+    folder = SERVERS[which].parent.name
+    dest = Path(dest)
+    for name in ("server.py", "index.html"):
+        data = subprocess.run(["git", "show", f"{rev}:{folder}/{name}"], cwd=REPO_ROOT,
+                              check=True, capture_output=True).stdout
+        (dest / name).write_bytes(data)
+    return dest / "server.py"
+
+
+class ServerProcess:
+    """A server.py started as a subprocess on a free port.
+
+    legacy=True runs a server.py that predates command line options: it
+    always listens on 8888 and gets no extra arguments.
+    """
+
+    def __init__(self, which="web", args=(), server_path=None, workdir=None, legacy=False):
+        self.script = Path(server_path) if server_path else SERVERS[which]
+        self.legacy = legacy
+        self.port = 8888 if legacy else free_port()
+        self.args = [] if legacy else list(args)
+        self.tempdir = None if workdir else tempfile.TemporaryDirectory(prefix="fx-bench-")
+        self.workdir = Path(workdir) if workdir else Path(self.tempdir.name)
+        self.process = None
+
+    def start(self, timeout=15):
+        cmd = [sys.executable, str(self.script)]
+        if not self.legacy:
+            cmd += ["--port", str(self.port)] + self.args
+        env = dict(os.environ, PYTHONIOENCODING="utf-8")
+        self.process = subprocess.Popen(cmd, cwd=self.workdir, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.script} exited with code {self.process.returncode}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.2):
+                    return self
+            except OSError:
+                time.sleep(0.01)
+        self.stop()
+        raise RuntimeError(f"{self.script} did not start listening on port {self.port}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.tempdir:
+            self.tempdir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def peak_rss(self):
+        """Summed over the worker processes of a pre-forking server"""
+        peaks = [peak_rss(pid) for pid in [self.pid] + child_pids(self.pid)]
+        return sum(peak or 0 for peak in peaks) if peaks[0] is not None else None
+
+    def cpu_seconds(self):
+        return cpu_seconds(self.pid)
+
+
+def peak_rss(pid):
+    """Peak resident set size of a process in bytes, None if unknown"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process(pid).memory_info()
+    return getattr(info, "peak_wset", info.rss)
+
+
+def child_pids(pid):
+    """All descendants of a process (worker processes of a pre-forking server)"""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in child_pids(child)]
+
+
+def cpu_seconds(pid):
+    """User + system CPU time used so far by a process and its children, None if unknown"""
+    try:
+        ticks = os.sysconf("SC_CLK_TCK")
+        total = 0
+        for process in [pid] + child_pids(pid):
+            with open(f"/proc/{process}/stat") as f:
+                # The command name may contain spaces, fields are counted after it
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        return total / ticks
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    process = psutil.Process(pid)
+    times = [process.cpu_times()] + [child.cpu_times() for child in process.children(recursive=True)]
+    return sum(t.user + t.system for t in times)
+
+
+def request(port, method, path, body=None, headers=None, timeout=60):
+    """Send one request, returns (status, headers, body bytes)"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, response.headers, data
+    finally:
+        conn.close()
+
+
+def request_discard(port, method, path, headers=None, timeout=60, chunk_size=1024 * 1024):
+    """Send a request and drain the response body, returns (status, bytes read)"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        total = 0
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+        return response.status, total
+    finally:
+        conn.close()
+
+
+def create_room(port, password="benchpass"):
+    status, _, data = request(port, "POST", "/api/create-room",
+                              body=json.dumps({"password": password}),
+                              headers={"Content-Type": "application/json"})
+    info = json.loads(data)
+    if status != 200:
+        raise RuntimeError(f"create-room failed: {info}")
+    return info
+
+
+def room_folder(workdir, room_id):
+    """Locate a room's data folder under a server working directory"""
+    sharded = Path(workdir, "servers_data", "rooms", room_id[:2], room_id)
+    if sharded.is_dir():
+        return sharded
+    for path in Path(workdir, "servers_data").rglob(room_id):
+        if path.is_dir():
+            return path
+    raise FileNotFoundError(f"no folder for room {room_id}")
+
+
+def room_headers(room):
+    """Auth headers for a room from create_room(): the session token when the
+    server issues one, the password for servers that predate tokens."""
+    if room.get("token"):
+        return {"X-Session-Token": room["token"]}
+    return {"X-Password": "benchpass"}
+
+
+def write_random_file(path, size, chunk_size=1024 * 1024):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            n = min(chunk_size, remaining)
+            f.write(os.urandom(n))
+            remaining -= n
+    return path
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_clients(clients, duration, operation):
+    """Run operation() in `clients` threads for `duration` seconds.
+
+    Returns (completed operations, errors, latencies in seconds).
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker():
+        local = []
+        local_errors = 0
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                operation()
+            except Exception:
+                local_errors += 1
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(latencies), errors[0], latencies
@@ -0,0 +1,158 @@
+"""Compression benchmark: bytes on the wire and latency per file type.
+
+Puts a typical mix of files (logs, CSV, JSON, source code, random binary
+data, a JPEG-named blob) into the server's data folder and downloads each
+one with every Accept-Encoding the benchmark is given. The first request
+of each file/coding pair is reported separately as "cold" since it is
+compressed on the fly; the following ones are served from the compressed
+variant cache. The file listing is measured the same way.
+
+    python bench/compression.py --server web --encodings identity gzip br zstd
+"""
+import argparse
+import json
+import os
+import random
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from common import (REPO_ROOT, ServerProcess, create_room, percentile, request,
+                    room_folder, room_headers, write_random_file)
+
+
+def make_log(path, size):
+    levels = ["INFO", "INFO", "INFO", "DEBUG", "WARN", "ERROR"]
+    paths = ["/api/files", "/api/upload", "/api/download/report.pdf", "/api/events"]
+    with open(path, "w") as f:
+        written = 0
+        while written < size:
+            line = (f"2024-05-{random.randint(1, 28):02d}T{random.randint(0, 23):02d}:"
+                    f"{random.randint(0, 59):02d}:{random.randint(0, 59):02d} "
+                    f"{random.choice(levels)} {random.choice(paths)} "
+                    f"status={random.choice([200, 200, 206, 304, 404])} "
+                    f"ms={random.randint(1, 900)} client=192.168.1.{random.randint(2, 254)}\n")
+            written += f.write(line)
+
+
+def make_csv(path, size):
+    with open(path, "w") as f:
+        written = f.write("id,timestamp,sensor,value,unit\n")
+        row = 0
+        while written < size:
+            row += 1
+            written += f.write(f"{row},{1700000000 + row * 15},sensor-{row % 17},"
+                               f"{random.uniform(-40, 60):.3f},celsius\n")
+
+
+def make_json(path, size):
+    records = []
+    total = 0
+    while total < size:
+        record = {"id": len(records), "name": f"file-{random.randint(0, 10 ** 6)}.dat",
+                  "size": random.randint(0, 10 ** 9), "modified": time.time() - random.random() * 1e6,
+                  "tags": random.sample(["docs", "photos", "backup", "shared", "tmp"], 2)}
+        records.append(record)
+        total += len(json.dumps(record))
+    Path(path).write_text(json.dumps(records, indent=1))
+
+
+def make_source(path, size):
+    sources = [p.read_bytes() for p in sorted(REPO_ROOT.glob("*/*.py")) + sorted(REPO_ROOT.glob("*/*.html"))]
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            for data in sources:
+                written += f.write(data)
+
+
+FILE_MIX = [
+    ("app.log", make_log),
+    ("sensors.csv", make_csv),
+    ("records.json", make_json),
+    ("sources.txt", make_source),
+    ("random.bin", write_random_file),
+    ("photo.jpg", write_random_file),
+]
+
+
+def measure(port, path, headers, requests):
+    """Returns one result per request: (bytes read, seconds, Content-Encoding)"""
+    results = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        status, response_headers, body = request(port, "GET", path, headers=headers)
+        if status != 200:
+            raise RuntimeError(f"GET {path} returned {status}")
+        results.append((len(body), time.perf_counter() - started,
+                        response_headers.get("Content-Encoding", "identity")))
+    return results
+
+
+def summarize(kind, name, size, encoding, results):
+    cold = results[0]
+    warm = results[1:] or results
+    latencies = [seconds for _, seconds, _ in warm]
+    wire = warm[-1][0]
+    return {
+        "kind": kind,
+        "file": name,
+        "size_kb": round(size / 1024, 1),
+        "accept_encoding": encoding,
+        "content_encoding": warm[-1][2],
+        "wire_kb": round(wire / 1024, 1),
+        "ratio": round(wire / size, 3) if size else 1.0,
+        "cold_ms": round(cold[1] * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def run(which, size, encodings, requests, listing_files):
+    with ServerProcess(which) as server:
+        headers = {}
+        if which == "web":
+            room = create_room(server.port)
+            folder = room_folder(server.workdir, room["room_id"])
+            base = f"/api/room/{room['room_id']}"
+            download, listing = f"{base}/download/", f"{base}/files"
+            headers.update(room_headers(room))
+        else:
+            folder = Path(server.workdir, "shared_files")
+            download, listing = "/api/download/", "/api/files"
+
+        for name, make in FILE_MIX:
+            make(folder / name, size)
+        for i in range(listing_files):
+            (folder / f"listing-{i:05d}.txt").write_bytes(b"x")
+
+        results = []
+        for name, _ in FILE_MIX:
+            file_size = os.path.getsize(folder / name)
+            for encoding in encodings:
+                runs = measure(server.port, download + quote(name),
+                               dict(headers, **{"Accept-Encoding": encoding}), requests)
+                results.append(summarize("download", name, file_size, encoding, runs))
+                print(json.dumps(results[-1]))
+        for encoding in encodings:
+            runs = measure(server.port, listing, dict(headers, **{"Accept-Encoding": encoding}), requests)
+            identity_size = len(request(server.port, "GET", listing, headers=headers)[2])
+            results.append(summarize("listing", f"{listing_files} files", identity_size, encoding, runs))
+            print(json.dumps(results[-1]))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--size-mb", type=float, default=8)
+    parser.add_argument("--encodings", nargs="+", default=["identity", "gzip", "br", "zstd"])
+    parser.add_argument("--requests", type=int, default=10, help="requests per file and coding")
+    parser.add_argument("--listing-files", type=int, default=2000)
+    args = parser.parse_args()
+    random.seed(1)
+    run(args.server, int(args.size_mb * 1024 * 1024), args.encodings, args.requests, args.listing_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Load benchmark: does throughput scale with concurrent clients?
+
+Boots the chosen server once per concurrency mode, uploads one large file,
+then for each client count runs half the clients polling the file list and
+half downloading the large file. A serializing server shows flat (or
+collapsing) list throughput as downloads are added; a concurrent one keeps
+serving polls while downloads are in flight.
+
+    python bench/concurrency.py --server web --modes single threaded asyncio
+"""
+import argparse
+import json
+import threading
+from urllib.parse import quote
+
+from common import (ServerProcess, create_room, percentile, request, request_discard,
+                    room_headers, run_clients)
+
+BIG_FILE = "big.bin"
+
+
+def prepare(server, which, size):
+    auth = {}
+    if which == "web":
+        room = create_room(server.port)
+        auth = room_headers(room)
+        base = f"/api/room/{room['room_id']}"
+        upload, listing, download = f"{base}/upload", f"{base}/files", f"{base}/download/{quote(BIG_FILE)}"
+    else:
+        upload, listing, download = "/api/upload", "/api/files", f"/api/download/{quote(BIG_FILE)}"
+    status, _, _ = request(server.port, "POST", upload, body=b"\0" * size,
+                           headers=dict(auth, **{"X-Filename": BIG_FILE}))
+    if status != 200:
+        raise RuntimeError(f"upload failed with status {status}")
+    return listing, download, auth
+
+
+def run_mode(which, mode, clients_list, duration, size, server_path):
+    results = []
+    with ServerProcess(which, ["--mode", mode], server_path=server_path) as server:
+        listing, download, auth = prepare(server, which, size)
+        for clients in clients_list:
+            pollers = max(1, clients // 2)
+            downloaders = max(1, clients - pollers)
+            downloaded = [0]
+            downloaded_lock = threading.Lock()
+
+            def poll():
+                status, _, _ = request(server.port, "GET", listing, headers=auth)
+                if status != 200:
+                    raise RuntimeError(status)
+
+            def fetch():
+                status, n = request_discard(server.port, "GET", download, headers=auth)
+                if status != 200:
+                    raise RuntimeError(status)
+                with downloaded_lock:
+                    downloaded[0] += n
+
+            poll_result = {}
+            poll_thread = threading.Thread(
+                target=lambda: poll_result.update(r=run_clients(pollers, duration, poll)))
+            poll_thread.start()
+            fetches, fetch_errors, _ = run_clients(downloaders, duration, fetch)
+            poll_thread.join()
+            polls, poll_errors, latencies = poll_result["r"]
+            results.append({
+                "server": which,
+                "mode": mode,
+                "clients": clients,
+                "polls_per_sec": round(polls / duration, 1),
+                "poll_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "poll_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "downloads": fetches,
+                "download_mb_per_sec": round(downloaded[0] / duration / 1e6, 1),
+                "errors": poll_errors + fetch_errors,
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--server-path", help="benchmark another checkout's server.py")
+    parser.add_argument("--modes", nargs="+", default=["single", "threaded", "asyncio"])
+    parser.add_argument("--clients", nargs="+", type=int, default=[2, 4, 8, 16])
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--size-mb", type=int, default=32)
+    args = parser.parse_args()
+    for mode in args.modes:
+        run_mode(args.server, mode, args.clients, args.duration,
+                 args.size_mb * 1024 * 1024, args.server_path)
+
+
+if __name__ == "__main__":
+    main()
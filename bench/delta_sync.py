@@ -0,0 +1,216 @@
+"""Delta sync benchmark: bytes on the wire for a modified file, full vs delta.
+
+Uploads a large random file into a room, then makes changes of growing
+size to a local copy (bytes overwritten in place, plus a small insertion
+that shifts everything after it) and brings the server up to date twice:
+
+    upload    GET /signature of the server's copy, POST /patch with the delta
+    download  POST /delta with the signature of the client's old copy
+
+Each line reports the changed bytes, the bytes a full transfer would move,
+the bytes the delta transfer moved (signature included) and the time it
+took. The server's file and the downloaded result are checked against the
+new content, so this also serves as an end-to-end test of the delta code.
+
+    python bench/delta_sync.py --size-mb 64
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import struct
+import time
+import zlib
+
+from common import ServerProcess, create_room, request, room_headers
+
+DELTA_HEADER = struct.Struct(">BII")
+DELTA_COPY, DELTA_LITERAL, DELTA_END = 0, 1, 2
+ADLER_MOD = 65521
+
+
+def block_size_for(size, minimum=4096, maximum=1024 * 1024):
+    block = minimum
+    while block * block < size and block < maximum:
+        block *= 2
+    return block
+
+
+def strong(block):
+    return hashlib.sha256(block).hexdigest()[:32]
+
+
+def signature(data, block_size):
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+    return {"size": len(data), "block_size": block_size,
+            "weak": [zlib.adler32(b) for b in blocks], "strong": [strong(b) for b in blocks]}
+
+
+def make_delta(data, sig):
+    """Delta records rebuilding data from a base with signature sig (client side of an upload)"""
+    size = sig["block_size"]
+    count = len(sig["weak"])
+    lengths = [size] * count
+    if count:
+        lengths[-1] = sig["size"] - (count - 1) * size
+    table = {}
+    for index, weak in enumerate(sig["weak"]):
+        table.setdefault(weak, []).append(index)
+    records = []
+
+    def literal(start, end):
+        if end > start:
+            records.append(DELTA_HEADER.pack(DELTA_LITERAL, end - start, 0) + data[start:end])
+
+    def copy(index):
+        last = records[-1] if records else b""
+        if len(last) == DELTA_HEADER.size:
+            op, first, blocks = DELTA_HEADER.unpack(last)
+            if op == DELTA_COPY and first + blocks == index:
+                records[-1] = DELTA_HEADER.pack(DELTA_COPY, first, blocks + 1)
+                return
+        records.append(DELTA_HEADER.pack(DELTA_COPY, index, 1))
+
+    def find(start, length):
+        window = data[start:start + length]
+        for index in table.get(zlib.adler32(window), ()):
+            if lengths[index] == length and sig["strong"][index] == strong(window):
+                return index
+        return None
+
+    pending = pos = 0
+    checksum = None
+    while pos + size <= len(data):
+        if checksum is None:
+            checksum = zlib.adler32(data[pos:pos + size])
+        index = find(pos, size) if checksum in table else None
+        if index is not None:
+            literal(pending, pos)
+            copy(index)
+            pos += size
+            pending = pos
+            checksum = None
+            continue
+        if pos + size == len(data):
+            pos += 1
+            break
+        a, b = checksum & 0xffff, checksum >> 16
+        out, new = data[pos], data[pos + size]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - size * out + a - 1) % ADLER_MOD
+        checksum = b << 16 | a
+        pos += 1
+    tail = len(data) - (lengths[-1] if count else 0)
+    if count and lengths[-1] < size and tail >= pending and find(tail, lengths[-1]) == count - 1:
+        literal(pending, tail)
+        copy(count - 1)
+        pending = len(data)
+    literal(pending, len(data))
+    records.append(DELTA_HEADER.pack(DELTA_END, 0, 0) + hashlib.sha256(data).digest())
+    return b"".join(records)
+
+
+def apply_delta(delta, base, block_size):
+    """The file a delta from the server rebuilds from the client's base (client side of a download)"""
+    out = []
+    pos = 0
+    while pos < len(delta):
+        op, a, b = DELTA_HEADER.unpack_from(delta, pos)
+        pos += DELTA_HEADER.size
+        if op == DELTA_COPY:
+            out.append(base[a * block_size:(a + b) * block_size])
+        elif op == DELTA_LITERAL:
+            out.append(delta[pos:pos + a])
+            pos += a
+        else:
+            result = b"".join(out)
+            if delta[pos:pos + 32] != hashlib.sha256(result).digest():
+                raise RuntimeError("delta checksum mismatch")
+            return result
+    raise RuntimeError("delta without an end record")
+
+
+def modify(data, changed, inserted=100):
+    """Overwrite `changed` bytes in a few scattered runs and insert a short run"""
+    data = bytearray(data)
+    runs = 4
+    for i in range(runs):
+        length = changed // runs
+        start = random.randrange(0, len(data) - length)
+        data[start:start + length] = os.urandom(length)
+    if changed:
+        at = random.randrange(len(data))
+        data[at:at] = os.urandom(inserted)
+    return bytes(data)
+
+
+def run(size, changes):
+    results = []
+    with ServerProcess("web") as server:
+        room = create_room(server.port)
+        headers = room_headers(room)
+        base = f"/api/room/{room['room_id']}"
+        for changed in changes:
+            old = os.urandom(size)
+            name = f"data-{changed}.bin"
+            status, _, _ = request(server.port, "POST", f"{base}/upload", body=old,
+                                   headers=dict(headers, **{"X-Filename": name}))
+            if status != 200:
+                raise RuntimeError(f"upload returned {status}")
+            new = modify(old, changed)
+
+            # Upload: fetch the signature of the server's copy, send only what differs
+            started = time.perf_counter()
+            status, _, body = request(server.port, "GET", f"{base}/signature/{name}", headers=headers)
+            sig = json.loads(body)
+            delta = make_delta(new, sig)
+            status, _, reply = request(server.port, "POST", f"{base}/patch/{name}?block={sig['block_size']}",
+                                       body=delta, headers=dict(headers, **{"If-Match": sig["etag"]}))
+            if status != 200:
+                raise RuntimeError(f"patch returned {status}: {reply[:200]}")
+            upload_seconds = time.perf_counter() - started
+            upload_bytes = len(body) + len(delta)
+            _, _, stored = request(server.port, "GET", f"{base}/download/{name}", headers=headers)
+            if stored != new:
+                raise RuntimeError("patched file differs from the new content")
+
+            # Download: send the signature of our old copy, get back only what differs
+            block_size = block_size_for(size)
+            sig_body = json.dumps(signature(old, block_size)).encode()
+            started = time.perf_counter()
+            status, _, delta = request(server.port, "POST", f"{base}/delta/{name}", body=sig_body,
+                                       headers=dict(headers, **{"Content-Type": "application/json"}))
+            if status != 200:
+                raise RuntimeError(f"delta returned {status}: {delta[:200]}")
+            if apply_delta(delta, old, block_size) != new:
+                raise RuntimeError("downloaded delta does not rebuild the new content")
+            download_seconds = time.perf_counter() - started
+
+            for direction, moved, seconds in (("upload", upload_bytes, upload_seconds),
+                                              ("download", len(sig_body) + len(delta), download_seconds)):
+                results.append({
+                    "direction": direction,
+                    "file_mb": round(size / 1024 ** 2, 1),
+                    "changed_kb": round(changed / 1024, 1),
+                    "full_kb": round(len(new) / 1024, 1),
+                    "delta_kb": round(moved / 1024, 1),
+                    "ratio": round(moved / len(new), 4),
+                    "seconds": round(seconds, 3),
+                })
+                print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=64)
+    parser.add_argument("--changes-kb", type=float, nargs="+", default=[0, 4, 64, 1024, 8192],
+                        help="bytes overwritten per run, spread over four places")
+    args = parser.parse_args()
+    random.seed(1)
+    run(int(args.size_mb * 1024 * 1024), [int(kb * 1024) for kb in args.changes_kb])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Download benchmark: throughput and server memory for parallel downloads.
+
+Places one large file directly in the server's data folder (so the upload
+path does not distort memory numbers), then runs several rounds of parallel
+downloads and reports MB/s and the server's peak RSS. With --baseline REV
+the same workload is run against server.py as of that git revision, e.g.
+the whole-file f.read() implementation:
+
+    python bench/download.py --server web --baseline 44dc680
+"""
+import argparse
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from common import (ServerProcess, checkout_server, create_room, peak_rss,
+                    request_discard, room_folder, room_headers, write_random_file)
+
+FILENAME = "big.bin"
+
+
+def run(which, size, parallel, rounds, server_path=None, legacy=False, label="current"):
+    with ServerProcess(which, server_path=server_path, legacy=legacy) as server:
+        headers = {}
+        if which == "web":
+            room = create_room(server.port)
+            folder = room_folder(server.workdir, room["room_id"])
+            path = f"/api/room/{room['room_id']}/download/{quote(FILENAME)}"
+            headers.update(room_headers(room))
+        else:
+            folder = Path(server.workdir, "shared_files")
+            path = f"/api/download/{quote(FILENAME)}"
+        write_random_file(folder / FILENAME, size)
+        idle_rss = peak_rss(server.pid)
+
+        received = []
+        lock = threading.Lock()
+
+        def fetch():
+            status, n = request_discard(server.port, "GET", path, headers=headers)
+            with lock:
+                received.append(n if status == 200 else 0)
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            threads = [threading.Thread(target=fetch) for _ in range(parallel)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        elapsed = time.perf_counter() - started
+        result = {
+            "label": label,
+            "server": which,
+            "file_mb": round(size / 1e6, 1),
+            "parallel": parallel,
+            "rounds": rounds,
+            "complete_downloads": sum(1 for n in received if n == size),
+            "mb_per_sec": round(sum(received) / elapsed / 1e6, 1),
+            "idle_rss_mb": round((idle_rss or 0) / 1e6, 1),
+            "peak_rss_mb": round((server.peak_rss() or 0) / 1e6, 1),
+        }
+        print(json.dumps(result))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--parallel", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--baseline", metavar="REV",
+                        help="also run against server.py from this git revision")
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+    run(args.server, size, args.parallel, args.rounds)
+    if args.baseline:
+        with tempfile.TemporaryDirectory(prefix="fx-baseline-") as tmp:
+            script = checkout_server(args.server, args.baseline, tmp)
+            run(args.server, size, args.parallel, args.rounds, server_path=script,
+                legacy=True, label=args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Polling benchmark: file-list requests per second for a large room.
+
+Fills a room (or the shared folder) with many small files directly on disk,
+then has several clients poll the listing endpoint as fast as they can,
+the way every open browser tab does. Also times /api/rooms for the web
+server. With --baseline REV the same run is repeated against server.py
+from that git revision, e.g. the iterdir()+stat() implementation:
+
+    python bench/polls.py --server web --files 5000 --baseline 44dc680
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from common import (ServerProcess, checkout_server, create_room, peak_rss, percentile,
+                    request, room_folder, room_headers, run_clients)
+
+
+def run(which, files, clients, duration, server_path=None, legacy=False, label="current"):
+    with ServerProcess(which, server_path=server_path, legacy=legacy) as server:
+        headers = {}
+        if which == "web":
+            room = create_room(server.port)
+            folder = room_folder(server.workdir, room["room_id"])
+            path = f"/api/room/{room['room_id']}/files"
+            headers.update(room_headers(room))
+        else:
+            folder = Path(server.workdir, "shared_files")
+            path = "/api/files"
+        for i in range(files):
+            (folder / f"file_{i:06d}.txt").write_bytes(b"x" * (i % 1024))
+        # Let the folder mtime settle so the index can trust it
+        time.sleep(2.1)
+
+        def poll():
+            status, _, body = request(server.port, "GET", path, headers=headers)
+            if status != 200:
+                raise RuntimeError(status)
+
+        polls, errors, latencies = run_clients(clients, duration, poll)
+        result = {
+            "label": label,
+            "server": which,
+            "files": files,
+            "clients": clients,
+            "polls_per_sec": round(polls / duration, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "errors": errors,
+        }
+        if which == "web":
+            rooms_polls, _, _ = run_clients(clients, duration / 2, lambda: request(
+                server.port, "GET", "/api/rooms"))
+            result["rooms_per_sec"] = round(rooms_polls / (duration / 2), 1)
+        result["peak_rss_mb"] = round((peak_rss(server.pid) or 0) / 1e6, 1)
+        print(json.dumps(result))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--baseline", metavar="REV",
+                        help="also run against server.py from this git revision")
+    args = parser.parse_args()
+    run(args.server, args.files, args.clients, args.duration)
+    if args.baseline:
+        with tempfile.TemporaryDirectory(prefix="fx-baseline-") as tmp:
+            script = checkout_server(args.server, args.baseline, tmp)
+            run(args.server, args.files, args.clients, args.duration,
+                server_path=script, legacy=True, label=args.baseline)
+
+
+if __name__ == "__main__":
+    main()
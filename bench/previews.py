@@ -0,0 +1,99 @@
+"""Preview benchmark: bytes and latency of browsing a room by previews.
+
+Writes large files straight into a room folder, so nothing was prepared at
+upload time, then fetches the preview of every file twice: the cold pass
+builds them in the server's preview processes, the warm pass is answered
+from the preview cache. CSV logs are always used; with Pillow installed
+(in this interpreter and the server's) large JPEG photos are added. Reports
+the bytes a full download of the room would take against the bytes of
+the previews, and p50/p99 latency of both passes.
+
+    python bench/previews.py --files 20 --size-mb 8
+"""
+import argparse
+import io
+import json
+import os
+import time
+from urllib.parse import quote
+
+from common import ServerProcess, create_room, percentile, request, room_folder, room_headers
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def write_csv(path, size):
+    row = b"2024-01-01T00:00:00,sensor-17,42.125,ok,some free text describing the reading\n"
+    with open(path, "wb") as f:
+        for _ in range(size // len(row)):
+            f.write(row)
+
+
+def write_photo(path, size):
+    # Noise does not compress, so the JPEG grows with the pixel count
+    side = int((size / 1.5) ** 0.5)
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    path.write_bytes(out.getvalue())
+
+
+def run(files, size, workers):
+    with ServerProcess("web", ["--preview-workers", str(workers)]) as server:
+        room = create_room(server.port)
+        headers = room_headers(room)
+        folder = room_folder(server.workdir, room["room_id"])
+        names = []
+        for i in range(files):
+            if Image and i % 2:
+                name = f"photo_{i:03d}.jpg"
+                write_photo(folder / name, size)
+            else:
+                name = f"log_{i:03d}.csv"
+                write_csv(folder / name, size)
+            names.append(name)
+        full = sum((folder / name).stat().st_size for name in names)
+        # Let the folder mtime settle so the index can trust it
+        time.sleep(2.1)
+
+        results = []
+        for phase in ("cold", "warm"):
+            latencies = []
+            moved = 0
+            for name in names:
+                started = time.perf_counter()
+                status, _, body = request(server.port, "GET",
+                                          f"/api/room/{room['room_id']}/preview/{quote(name)}",
+                                          headers=headers)
+                if status != 200:
+                    raise RuntimeError(f"preview of {name} returned {status}")
+                latencies.append(time.perf_counter() - started)
+                moved += len(body)
+            results.append({
+                "phase": phase,
+                "files": files,
+                "thumbnails": bool(Image),
+                "room_mb": round(full / 1024 ** 2, 1),
+                "previews_kb": round(moved / 1024, 1),
+                "ratio": round(moved / full, 5),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-mb", type=float, default=8)
+    parser.add_argument("--workers", type=int, default=2, help="--preview-workers of the server")
+    args = parser.parse_args()
+    run(args.files, int(args.size_mb * 1024 * 1024), args.workers)
+
+
+if __name__ == "__main__":
+    main()
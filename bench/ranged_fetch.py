@@ -0,0 +1,127 @@
+"""Segmented download check: parallel Range fetches must reassemble the file.
+
+Places a random file in the server's data folder, downloads it as N
+parallel byte ranges (like a download accelerator), reassembles the parts
+and compares them with the original. It also checks a multipart/byteranges
+response, an If-Range mismatch and an unsatisfiable range. Exits non-zero
+on any mismatch and prints the segmented vs. single-stream throughput.
+
+    python bench/ranged_fetch.py --server web --segments 8
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from common import (ServerProcess, create_room, request, room_folder, room_headers,
+                    write_random_file)
+
+FILENAME = "segmented.bin"
+
+
+def fetch_segments(port, path, headers, size, segments):
+    bounds = [(i * size // segments, (i + 1) * size // segments - 1) for i in range(segments)]
+    parts = [None] * segments
+    errors = []
+
+    def fetch(index, start, end):
+        status, response_headers, body = request(
+            port, "GET", path, headers=dict(headers, Range=f"bytes={start}-{end}"))
+        if status != 206 or response_headers.get("Content-Range") != f"bytes {start}-{end}/{size}":
+            errors.append((index, status, response_headers.get("Content-Range")))
+        parts[index] = body
+
+    threads = [threading.Thread(target=fetch, args=(i, s, e)) for i, (s, e) in enumerate(bounds)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return b"".join(p or b"" for p in parts), errors
+
+
+def parse_multipart(content_type, body):
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return [(part["Content-Range"], part.get_payload(decode=True)) for part in message.iter_parts()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--segments", type=int, default=8)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024 + 12345  # not a multiple of the segment count
+    failures = []
+
+    with ServerProcess(args.server) as server:
+        headers = {}
+        if args.server == "web":
+            room = create_room(server.port)
+            folder = room_folder(server.workdir, room["room_id"])
+            path = f"/api/room/{room['room_id']}/download/{quote(FILENAME)}"
+            headers.update(room_headers(room))
+        else:
+            folder = Path(server.workdir, "shared_files")
+            path = f"/api/download/{quote(FILENAME)}"
+        original = write_random_file(folder / FILENAME, size).read_bytes()
+        digest = hashlib.sha256(original).hexdigest()
+
+        started = time.perf_counter()
+        status, response_headers, whole = request(server.port, "GET", path, headers=headers)
+        single_time = time.perf_counter() - started
+        etag = response_headers.get("ETag")
+        if status != 200 or hashlib.sha256(whole).hexdigest() != digest:
+            failures.append("full download differs from the original")
+        if response_headers.get("Accept-Ranges") != "bytes" or not etag:
+            failures.append("missing Accept-Ranges or ETag")
+
+        started = time.perf_counter()
+        assembled, errors = fetch_segments(server.port, path, headers, size, args.segments)
+        segmented_time = time.perf_counter() - started
+        if errors:
+            failures.append(f"bad segment responses: {errors}")
+        if hashlib.sha256(assembled).hexdigest() != digest:
+            failures.append("reassembled segments differ from the original")
+
+        wanted = [(0, 99), (size - 50, size - 1), (1000, 1999)]
+        spec = ",".join(f"{s}-{e}" for s, e in wanted)
+        status, response_headers, body = request(server.port, "GET", path,
+                                                 headers=dict(headers, Range=f"bytes={spec}"))
+        parts = parse_multipart(response_headers.get("Content-Type", ""), body) if status == 206 else []
+        expected = [(f"bytes {s}-{e}/{size}", original[s:e + 1]) for s, e in wanted]
+        if parts != expected:
+            failures.append("multipart/byteranges response does not match")
+
+        status, _, body = request(server.port, "GET", path,
+                                  headers=dict(headers, Range="bytes=0-9", **{"If-Range": '"stale"'}))
+        if status != 200 or len(body) != size:
+            failures.append(f"If-Range mismatch should send the full file, got {status}")
+        status, _, _ = request(server.port, "GET", path, headers=dict(headers, Range="bytes=0-9",
+                                                                      **{"If-Range": etag}))
+        if status != 206:
+            failures.append(f"If-Range match should send a range, got {status}")
+        status, response_headers, _ = request(server.port, "GET", path,
+                                              headers=dict(headers, Range=f"bytes={size}-"))
+        if status != 416 or response_headers.get("Content-Range") != f"bytes */{size}":
+            failures.append(f"unsatisfiable range should give 416, got {status}")
+
+    print(json.dumps({
+        "server": args.server,
+        "file_mb": round(size / 1e6, 1),
+        "segments": args.segments,
+        "single_mb_per_sec": round(size / single_time / 1e6, 1),
+        "segmented_mb_per_sec": round(size / segmented_time / 1e6, 1),
+        "failures": failures,
+    }))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
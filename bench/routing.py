@@ -0,0 +1,105 @@
+"""Routing benchmark: requests per second on tiny JSON endpoints.
+
+Answers on these endpoints are a few dozen bytes, so the time goes to
+parsing the request, finding its route and writing the headers rather
+than to any real work. Clients keep their connections open, the way a
+browser tab polling the file list does:
+
+    limits   GET /api/limits (no room lookup at all)
+    files    GET /api/room/{room}/files of a room with one file
+    missing  GET /api/room/{room}/download/{name} of a file that is not there
+    unknown  GET /api/room/{room}/nothing, an address without a route
+
+With --baseline REV the same run is repeated against server.py from that
+git revision, e.g. the one before the compiled route table:
+
+    python bench/routing.py --baseline HEAD~1
+"""
+import argparse
+import http.client
+import json
+import tempfile
+import threading
+
+from common import (ServerProcess, checkout_server, create_room, percentile, request, room_headers,
+                    run_clients)
+
+
+def endpoints(room):
+    base = f"/api/room/{room['room_id']}"
+    return {
+        "limits": ("/api/limits", 200),
+        "files": (f"{base}/files", 200),
+        "missing": (f"{base}/download/missing.txt", 404),
+        "unknown": (f"{base}/nothing", 404),
+    }
+
+
+def run(clients, duration, names, server_path=None, label="current"):
+    results = []
+    with ServerProcess("web", server_path=server_path) as server:
+        room = create_room(server.port)
+        headers = room_headers(room)
+        status, _, _ = request(server.port, "POST", f"/api/room/{room['room_id']}/upload", body=b"x",
+                               headers=dict(headers, **{"X-Filename": "file.txt"}))
+        if status != 200:
+            raise RuntimeError(f"upload returned {status}")
+        paths = endpoints(room)
+        for name in names:
+            path, expected = paths[name]
+            local = threading.local()
+
+            def operation():
+                # One keep-alive connection per client thread
+                if getattr(local, "conn", None) is None:
+                    local.conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+                try:
+                    status, _, _ = keepalive_request(local.conn, "GET", path, None, headers)
+                except (OSError, http.client.HTTPException):
+                    local.conn.close()
+                    local.conn = None
+                    raise
+                if status != expected:
+                    raise RuntimeError(f"{path} returned {status}")
+
+            requests, errors, latencies = run_clients(clients, duration, operation)
+            results.append({
+                "label": label,
+                "endpoint": name,
+                "clients": clients,
+                "requests_per_sec": round(requests / duration, 1),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                "errors": errors,
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+def keepalive_request(conn, method, path, body, headers):
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    data = response.read()
+    if response.getheader("Connection", "").lower() == "close":
+        conn.close()
+    return response.status, response.headers, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--endpoints", nargs="+", choices=["limits", "files", "missing", "unknown"],
+                        default=["limits", "files", "missing", "unknown"])
+    parser.add_argument("--baseline", metavar="REV",
+                        help="also run against server.py from this git revision")
+    args = parser.parse_args()
+    run(args.clients, args.duration, args.endpoints)
+    if args.baseline:
+        with tempfile.TemporaryDirectory(prefix="fx-baseline-") as tmp:
+            script = checkout_server("web", args.baseline, tmp)
+            run(args.clients, args.duration, args.endpoints, server_path=script, label=args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Startup benchmark: time until the web server accepts connections.
+
+Creates a data folder with N rooms in the flat servers_data/{ID} layout
+(a .room_info and a few files each), times the one-off migration into the
+sharded layout and the registry, then times how long the server takes to
+start listening. Startup should stay flat as the room count grows. With
+--baseline REV the same folders are started with server.py from that
+revision, e.g. one that still read every .room_info at startup:
+
+    python bench/startup.py --rooms 0 1000 10000 50000 --baseline 90a80ae
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from common import SERVERS, ServerProcess, checkout_server, request
+
+
+def make_rooms(workdir, rooms, files):
+    data = Path(workdir, "servers_data")
+    data.mkdir(exist_ok=True)
+    password_hash = hashlib.sha256(b"benchpass").hexdigest()
+    for i in range(rooms):
+        room_id = f"{i:06X}"
+        folder = data / room_id
+        folder.mkdir()
+        (folder / ".room_info").write_text(json.dumps({"room_id": room_id, "password_hash": password_hash}))
+        for j in range(files):
+            (folder / f"file_{j}.txt").write_bytes(b"x" * j)
+
+
+def time_startup(which, workdir, repeats, server_path=None):
+    """Median seconds from launch until the server listens and until the first
+    /api/rooms answer (which lists every room, so it grows with the count),
+    and peak RSS"""
+    listen, listing, rss = [], [], 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        with ServerProcess(which, server_path=server_path, workdir=workdir) as server:
+            listen.append(time.perf_counter() - started)
+            status, _, _ = request(server.port, "GET", "/api/rooms")
+            if status != 200:
+                raise RuntimeError(f"/api/rooms returned {status}")
+            listing.append(time.perf_counter() - started)
+            rss = max(rss, server.peak_rss() or 0)
+    return statistics.median(listen), statistics.median(listing), rss
+
+
+def result(label, rooms, listen, listing, rss, **extra):
+    return dict({"label": label, "rooms": rooms}, **extra, listen_ms=round(listen * 1000, 1),
+                first_rooms_list_ms=round(listing * 1000, 1), peak_rss_mb=round(rss / 1e6, 1))
+
+
+def run(rooms, files, repeats, baseline=None):
+    results = []
+    for count in rooms:
+        with tempfile.TemporaryDirectory(prefix="fx-startup-") as tmp:
+            make_rooms(tmp, count, files)
+            pristine = Path(tmp, "flat")
+            if baseline:
+                shutil.copytree(Path(tmp, "servers_data"), pristine, copy_function=os.link)
+            started = time.perf_counter()
+            subprocess.run([sys.executable, str(SERVERS["web"]), "--migrate"], cwd=tmp,
+                           check=True, stdout=subprocess.DEVNULL)
+            migrate = time.perf_counter() - started
+            results.append(result("current", count, *time_startup("web", tmp, repeats),
+                                  migrate_s=round(migrate, 3)))
+            print(json.dumps(results[-1]))
+            if baseline:
+                shutil.rmtree(Path(tmp, "servers_data"))
+                os.rename(pristine, Path(tmp, "servers_data"))
+                with tempfile.TemporaryDirectory(prefix="fx-baseline-") as checkout:
+                    path = checkout_server("web", baseline, checkout)
+                    results.append(result(baseline, count, *time_startup("web", tmp, repeats, server_path=path)))
+                print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", nargs="+", type=int, default=[0, 1000, 10000])
+    parser.add_argument("--files", type=int, default=3, help="files per room")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--baseline", metavar="REV", help="also start server.py from this git revision")
+    args = parser.parse_args()
+    run(args.rooms, args.files, args.repeats, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Benchmark suite: realistic workloads against a freshly booted server.
+
+Each workload boots its own server process on a local port, prepares the
+data it needs and then drives it with concurrent clients for a fixed time:
+
+    poll     many clients polling the file lists of several rooms
+    mixed    small and large uploads and downloads at the same time
+    listing  bulk listing of many rooms with many files each
+    join     a storm of clients joining rooms (password hashing)
+
+For every workload it reports operations per second, MB/s, p50/p99
+latency, errors, peak RSS and the CPU the server used, prints one JSON
+line per result and writes them all to --output. Results written by an
+earlier run (e.g. of the previous release) can be compared with --compare,
+and --baseline REV runs the same workloads against server.py from another
+git revision in the same invocation:
+
+    python bench/suite.py --server web --output results.json
+    python bench/suite.py --server web --compare results.json
+    python bench/suite.py --server web --workloads poll listing --baseline HEAD~5
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from common import (REPO_ROOT, ServerProcess, checkout_server, create_room, percentile, request,
+                    request_discard, room_folder, room_headers, run_clients, write_random_file)
+
+SMALL_FILE = 64 * 1024
+
+
+class Target:
+    """URLs of one room on the web server, or of the LAN server's shared folder"""
+
+    def __init__(self, server, which, room=None):
+        self.server = server
+        self.port = server.port
+        if which == "web":
+            base = f"/api/room/{room['room_id']}"
+            self.headers = room_headers(room)
+            self.folder = room_folder(server.workdir, room["room_id"])
+        else:
+            base = "/api"
+            self.headers = {}
+            self.folder = Path(server.workdir, "shared_files")
+        self.listing = f"{base}/files"
+        self.upload = f"{base}/upload"
+        self.download = f"{base}/download/"
+
+    def fetch(self, name):
+        status, n = request_discard(self.port, "GET", self.download + quote(name), headers=self.headers)
+        if status != 200:
+            raise RuntimeError(f"download returned {status}")
+        return n
+
+    def put(self, name, data):
+        status, _, _ = request(self.port, "POST", self.upload, body=data,
+                               headers=dict(self.headers, **{"X-Filename": name}))
+        if status != 200:
+            raise RuntimeError(f"upload returned {status}")
+        return len(data)
+
+    def list(self):
+        status, _, body = request(self.port, "GET", self.listing, headers=self.headers)
+        if status != 200:
+            raise RuntimeError(f"listing returned {status}")
+        return len(body)
+
+
+def targets(server, which, count):
+    if which == "web":
+        return [Target(server, which, create_room(server.port)) for _ in range(count)]
+    return [Target(server, which)]
+
+
+def fill(target, files, size=256):
+    for i in range(files):
+        (target.folder / f"file_{i:06d}.txt").write_bytes(b"x" * (i % size))
+
+
+def measure(server, operation, clients, duration):
+    """Drive operation() from `clients` threads; operation returns bytes moved"""
+    moved = [0]
+    lock = threading.Lock()
+
+    def counted():
+        n = operation() or 0
+        with lock:
+            moved[0] += n
+
+    cpu_before = server.cpu_seconds()
+    started = time.perf_counter()
+    ops, errors, latencies = run_clients(clients, duration, counted)
+    elapsed = time.perf_counter() - started
+    cpu_after = server.cpu_seconds()
+    result = {
+        "clients": clients,
+        "ops": ops,
+        "ops_per_sec": round(ops / elapsed, 1),
+        "mb_per_sec": round(moved[0] / elapsed / 1e6, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "errors": errors,
+    }
+    if cpu_before is not None and cpu_after is not None:
+        result["cpu_percent"] = round((cpu_after - cpu_before) / elapsed * 100, 1)
+    return result
+
+
+def workload_poll(server, which, args):
+    rooms = targets(server, which, args.rooms)
+    for target in rooms:
+        fill(target, args.files)
+    # Let the folder mtimes settle so the indexes can trust them
+    time.sleep(2.1)
+    return measure(server, lambda: random.choice(rooms).list(), args.clients, args.duration)
+
+
+def workload_mixed(server, which, args):
+    target = targets(server, which, 1)[0]
+    large = int(args.large_mb * 1024 * 1024)
+    write_random_file(target.folder / "large.bin", large)
+    for i in range(16):
+        write_random_file(target.folder / f"small_{i:02d}.bin", SMALL_FILE)
+    small_data = bytes(SMALL_FILE)
+    large_data = bytes(large)
+    counter = [0]
+    lock = threading.Lock()
+
+    def operation():
+        with lock:
+            counter[0] += 1
+            n = counter[0]
+        roll = random.random()
+        if roll < 0.60:
+            return target.fetch(f"small_{n % 16:02d}.bin")
+        if roll < 0.75:
+            return target.fetch("large.bin")
+        if roll < 0.95:
+            return target.put(f"upload_{n:06d}.bin", small_data)
+        return target.put(f"upload_large_{n:06d}.bin", large_data)
+
+    return measure(server, operation, args.clients, args.duration)
+
+
+def workload_listing(server, which, args):
+    rooms = targets(server, which, args.rooms)
+    for target in rooms:
+        fill(target, args.listing_files)
+    time.sleep(2.1)
+    if which != "web":
+        return measure(server, rooms[0].list, args.clients, args.duration)
+
+    def operation():
+        # The room list is what a new visitor sees, the file lists are what they open next
+        status, _, body = request(server.port, "GET", "/api/rooms")
+        if status != 200:
+            raise RuntimeError(f"/api/rooms returned {status}")
+        return len(body) + random.choice(rooms).list()
+
+    return measure(server, operation, args.clients, args.duration)
+
+
+def workload_join(server, which, args):
+    if which != "web":
+        return None
+    rooms = [create_room(server.port) for _ in range(args.rooms)]
+
+    def operation():
+        room = random.choice(rooms)
+        # One in ten visitors mistypes the password
+        wrong = random.random() < 0.1
+        body = json.dumps({"room_id": room["room_id"], "password": "wrong" if wrong else "benchpass"})
+        status, _, data = request(server.port, "POST", "/api/join-room", body=body,
+                                  headers={"Content-Type": "application/json"})
+        if status != (403 if wrong else 200):
+            raise RuntimeError(f"join-room returned {status}")
+        return len(data)
+
+    return measure(server, operation, args.clients, args.duration)
+
+
+WORKLOADS = {
+    "poll": workload_poll,
+    "mixed": workload_mixed,
+    "listing": workload_listing,
+    "join": workload_join,
+}
+
+
+def run(which, workloads, args, server_path=None, legacy=False, label="current"):
+    results = []
+    for name in workloads:
+        with ServerProcess(which, args.server_args, server_path=server_path, legacy=legacy) as server:
+            result = WORKLOADS[name](server, which, args)
+            if result is None:
+                continue
+            result = dict({"label": label, "server": which, "workload": name}, **result)
+            result["peak_rss_mb"] = round((server.peak_rss() or 0) / 1e6, 1)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous, threshold):
+    """Print throughput and p99 changes against an earlier results file"""
+    old = {(r["server"], r["workload"], r["clients"]): r for r in previous["results"] if r["label"] == "current"}
+    regressions = 0
+    for result in results:
+        before = old.get((result["server"], result["workload"], result["clients"]))
+        if not before or result["label"] != "current":
+            continue
+        ops = result["ops_per_sec"] / before["ops_per_sec"] if before["ops_per_sec"] else 1.0
+        p99 = result["p99_ms"] / before["p99_ms"] if before["p99_ms"] else 1.0
+        regressed = ops < 1 - threshold or p99 > 1 + threshold
+        regressions += regressed
+        print(json.dumps({
+            "compare": result["workload"],
+            "server": result["server"],
+            "previous": previous["meta"].get("revision"),
+            "ops_per_sec_ratio": round(ops, 3),
+            "p99_ratio": round(p99, 3),
+            "regression": regressed,
+        }))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["web", "server"], default="web")
+    parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--files", type=int, default=200, help="files per room for poll")
+    parser.add_argument("--listing-files", type=int, default=2000, help="files per room for listing")
+    parser.add_argument("--large-mb", type=float, default=16)
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[],
+                        help="extra arguments for server.py, must come last")
+    parser.add_argument("--baseline", metavar="REV", help="also run against server.py from this git revision")
+    parser.add_argument("--legacy", action="store_true",
+                        help="the baseline predates command line options (fixed port 8888)")
+    parser.add_argument("--output", help="write all results to this JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare with results written by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change counted as a regression by --compare")
+    args = parser.parse_args()
+    random.seed(1)
+
+    results = run(args.server, args.workloads, args)
+    if args.baseline:
+        with tempfile.TemporaryDirectory(prefix="fx-baseline-") as tmp:
+            path = checkout_server(args.server, args.baseline, tmp)
+            results += run(args.server, args.workloads, args, server_path=path,
+                           legacy=args.legacy, label=args.baseline)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())
+        if compare(results, previous, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,769 @@
 import os
+import errno
 import socket
 import threading
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import json
 import mimetypes
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlparse, unquote, parse_qs
+from collections import deque, OrderedDict
+import zlib
+import queue
+from contextlib import contextmanager
 import shutil
+import secrets
+import hashlib
+import tempfile
+import time
 import sys
+import io
+import csv
+import multiprocessing
+
+# Optional codecs, used when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Image thumbnails need Pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 UPLOAD_FOLDER = Path("shared_files")
 UPLOAD_FOLDER.mkdir(exist_ok=True)
 
+# Block sizes for streaming file transfers
+CHUNK_SIZE = 1024 * 1024
+SENDFILE_BLOCK = 8 * 1024 * 1024
+# os.sendfile errors that make us fall back to chunked reads
+SENDFILE_FALLBACK_ERRORS = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                            errno.EOPNOTSUPP, errno.EAGAIN}
+# Unfinished uploads are written to temp files with this prefix
+UPLOAD_PREFIX = ".upload-"
+# New files get the same mode a plain open() would give them
+UMASK = os.umask(0)
+os.umask(UMASK)
+MAX_UPLOAD_SIZE = 10 * 1024 ** 3
+# Chunked uploads: chunk size bounds and lifetime of an unfinished session
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+# File change notifications (SSE / long-poll)
+EVENT_HISTORY = 256
+RESCAN_INTERVAL = 2.0
+EVENT_HEARTBEAT = 15.0
+EVENT_STREAM_LIFETIME = 300.0
+LONG_POLL_TIMEOUT = 30.0
+
+# Response compression: smallest body worth compressing, zlib/brotli/zstd level
+COMPRESS_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+# Compressed downloads are cached on disk up to this total size
+COMPRESSION_CACHE_FOLDER = Path(".cache") / "compressed"
+COMPRESSION_CACHE_SIZE = 512 * 1024 ** 2
+# Previews: image thumbnails and the head of text files, cached on disk by content hash
+PREVIEW_CACHE_FOLDER = Path(".cache") / "previews"
+PREVIEW_CACHE_SIZE = 256 * 1024 ** 2
+PREVIEW_SIZE = 256
+PREVIEW_QUALITY = 80
+PREVIEW_IMAGE_LIMIT = 64 * 1024 ** 2
+PREVIEW_TEXT_BYTES = 8 * 1024
+PREVIEW_TEXT_LINES = 40
+PREVIEW_TABLE_ROWS = 20
+PREVIEW_CELL_LENGTH = 200
+PREVIEW_TIMEOUT = 10.0
+PREVIEW_KEYS = 10000
+PREVIEW_IMAGE_TYPES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+PREVIEW_TABLE_TYPES = {".csv", ".tsv"}
+PREVIEW_TEXT_TYPES = {".txt", ".md", ".log", ".json", ".xml", ".yaml", ".yml", ".ini", ".cfg",
+                      ".conf", ".py", ".js", ".ts", ".html", ".css", ".sql", ".sh", ".bat"}
+# Without Pillow, small images in browser formats serve as their own preview
+PREVIEW_PASSTHROUGH_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+                             ".gif": "image/gif", ".webp": "image/webp"}
+PREVIEW_PASSTHROUGH_LIMIT = 256 * 1024
+# UI files are kept in memory, changes on disk are checked at most once a second
+STATIC_FOLDER = Path(__file__).resolve().parent
+STATIC_FILES = {"/": "index.html", "/index.html": "index.html"}
+STATIC_CHECK_INTERVAL = 1.0
+# Content codings in order of preference, gzip is always available
+ENCODINGS = [name for name, codec in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if codec]
+# Types that are compressed already and gain nothing from another pass
+PRECOMPRESSED_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/zstd", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/vnd.rar", "application/java-archive",
+    "application/pdf", "application/epub+zip", "application/x-iso9660-image",
+}
+
+# Metrics: latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Access log: queued lines, file size before rotation and rotated copies kept
+ACCESS_LOG_QUEUE = 10000
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 5
+
+class UploadTooLarge(Exception):
+    pass
+
+def safe_filename(name):
+    """Strip directories from a client supplied name, None if it is unusable"""
+    name = Path(name.replace('\\', '/')).name
+    if not name or name in ('.', '..') or name.startswith(UPLOAD_PREFIX):
+        return None
+    return name
+
+MAX_RANGES = 32
+
+def file_etag(st):
+    """Strong ETag derived from file size and modification time"""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def parse_range(header, size):
+    """Parse a Range header into a list of inclusive (start, end) byte ranges.
+
+    Returns None when the header is absent, malformed or asks for too many
+    ranges (the full file is sent), and [] when no range is satisfiable.
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    specs = header.split('=', 1)[1].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else max(start, size - 1)
+                if end < start:
+                    return None
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if start < 0:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    return ranges
+
+def negotiate_encoding(accept_encoding):
+    """Preferred content coding the client accepts, None for identity"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+class BrotliStream:
+    """brotli.Compressor with the compress/flush interface of zlib"""
+    
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=COMPRESSION_LEVEL)
+    
+    def compress(self, data):
+        return self.compressor.process(data)
+    
+    def flush(self):
+        return self.compressor.finish()
+
+def new_compressor(encoding):
+    """Streaming compressor for a content coding from ENCODINGS"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+    if encoding == "br":
+        return BrotliStream()
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+def compress_bytes(data, encoding):
+    compressor = new_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+def is_compressible(filepath, f):
+    """Whether a download is worth compressing.
+
+    Archives, media and other precompressed types are skipped by MIME type;
+    files of unknown type are judged by how well their first block packs.
+    """
+    content_type, encoding = mimetypes.guess_type(str(filepath))
+    if encoding:
+        return False
+    if content_type:
+        major = content_type.split('/')[0]
+        if content_type in PRECOMPRESSED_TYPES or (major in ('image', 'audio', 'video')
+                                                   and not content_type.endswith('+xml')):
+            return False
+        if major == 'text' or content_type.endswith(('json', 'xml', 'javascript', 'sql')):
+            return True
+    sample = f.read(64 * 1024)
+    f.seek(0)
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+class CompressionCache:
+    """Compressed variants of downloaded files kept on disk, least recently used evicted first.
+
+    Entries are keyed by the file path, its ETag and the coding, so a file
+    that changes never gets a stale variant; old variants just age out.
+    """
+    
+    def __init__(self, folder=COMPRESSION_CACHE_FOLDER, max_size=COMPRESSION_CACHE_SIZE):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # name -> size, oldest first
+        self.total = 0
+        paths = []
+        for path in self.folder.iterdir():
+            if path.name.startswith(UPLOAD_PREFIX):
+                os.remove(path)
+            else:
+                paths.append((path.stat().st_mtime, path))
+        for _, path in sorted(paths):
+            self.entries[path.name] = path.stat().st_size
+            self.total += self.entries[path.name]
+        with self.lock:
+            self.evict()
+    
+    def key(self, filepath, etag, encoding):
+        digest = hashlib.blake2b(f"{filepath}\0{etag}".encode(), digest_size=16).hexdigest()
+        return f"{digest}.{encoding}"
+    
+    def open(self, key):
+        """Open a cached variant for reading, None on a miss"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            try:
+                return open(self.folder / key, 'rb')
+            except OSError:
+                self.total -= self.entries.pop(key)
+                return None
+    
+    def create(self):
+        """Temp file to write a new variant into, returns (file, path)"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=UPLOAD_PREFIX)
+        return os.fdopen(fd, 'wb'), tmp_path
+    
+    def store(self, key, tmp_path):
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.folder / key)
+        with self.lock:
+            self.total += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.evict()
+    
+    def evict(self):
+        # Called with self.lock held
+        while self.total > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.folder / name)
+            except OSError:
+                pass
+
+def preview_kind(name):
+    """"image", "table", "text" or None: what kind of preview a file name gets"""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in PREVIEW_IMAGE_TYPES:
+        return "image"
+    if ext in PREVIEW_TABLE_TYPES:
+        return "table"
+    if ext in PREVIEW_TEXT_TYPES or (mimetypes.guess_type(name)[0] or "").startswith("text/"):
+        return "text"
+    return None
+
+def text_preview(data, kind, delimiter=","):
+    """JSON preview of the head of a text file: its first lines, or first rows for a table
+    (delimiter is the fallback when the sample does not reveal one)"""
+    truncated = len(data) > PREVIEW_TEXT_BYTES
+    data = data[:PREVIEW_TEXT_BYTES]
+    if b"\0" in data:
+        raise ValueError("binary file")
+    text = data.decode("utf-8", errors="replace")
+    lines = text.splitlines()
+    if truncated and len(lines) > 1:
+        # The last line may have been cut off in the middle
+        lines.pop()
+    truncated = truncated or len(lines) > (PREVIEW_TABLE_ROWS if kind == "table" else PREVIEW_TEXT_LINES)
+    if kind == "table":
+        try:
+            delimiter = csv.Sniffer().sniff("\n".join(lines[:PREVIEW_TABLE_ROWS]), ",;\t|").delimiter
+        except csv.Error:
+            pass
+        rows = [[cell[:PREVIEW_CELL_LENGTH] for cell in row]
+                for row in csv.reader(lines[:PREVIEW_TABLE_ROWS], delimiter=delimiter)]
+        preview = {"kind": "table", "rows": rows, "truncated": truncated}
+    else:
+        preview = {"kind": "text", "lines": lines[:PREVIEW_TEXT_LINES], "truncated": truncated}
+    return json.dumps(preview, ensure_ascii=False).encode()
+
+def image_preview(data):
+    """JPEG thumbnail no larger than PREVIEW_SIZE on either side"""
+    image = Image.open(io.BytesIO(data))
+    # JPEG can be decoded straight to a reduced size
+    image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=PREVIEW_QUALITY, optimize=True)
+    return out.getvalue()
+
+def render_preview(path, kind, folder):
+    """Build the preview of one file; runs in a preview pool process.
+
+    The key is the SHA-256 of exactly the bytes the preview is made from
+    (the whole image, the head of a text file), so copies and renamed
+    files share one cached preview. Returns (key, tmp_path), tmp_path
+    being None when the cache already has the key. Raises ValueError if
+    the file has no usable preview.
+    """
+    with open(path, 'rb') as f:
+        limit = PREVIEW_IMAGE_LIMIT if kind == "image" else PREVIEW_TEXT_BYTES
+        data = f.read(limit + 1)
+    if kind == "image" and len(data) > limit:
+        raise ValueError("image too large for a preview")
+    key = f"{hashlib.sha256(data).hexdigest()[:40]}.{'jpg' if kind == 'image' else kind + '.json'}"
+    if os.path.exists(os.path.join(folder, key)):
+        return key, None
+    try:
+        if kind == "image":
+            body = image_preview(data)
+        else:
+            body = text_preview(data, kind, "\t" if path.lower().endswith(".tsv") else ",")
+    except Exception as e:
+        raise ValueError(f"no preview: {e}") from None
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=UPLOAD_PREFIX)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    return key, tmp_path
+
+def watch_parent(parent):
+    """Initializer of preview pool processes: exit once the server process is gone,
+    even if it was killed without shutting the pool down"""
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+class PreviewCache(CompressionCache):
+    """Rendered previews on disk, named by content key, least recently used evicted first"""
+    
+    def __init__(self, folder=PREVIEW_CACHE_FOLDER, max_size=PREVIEW_CACHE_SIZE):
+        super().__init__(folder, max_size)
+
+class PreviewService:
+    """Previews built by a pool of processes and kept in a PreviewCache.
+
+    Decoding a large image would stall a request thread, so rendering runs
+    in worker processes, spawned on first use. Previews are queued when a
+    file is uploaded and built lazily for files that have none yet. The
+    content key of each file version (path, size, mtime) is remembered, so
+    a preview that is already cached is found without reading the file; a
+    file that has no preview is remembered as such.
+    """
+    
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.keys = OrderedDict()  # (path, size, mtime_ns) -> content key, None if no preview
+        self.pending = {}  # (path, size, mtime_ns) -> Future of the key
+    
+    def request(self, path, st, kind):
+        """Future of the content key of a file's preview, None if it has none"""
+        version = (str(path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if version in self.keys:
+                self.keys.move_to_end(version)
+                future = Future()
+                future.set_result(self.keys[version])
+                return future
+            future = self.pending.get(version)
+            if future is not None:
+                return future
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=watch_parent, initargs=(os.getpid(),))
+            future = self.pending[version] = Future()
+            job = self.pool.submit(render_preview, str(path), kind, str(self.cache.folder))
+        job.add_done_callback(lambda job: self.finish(version, job, future))
+        return future
+    
+    def finish(self, version, job, future):
+        key = error = None
+        try:
+            key, tmp_path = job.result()
+            if tmp_path:
+                self.cache.store(key, tmp_path)
+            METRICS.inc("fx_previews_total", (("result", "built" if tmp_path else "cached"),))
+        except ValueError:
+            METRICS.inc("fx_previews_total", (("result", "none"),))
+        except Exception as e:
+            # E.g. a crashed pool process: try again next time
+            METRICS.inc("fx_previews_total", (("result", "error"),))
+            error = e
+        with self.lock:
+            self.pending.pop(version, None)
+            if error is None:
+                self.keys[version] = key
+                while len(self.keys) > PREVIEW_KEYS:
+                    self.keys.popitem(last=False)
+        if error is None:
+            future.set_result(key)
+        else:
+            future.set_exception(error)
+    
+    def forget(self, path, st):
+        """Drop the remembered key of a file version whose preview was evicted"""
+        with self.lock:
+            self.keys.pop((str(path), st.st_size, st.st_mtime_ns), None)
+    
+    def prefetch(self, paths):
+        """Queue previews of freshly uploaded files"""
+        for path in paths:
+            kind = preview_kind(path.name)
+            if kind is None or (kind == "image" and Image is None):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if kind != "image" or st.st_size <= PREVIEW_IMAGE_LIMIT:
+                self.request(path, st, kind)
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+class StaticAsset:
+    """One UI file held in memory with every compressed variant of it"""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.body = f.read()
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.etag = file_etag(st)
+        self.mtime = int(st.st_mtime)
+        self.content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        if self.content_type.startswith("text/"):
+            self.content_type += "; charset=utf-8"
+        self.variants = {}
+        if len(self.body) >= COMPRESS_MIN_SIZE:
+            for encoding in ENCODINGS:
+                self.variants[encoding] = compress_bytes(self.body, encoding)
+        self.checked = time.monotonic()
+
+class StaticAssets:
+    """UI files served from memory instead of being read on every request.
+
+    Files are looked up next to this script, not in the working directory.
+    A file is loaded and compressed once, then served as is until its
+    mtime or size changes; the file is stat()ed at most once per
+    STATIC_CHECK_INTERVAL, so an edited index.html shows up within a second.
+    """
+    
+    def __init__(self, folder=STATIC_FOLDER):
+        self.folder = Path(folder)
+        self.lock = threading.Lock()
+        self.assets = {}  # name -> StaticAsset
+    
+    def get(self, name):
+        """The current StaticAsset for a file name, None if there is no such file"""
+        asset = self.assets.get(name)
+        now = time.monotonic()
+        if asset and now - asset.checked < STATIC_CHECK_INTERVAL:
+            return asset
+        path = self.folder / name
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.assets.pop(name, None)
+            return None
+        if asset and asset.stamp == (st.st_mtime_ns, st.st_size):
+            asset.checked = now
+            return asset
+        with self.lock:
+            # Another thread may have reloaded the file while we waited
+            asset = self.assets.get(name)
+            if asset and asset.stamp == (st.st_mtime_ns, st.st_size):
+                return asset
+            try:
+                asset = StaticAsset(path)
+            except OSError:
+                return None
+            self.assets[name] = asset
+            METRICS.inc("fx_static_loads_total")
+            return asset
+
+# Route templates used as metric labels, anything else is counted as "other"
+ROUTES = {"/", "/api/files", "/api/server-info", "/api/download", "/api/upload",
+          "/api/upload-session", "/api/events", "/api/delete", "/api/metrics", "/api/preview"}
+UPLOAD_ROUTES = {"/api/upload", "/api/upload-session"}
+DOWNLOAD_ROUTES = {"/api/download"}
+
+def route_of(path):
+    """Route template of a request path, used as the metrics label"""
+    route = "/".join(path.split('?')[0].split('/')[:3]) or "/"
+    if not route.startswith("/api/"):
+        return "/"
+    return route if route in ROUTES else "other"
+
+METRIC_HELP = {
+    "fx_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "fx_request_duration_seconds": ("histogram", "Time to handle a request"),
+    "fx_received_bytes_total": ("counter", "Request bytes read, headers included"),
+    "fx_sent_bytes_total": ("counter", "Response bytes written, headers included"),
+    "fx_open_connections": ("gauge", "Client connections being served"),
+    "fx_transfers_in_flight": ("gauge", "Uploads and downloads in progress"),
+    "fx_span_duration_seconds": ("histogram", "Time spent in instrumented sections (--trace-spans)"),
+    "fx_access_log_dropped_total": ("counter", "Access log lines dropped because the queue was full"),
+    "fx_storage_bytes": ("gauge", "Bytes in the shared folder"),
+    "fx_files": ("gauge", "Files in the shared folder"),
+    "fx_upload_sessions": ("gauge", "Unfinished chunked upload sessions"),
+    "fx_static_loads_total": ("counter", "UI files read from disk into memory"),
+    "fx_previews_total": ("counter", "Preview jobs by result: built, cached (same content seen before), none or error"),
+}
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Series are keyed by metric name and a tuple of (label, value) pairs.
+    Gauges that are cheaper to read on demand come from collector
+    callbacks run at scrape time.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = []
+        self.spans_enabled = False
+    
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+    
+    def add(self, name, labels=(), value=1):
+        with self.lock:
+            self.gauges[name, labels] = self.gauges.get((name, labels), 0) + value
+    
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.histograms.get((name, labels))
+            if series is None:
+                series = self.histograms[name, labels] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def register(self, collector):
+        """collector() returns [(name, labels, value)] gauge samples"""
+        self.collectors.append(collector)
+    
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), series in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(LATENCY_BUCKETS, series):
+                    lines.append((name + "_bucket", labels + (("le", repr(bound)),), count))
+                lines.append((name + "_bucket", labels + (("le", "+Inf"),), series[-1]))
+                lines.append((name + "_sum", labels, series[-2]))
+                lines.append((name + "_count", labels, series[-1]))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((name, labels, value))
+        out = []
+        for name in sorted(samples):
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples[name]:
+                if labels:
+                    rendered = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                          .replace('"', '\\"').replace('\n', '\\n'))
+                                        for k, v in labels)
+                    sample = f"{sample}{{{rendered}}}"
+                out.append(f"{sample} {value}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+# Span totals of the request handled by the current thread
+REQUEST_SPANS = threading.local()
+
+@contextmanager
+def span(name):
+    """Time a section of work when --trace-spans is on.
+
+    The time goes to the fx_span_duration_seconds histogram and is added to
+    the current request's spans, which end up in its access log line.
+    """
+    if not METRICS.spans_enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        METRICS.observe("fx_span_duration_seconds", (("span", name),), elapsed)
+        totals = getattr(REQUEST_SPANS, "totals", None)
+        if totals is not None:
+            totals[name] = totals.get(name, 0.0) + elapsed
+
+class AccessLog:
+    """Access log written by a background thread.
+
+    Request threads only queue their line. The writer drains the queue in
+    batches into a buffered file, flushes whenever it runs dry and rotates
+    the file past max_bytes, keeping `backups` old copies (access.log.1 is
+    the newest). path "-" writes to stdout, None disables the log.
+    """
+    
+    def __init__(self, path, max_bytes=ACCESS_LOG_MAX_BYTES, backups=ACCESS_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(ACCESS_LOG_QUEUE)
+        self.thread = None
+        if path:
+            self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+            self.thread.start()
+    
+    def write(self, line):
+        if not self.thread:
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            METRICS.inc("fx_access_log_dropped_total")
+    
+    def open(self):
+        if self.path == "-":
+            return sys.stdout
+        return open(self.path, "a", encoding="utf-8", buffering=64 * 1024)
+    
+    def rotate(self, stream):
+        stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return self.open()
+    
+    def run(self):
+        stream = self.open()
+        size = 0 if self.path == "-" else os.path.getsize(self.path)
+        while True:
+            line = self.queue.get()
+            while line is not None:
+                stream.write(line + "\n")
+                size += len(line) + 1
+                if self.path != "-" and size >= self.max_bytes:
+                    stream = self.rotate(stream)
+                    size = 0
+                try:
+                    line = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stream.flush()
+            if line is None:
+                return
+    
+    def close(self, timeout=5):
+        """Write out the queued lines before exit"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+class CountingReader:
+    """Wraps a handler's rfile and counts the bytes read through it"""
+    
+    def __init__(self, raw, handler):
+        self.raw = raw
+        self.handler = handler
+    
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.handler.bytes_in += len(data)
+        return data
+    
+    def readline(self, size=-1):
+        data = self.raw.readline(size)
+        self.handler.bytes_in += len(data)
+        return data
+    
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class CountingWriter:
+    """Wraps a handler's wfile and counts the bytes written through it"""
+    
+    def __init__(self, raw, handler):
+        self.raw = raw
+        self.handler = handler
+    
+    def write(self, data):
+        n = self.raw.write(data)
+        self.handler.bytes_out += len(data)
+        return n
+    
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 def get_local_ip():
     """Get local IP address"""
     try:
@@ -23,45 +775,331 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
+class FileIndex:
+    """In-memory listing of a folder, kept current by the upload and delete paths.
+
+    Every read stats only the folder itself; the files are rescanned when the
+    folder's mtime shows a change made behind our back (a file copied in by
+    hand, another process). A folder modified within the last couple of
+    seconds is not trusted, since a coarse mtime could hide a second change.
+
+    Each change bumps the version and is kept in a short event history that
+    event stream clients wait on.
+    """
+    
+    def __init__(self, folder, hidden=()):
+        self.folder = Path(folder)
+        self.hidden = set(hidden)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = {}  # name -> {"name", "size", "modified"}
+        self.dir_mtime = None
+        self.listing = None
+        self.encoded = None
+        self.etag = None
+        # epoch tells event histories apart across server restarts
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self.events = deque(maxlen=EVENT_HISTORY)
+    
+    def is_hidden(self, name):
+        return name in self.hidden or name.startswith(UPLOAD_PREFIX)
+    
+    def remember_dir_mtime(self):
+        mtime = os.stat(self.folder).st_mtime
+        self.dir_mtime = None if time.time() - mtime < 2 else mtime
+    
+    def record(self, event_type, name, entry=None):
+        self.version += 1
+        self.listing = None
+        self.encoded = None
+        event = {"id": f"{self.epoch}:{self.version}", "type": event_type, "name": name}
+        if entry:
+            event["file"] = entry
+        self.events.append((self.version, event))
+        self.changed.notify_all()
+    
+    def refresh(self):
+        mtime = os.stat(self.folder).st_mtime
+        if mtime == self.dir_mtime:
+            return
+        entries = {}
+        with span("scan"), os.scandir(self.folder) as it:
+            for entry in it:
+                if self.is_hidden(entry.name) or not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries[entry.name] = {"name": entry.name, "size": st.st_size, "modified": st.st_mtime}
+        self.dir_mtime = None if time.time() - mtime < 2 else mtime
+        if entries != self.entries:
+            old = self.entries
+            self.entries = entries
+            for name in old.keys() - entries.keys():
+                self.record("file-deleted", name)
+            for name, entry in entries.items():
+                if old.get(name) != entry:
+                    self.record("file-added", name, entry)
+    
+    def files(self):
+        with self.lock:
+            self.refresh()
+            if self.listing is None:
+                self.listing = list(self.entries.values())
+            return self.listing
+    
+    def files_json(self, encoding=None):
+        """The listing encoded as JSON and its ETag, cached until the next change.
+
+        With a content coding the compressed body and its variant ETag are
+        returned (and cached) instead.
+        """
+        with self.lock:
+            self.refresh()
+            if self.encoded is None:
+                body = json.dumps(list(self.entries.values())).encode()
+                self.encoded = {None: body}
+                self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            if encoding is None:
+                return self.encoded[None], self.etag
+            if encoding not in self.encoded:
+                self.encoded[encoding] = compress_bytes(self.encoded[None], encoding)
+            return self.encoded[encoding], f'{self.etag[:-1]}-{encoding}"'
+
+    
+    def count(self):
+        with self.lock:
+            self.refresh()
+            return len(self.entries)
+    
+    def total_size(self):
+        with self.lock:
+            self.refresh()
+            return sum(e["size"] for e in self.entries.values())
+    
+    def add(self, path):
+        st = os.stat(path)
+        entry = {"name": path.name, "size": st.st_size, "modified": st.st_mtime}
+        with self.lock:
+            self.entries[path.name] = entry
+            self.record("file-added", path.name, entry)
+            self.remember_dir_mtime()
+    
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.record("file-deleted", name)
+            self.remember_dir_mtime()
+    
+    def cursor(self):
+        with self.lock:
+            return f"{self.epoch}:{self.version}"
+    
+    def wait_for_changes(self, since, timeout):
+        """Block until there are events after the cursor since, or timeout.
+
+        Returns (cursor, events); events is None when since is unknown or
+        too old for the history, and the client has to reload the listing.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            self.refresh()
+            epoch, _, version = (since or "").partition(":")
+            if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+                return f"{self.epoch}:{self.version}", None
+            since_version = int(version)
+            while self.version <= since_version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Recheck the folder now and then for outside changes
+                self.changed.wait(min(remaining, RESCAN_INTERVAL))
+                self.refresh()
+            if self.version > since_version and (not self.events or self.events[0][0] > since_version + 1):
+                return f"{self.epoch}:{self.version}", None
+            events = [event for v, event in self.events if v > since_version]
+            return f"{self.epoch}:{self.version}", events
+
+FILE_INDEX = FileIndex(UPLOAD_FOLDER)
+
+class UploadSession:
+    """A resumable upload assembled from numbered chunks.
+
+    The target is preallocated as a temp file in the destination folder and
+    every chunk is written at its own offset through a separate descriptor,
+    so chunks may arrive out of order and in parallel.
+    """
+    
+    def __init__(self, session_id, folder, filename, size, chunk_size, owner=None):
+        self.session_id = session_id
+        self.folder = folder
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.owner = owner
+        self.chunk_count = (size + chunk_size - 1) // chunk_size
+        self.received = set()
+        self.lock = threading.Lock()
+        self.updated = time.time()
+        self.path = folder / f"{UPLOAD_PREFIX}{session_id}"
+        with open(self.path, 'wb') as f:
+            if size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass
+            f.truncate(size)
+    
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+    
+    def write_chunk(self, index, chunks):
+        """Write one chunk from an iterable of byte strings, returns its length"""
+        offset = index * self.chunk_size
+        written = 0
+        fd = os.open(self.path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for data in chunks:
+                view = memoryview(data)
+                while view:
+                    with span("write"):
+                        if hasattr(os, "pwrite"):
+                            n = os.pwrite(fd, view, offset + written)
+                        else:
+                            os.lseek(fd, offset + written, os.SEEK_SET)
+                            n = os.write(fd, view)
+                    view = view[n:]
+                    written += n
+        finally:
+            os.close(fd)
+        if written == self.chunk_length(index):
+            with self.lock:
+                self.received.add(index)
+                self.updated = time.time()
+        return written
+    
+    def missing(self):
+        with self.lock:
+            return [i for i in range(self.chunk_count) if i not in self.received]
+    
+    def status(self):
+        with self.lock:
+            received = sorted(self.received)
+        return {
+            "session_id": self.session_id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunk_count,
+            "received": received,
+            "complete": len(received) == self.chunk_count,
+        }
+    
+    def finalize(self):
+        """Move the assembled file into place, returns the final path"""
+        with open(self.path, 'rb+') as f, span("fsync"):
+            os.fsync(f.fileno())
+        os.chmod(self.path, 0o666 & ~UMASK)
+        target = self.folder / self.filename
+        os.replace(self.path, target)
+        return target
+    
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
 class FileExchangeHandler(SimpleHTTPRequestHandler):
+    upload_sessions = {}  # session_id -> UploadSession
+    sessions_lock = threading.Lock()
+    # Open event streams and long-polls, each one holds a worker thread
+    event_slots = threading.Semaphore(16)
+    # On-disk cache of compressed downloads, None compresses every time
+    compression_cache = None
+    # UI files held in memory
+    static = StaticAssets()
+    # Previews of shared files (PreviewService), None when disabled
+    previews = None
+    # Background access log, None prints every line straight to stdout
+    access_log = None
+    
+    @classmethod
+    def storage_metrics(cls):
+        with cls.sessions_lock:
+            sessions = len(cls.upload_sessions)
+        return [("fx_storage_bytes", (), FILE_INDEX.total_size()),
+                ("fx_files", (), FILE_INDEX.count()),
+                ("fx_upload_sessions", (), sessions)]
+    
     def do_GET(self):
         if self.path == "/api/files":
             self.list_files()
         elif self.path == "/api/server-info":
             self.server_info()
+        elif self.path == "/api/metrics":
+            self.serve_metrics()
         elif self.path.startswith("/api/download/"):
             self.download_file()
+        elif self.path.startswith("/api/preview/"):
+            self.file_preview()
+        elif self.path.startswith("/api/upload-session/"):
+            self.upload_session_status()
+        elif self.path == "/api/events" or self.path.startswith("/api/events?"):
+            self.stream_events(FILE_INDEX)
+        elif self.path in STATIC_FILES:
+            self.serve_static(STATIC_FILES[self.path])
+        elif self.path.startswith("/api/"):
+            self.send_error(404)
         else:
-            self.serve_index()
+            self.serve_static("index.html")
     
     def do_POST(self):
         if self.path == "/api/upload":
             self.upload_file()
+        elif self.path == "/api/upload-session":
+            self.create_upload_session()
+        elif self.path.startswith("/api/upload-session/") and self.path.endswith("/finalize"):
+            self.finalize_upload_session()
+        else:
+            self.send_error(404)
+    
+    def do_PUT(self):
+        if self.path.startswith("/api/upload-session/"):
+            self.upload_chunk()
+        else:
+            self.send_error(404)
+    
+    def do_HEAD(self):
+        if self.path.startswith("/api/download/"):
+            self.download_file()
+        elif self.path in STATIC_FILES:
+            self.serve_static(STATIC_FILES[self.path])
         else:
             self.send_error(404)
     
     def do_DELETE(self):
         if self.path.startswith("/api/delete/"):
             self.delete_file()
+        elif self.path.startswith("/api/upload-session/"):
+            self.abort_upload_session()
         else:
             self.send_error(404)
     
     def list_files(self):
         try:
-            files = []
-            for item in UPLOAD_FOLDER.iterdir():
-                if item.is_file():
-                    files.append({
-                        "name": item.name,
-                        "size": item.stat().st_size,
-                        "modified": item.stat().st_mtime
-                    })
+            body, etag = FILE_INDEX.files_json()
+            encoding = self.response_encoding(len(body))
+            if encoding:
+                body, etag = FILE_INDEX.files_json(encoding)
+            if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
             
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            self.wfile.write(json.dumps(files).encode())
+            self.send_json_bytes(body, headers={"ETag": etag, "Cache-Control": "no-cache"},
+                                 encoding=encoding)
         except Exception as e:
             self.send_error(500, str(e))
     
@@ -70,7 +1108,7 @@ class FileExchangeHandler(SimpleHTTPRequestHandler):
             local_ip = get_local_ip()
             info = {
                 "local_ip": local_ip,
-                "port": 8888,
+                "port": self.server.server_address[1],
                 "status": "online"
             }
             self.send_response(200)
@@ -81,45 +1119,575 @@ class FileExchangeHandler(SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
+    def read_body_chunks(self, limit):
+        """Yield the request body in bounded chunks.
+
+        Handles both Content-Length and Transfer-Encoding: chunked bodies and
+        raises UploadTooLarge as soon as more than limit bytes have arrived.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            received = 0
+            while True:
+                line = self.rfile.readline(65537)
+                if not line:
+                    raise ConnectionAbortedError("connection closed inside chunked body")
+                try:
+                    chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ValueError("bad chunk size line")
+                if chunk_size == 0:
+                    # Skip trailer headers up to the blank line
+                    while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                received += chunk_size
+                if received > limit:
+                    raise UploadTooLarge()
+                yield from self.read_exact_chunks(chunk_size)
+                self.rfile.readline(65537)
+        else:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            if content_length < 0:
+                raise ValueError("negative Content-Length")
+            if content_length > limit:
+                raise UploadTooLarge()
+            yield from self.read_exact_chunks(content_length)
+    
+    def read_exact_chunks(self, count):
+        while count > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                raise ConnectionAbortedError("connection closed before the body was complete")
+            count -= len(chunk)
+            yield chunk
+    
+    def receive_upload(self, folder, filename, limit):
+        """Stream the request body into folder/filename, returns its size.
+
+        The body goes to a temporary file next to the target which is renamed
+        into place only once complete, so listings never show partial files.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=UPLOAD_PREFIX)
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.read_body_chunks(limit):
+                    with span("write"):
+                        f.write(chunk)
+                    size += len(chunk)
+                with span("fsync"):
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+            os.replace(tmp_path, folder / filename)
+            return size
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
     def download_file(self):
         try:
             filename = unquote(self.path.split("/api/download/")[1])
             filepath = UPLOAD_FOLDER / filename
             
-            if not filepath.exists() or not filepath.is_file():
+            if not filepath.is_file():
                 self.send_error(404, "File not found")
                 return
             
-            self.send_response(200)
-            self.send_header("Content-type", mimetypes.guess_type(filepath)[0] or "application/octet-stream")
-            self.send_header("Content-Length", filepath.stat().st_size)
+            self.send_file(filepath)
+        except ConnectionError:
+            # Client went away mid-download, nothing left to report
+            self.close_connection = True
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    def file_preview(self):
+        """A small preview of a shared file instead of the whole file.
+
+        Images get a JPEG thumbnail (with Pillow; without it small images
+        are sent as they are), text files their first lines and CSV/TSV
+        files their first rows as JSON. A preview not built yet is waited
+        for up to PREVIEW_TIMEOUT, then the answer is 503 with Retry-After.
+        """
+        try:
+            filename = safe_filename(unquote(urlparse(self.path).path.split("/api/preview/")[1]))
+            filepath = UPLOAD_FOLDER / filename if filename else None
+            if not filepath or not filepath.is_file():
+                self.send_error(404, "File not found")
+                return
+            st = os.stat(filepath)
+            kind = preview_kind(filepath.name) if self.previews else None
+            if kind == "image" and Image is None:
+                content_type = PREVIEW_PASSTHROUGH_TYPES.get(filepath.suffix.lower())
+                if content_type and st.st_size <= PREVIEW_PASSTHROUGH_LIMIT:
+                    with open(filepath, 'rb') as f:
+                        self.send_preview(f.read(), content_type, file_etag(st))
+                    return
+                kind = None
+            if kind is None or (kind == "image" and st.st_size > PREVIEW_IMAGE_LIMIT):
+                self.send_error(404, "No preview for this file")
+                return
+            
+            try:
+                key = self.previews.request(filepath, st, kind).result(PREVIEW_TIMEOUT)
+            except FutureTimeout:
+                key = False
+            f = self.previews.cache.open(key) if key else None
+            if key is None:
+                self.send_error(404, "No preview for this file")
+                return
+            if f is None:
+                if key:
+                    # Evicted from the cache, it is rebuilt on the next request
+                    self.previews.forget(filepath, st)
+                self.send_json_bytes(json.dumps({"status": "pending"}).encode(), 503, {"Retry-After": "2"})
+                return
+            with f:
+                body = f.read()
+            self.send_preview(body, "image/jpeg" if key.endswith(".jpg") else "application/json", f'"{key}"')
+            
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def send_preview(self, body, content_type, etag):
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        encoding = self.response_encoding(len(body)) if content_type == "application/json" else None
+        if encoding:
+            body = compress_bytes(body, encoding)
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", len(body))
+        self.send_header("ETag", etag)
+        # The same name may point to other content later, so browsers revalidate
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_file(self, filepath):
+        """Send a file as a download, honouring conditional and Range headers.
+
+        Answers 304 for a matching If-None-Match, 206 with one range or a
+        multipart/byteranges body, 416 for unsatisfiable ranges and 200 with
+        the whole file otherwise. HEAD requests get the headers only.
+        """
+        with open(filepath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = file_etag(st)
+            last_modified = self.date_time_string(int(st.st_mtime))
+            content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+            
+            # Only whole-file responses are compressed, ranges address the raw bytes
+            encoding = None
+            if not self.headers.get('Range'):
+                encoding = self.response_encoding(size)
+                if encoding and not is_compressible(filepath, f):
+                    encoding = None
+            if encoding:
+                etag = f'{etag[:-1]}-{encoding}"'
+            
+            if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+            
+            if encoding:
+                self.send_compressed(f, filepath, etag, encoding, content_type, last_modified)
+                return
+            
+            ranges = parse_range(self.headers.get('Range'), size)
+            if_range = self.headers.get('If-Range')
+            if ranges is not None and if_range and if_range.strip() not in (etag, last_modified):
+                ranges = None
+            
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return
+            
+            if ranges is None:
+                self.send_response(200)
+                self.send_header("Content-type", content_type)
+                self.send_header("Content-Length", size)
+                parts = [(None, 0, size)]
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-type", content_type)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", end - start + 1)
+                parts = [(None, start, end - start + 1)]
+            else:
+                boundary = secrets.token_hex(16)
+                parts = []
+                length = 0
+                for start, end in ranges:
+                    head = (f"\r\n--{boundary}\r\n"
+                            f"Content-Type: {content_type}\r\n"
+                            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                    parts.append((head, start, end - start + 1))
+                    length += len(head) + end - start + 1
+                tail = f"\r\n--{boundary}--\r\n".encode()
+                length += len(tail)
+                parts.append((tail, 0, 0))
+                self.send_response(206)
+                self.send_header("Content-type", f"multipart/byteranges; boundary={boundary}")
+                self.send_header("Content-Length", length)
+            
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Last-Modified", last_modified)
             self.send_header("Content-Disposition", f'attachment; filename="{filepath.name}"')
             self.send_header("Access-Control-Allow-Origin", "*")
             self.end_headers()
             
-            with open(filepath, 'rb') as f:
-                self.wfile.write(f.read())
-        except Exception as e:
-            self.send_error(500, str(e))
+            if self.command == 'HEAD':
+                return
+            for head, offset, count in parts:
+                if head:
+                    self.wfile.write(head)
+                self.send_file_range(f, offset, count)
+    
+    def send_compressed(self, f, filepath, etag, encoding, content_type, last_modified):
+        """Send a whole file with a Content-Encoding.
+
+        A cached variant goes out through sendfile with a Content-Length.
+        Otherwise the file is compressed while it streams, copied into the
+        cache on the way, and the end of the body is marked by closing the
+        connection.
+        """
+        cache = self.compression_cache
+        key = cache.key(filepath, etag, encoding) if cache else None
+        cached = cache.open(key) if cache else None
+        
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Content-Disposition", f'attachment; filename="{filepath.name}"')
+        if cached:
+            with cached:
+                length = os.fstat(cached.fileno()).st_size
+                self.send_header("Content-Length", length)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.send_file_range(cached, 0, length)
+            return
+        
+        self.close_connection = True
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        # Variants of very large files would flush the whole cache
+        size = os.fstat(f.fileno()).st_size
+        out, tmp_path = cache.create() if cache and size <= cache.max_size // 4 else (None, None)
+        try:
+            compressor = new_compressor(encoding)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                data = compressor.compress(chunk)
+                if data:
+                    self.wfile.write(data)
+                    if out:
+                        out.write(data)
+            data = compressor.flush()
+            self.wfile.write(data)
+            if out:
+                out.write(data)
+                out.close()
+                cache.store(key, tmp_path)
+                out = None
+        finally:
+            if out:
+                out.close()
+                os.remove(tmp_path)
+    
+    def send_file_range(self, f, offset, count):
+        """Stream count bytes of an open file starting at offset to the client.
+
+        Uses zero-copy os.sendfile when the platform and socket support it,
+        otherwise falls back to fixed-size chunked reads.
+        """
+        if hasattr(os, "sendfile"):
+            try:
+                out_fd = self.connection.fileno()
+                in_fd = f.fileno()
+                while count > 0:
+                    with span("sendfile"):
+                        sent = os.sendfile(out_fd, in_fd, offset, min(count, SENDFILE_BLOCK))
+                    if sent == 0:
+                        raise ConnectionAbortedError("file truncated while sending")
+                    self.bytes_out += sent
+                    offset += sent
+                    count -= sent
+                return
+            except OSError as e:
+                if e.errno not in SENDFILE_FALLBACK_ERRORS:
+                    raise
+        f.seek(offset)
+        while count > 0:
+            with span("read"):
+                chunk = f.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                raise ConnectionAbortedError("file truncated while sending")
+            self.wfile.write(chunk)
+            count -= len(chunk)
     
     def upload_file(self):
         try:
-            content_length = int(self.headers['Content-Length'])
-            filename = self.headers.get('X-Filename', 'uploaded_file')
-            
-            filepath = UPLOAD_FOLDER / filename
+            filename = safe_filename(self.headers.get('X-Filename', 'uploaded_file'))
+            if not filename:
+                self.close_connection = True
+                self.send_error(400, "Invalid filename")
+                return
             
-            with open(filepath, 'wb') as f:
-                f.write(self.rfile.read(content_length))
+            size = self.receive_upload(UPLOAD_FOLDER, filename, MAX_UPLOAD_SIZE)
+            FILE_INDEX.add(UPLOAD_FOLDER / filename)
+            if self.previews:
+                self.previews.prefetch([UPLOAD_FOLDER / filename])
             
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.send_header("Access-Control-Allow-Origin", "*")
             self.end_headers()
-            self.wfile.write(json.dumps({"status": "success", "filename": filename}).encode())
+            self.wfile.write(json.dumps({"status": "success", "filename": filename, "size": size}).encode())
+        except UploadTooLarge:
+            self.close_connection = True
+            self.send_error(413, "File too large")
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, f"Bad request body: {e}")
+        except ConnectionError:
+            # Client aborted the upload, the temp file is already removed
+            self.close_connection = True
         except Exception as e:
             self.send_error(500, str(e))
     
+    def get_upload_session(self, session_id):
+        with self.sessions_lock:
+            session = self.upload_sessions.get(session_id)
+        if not session:
+            self.close_connection = True
+            self.send_error(404, "Upload session not found")
+        return session
+    
+    @classmethod
+    def expire_upload_sessions(cls):
+        deadline = time.time() - UPLOAD_SESSION_TTL
+        with cls.sessions_lock:
+            expired = [sid for sid, s in cls.upload_sessions.items() if s.updated < deadline]
+            sessions = [cls.upload_sessions.pop(sid) for sid in expired]
+        for session in sessions:
+            session.discard()
+    
+    def create_upload_session(self):
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            filename = safe_filename(str(data.get('filename', '')))
+            size = int(data.get('size', -1))
+            chunk_size = int(data.get('chunk_size') or DEFAULT_CHUNK_SIZE)
+            
+            if not filename or size < 0:
+                self.send_error(400, "Invalid filename or size")
+                return
+            if size > MAX_UPLOAD_SIZE:
+                self.send_error(413, "File too large")
+                return
+            chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+            
+            self.expire_upload_sessions()
+            session_id = secrets.token_hex(16)
+            session = UploadSession(session_id, UPLOAD_FOLDER, filename, size, chunk_size)
+            with self.sessions_lock:
+                self.upload_sessions[session_id] = session
+            
+            self.send_json_response(dict(session.status(), status="success"))
+        except (ValueError, TypeError) as e:
+            self.send_error(400, f"Bad request: {e}")
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def upload_chunk(self):
+        try:
+            # /api/upload-session/{session_id}/{index}
+            parts = self.path.split('/')
+            if len(parts) != 5:
+                self.close_connection = True
+                self.send_error(404)
+                return
+            session = self.get_upload_session(parts[3])
+            if not session:
+                return
+            
+            index = int(parts[4])
+            if not 0 <= index < session.chunk_count:
+                self.close_connection = True
+                self.send_error(400, "Invalid chunk index")
+                return
+            
+            expected = session.chunk_length(index)
+            written = session.write_chunk(index, self.read_body_chunks(expected))
+            if written != expected:
+                self.send_error(400, "Incomplete chunk")
+                return
+            
+            self.send_json_response({"status": "success", "index": index})
+        except UploadTooLarge:
+            self.close_connection = True
+            self.send_error(413, "Chunk larger than expected")
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, f"Bad request: {e}")
+        except ConnectionError:
+            # The chunk stays missing and the client sends it again
+            self.close_connection = True
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def upload_session_status(self):
+        try:
+            session = self.get_upload_session(self.path.split('/')[3])
+            if session:
+                self.send_json_response(session.status())
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def finalize_upload_session(self):
+        try:
+            session = self.get_upload_session(self.path.split('/')[3])
+            if not session:
+                return
+            
+            missing = session.missing()
+            if missing:
+                self.send_json_response({"status": "incomplete", "missing": missing}, 409)
+                return
+            
+            with self.sessions_lock:
+                if self.upload_sessions.pop(session.session_id, None) is None:
+                    self.send_error(404, "Upload session not found")
+                    return
+            try:
+                path = session.finalize()
+            except Exception:
+                # The session is already forgotten and cannot be retried
+                session.discard()
+                raise
+            FILE_INDEX.add(path)
+            if self.previews:
+                self.previews.prefetch([path])
+            
+            self.send_json_response({"status": "success", "filename": session.filename,
+                                     "size": session.size})
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def abort_upload_session(self):
+        try:
+            session = self.get_upload_session(self.path.split('/')[3])
+            if not session:
+                return
+            with self.sessions_lock:
+                self.upload_sessions.pop(session.session_id, None)
+            session.discard()
+            self.send_json_response({"status": "success"})
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def stream_events(self, index):
+        """Push changes of a file index to the client.
+
+        Default is a Server-Sent Events stream; ?mode=poll turns it into a
+        long-poll that answers with the events as JSON as soon as there are
+        any. The cursor comes from ?since= or the Last-Event-ID header.
+        """
+        query = parse_qs(urlparse(self.path).query)
+        since = query.get('since', [self.headers.get('Last-Event-ID', '')])[0] or index.cursor()
+        
+        if not self.event_slots.acquire(blocking=False):
+            if query.get('mode') == ['poll']:
+                # No free slot: answer right away, the client polls again later
+                cursor, events = index.wait_for_changes(since, 0)
+                self.send_json_response({"cursor": cursor, "events": events or [],
+                                         "reset": events is None})
+            else:
+                self.send_response(503)
+                self.send_header("Retry-After", "5")
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+            return
+        try:
+            if query.get('mode') == ['poll']:
+                timeout = min(float(query.get('timeout', [LONG_POLL_TIMEOUT])[0]), LONG_POLL_TIMEOUT)
+                cursor, events = index.wait_for_changes(since, max(timeout, 0))
+                self.send_json_response({"cursor": cursor, "events": events or [],
+                                         "reset": events is None})
+                return
+            
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(f"retry: 3000\nid: {since}\nevent: ready\ndata: {{}}\n\n".encode())
+            
+            deadline = time.monotonic() + EVENT_STREAM_LIFETIME
+            while time.monotonic() < deadline:
+                cursor, events = index.wait_for_changes(since, EVENT_HEARTBEAT)
+                if events is None:
+                    self.wfile.write(f"id: {cursor}\nevent: reset\ndata: {{}}\n\n".encode())
+                elif events:
+                    self.wfile.write("".join(
+                        f"id: {e['id']}\nevent: {e['type']}\ndata: {json.dumps(e)}\n\n" for e in events
+                    ).encode())
+                else:
+                    self.wfile.write(b": ping\n\n")
+                since = cursor
+        except ConnectionError:
+            self.close_connection = True
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, 400)
+        finally:
+            self.event_slots.release()
+    
+    def send_json_response(self, data, status=200):
+        body = json.dumps(data).encode()
+        encoding = self.response_encoding(len(body))
+        if encoding:
+            body = compress_bytes(body, encoding)
+        self.send_json_bytes(body, status, encoding=encoding)
+    
+    def send_json_bytes(self, body, status=200, headers=None, encoding=None):
+        """Send a JSON body, already compressed with encoding if one is given"""
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
     def delete_file(self):
         try:
             filename = unquote(self.path.split("/api/delete/")[1])
@@ -130,6 +1698,7 @@ class FileExchangeHandler(SimpleHTTPRequestHandler):
                 return
             
             os.remove(filepath)
+            FILE_INDEX.remove(filepath.name)
             
             self.send_response(200)
             self.send_header("Content-type", "application/json")
@@ -139,31 +1708,294 @@ class FileExchangeHandler(SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
-    def serve_index(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/html; charset=utf-8")
-        self.send_header("Access-Control-Allow-Origin", "*")
+    def serve_static(self, name):
+        """Send a UI file from memory.
+
+        The variant for the client's Accept-Encoding was compressed when the
+        file was loaded; If-None-Match and If-Modified-Since get a 304, and
+        Cache-Control: no-cache makes browsers revalidate on every visit so
+        an updated interface is picked up at once.
+        """
+        asset = self.static.get(name)
+        if asset is None:
+            self.send_error(404, f"File {name} not found")
+            return
+        
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if asset.variants else None
+        body = asset.variants.get(encoding, asset.body)
+        etag = f'{asset.etag[:-1]}-{encoding}"' if encoding in asset.variants else asset.etag
+        last_modified = self.date_time_string(asset.mtime)
+        
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+        else:
+            try:
+                since = parsedate_to_datetime(self.headers.get('If-Modified-Since'))
+                not_modified = asset.mtime <= since.timestamp()
+            except (TypeError, ValueError, IndexError):
+                not_modified = False
+        
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if not not_modified:
+            self.send_header("Content-type", asset.content_type)
+            self.send_header("Content-Length", len(body))
+            if encoding in asset.variants:
+                self.send_header("Content-Encoding", encoding)
         self.end_headers()
-        with open("index.html", 'rb') as f:
-            self.wfile.write(f.read())
+        if not not_modified and self.command != 'HEAD':
+            self.wfile.write(body)
     
     def end_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Filename")
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, POST, PUT, DELETE, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Filename, Range, If-Range, If-None-Match, Last-Event-ID")
+        self.send_header("Access-Control-Expose-Headers", "Content-Range, Accept-Ranges, ETag, Content-Length, Content-Encoding")
         super().end_headers()
     
     def do_OPTIONS(self):
         self.send_response(200)
         self.end_headers()
     
+    def response_encoding(self, size):
+        """Content coding for a response body of size bytes, None to send it as is"""
+        if size < COMPRESS_MIN_SIZE:
+            return None
+        return negotiate_encoding(self.headers.get('Accept-Encoding'))
+    
+    def setup(self):
+        super().setup()
+        self.bytes_in = self.bytes_out = 0
+        self.rfile = CountingReader(self.rfile, self)
+        self.wfile = CountingWriter(self.wfile, self)
+        METRICS.add("fx_open_connections")
+    
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            METRICS.add("fx_open_connections", value=-1)
+    
+    def handle_one_request(self):
+        """Handle one request and record its metrics and access log line"""
+        self.requestline = ""
+        self.status_code = None
+        self.route = None
+        self.transfer = None
+        self.bytes_in = self.bytes_out = 0
+        REQUEST_SPANS.totals = {} if METRICS.spans_enabled else None
+        started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            if self.transfer:
+                METRICS.add("fx_transfers_in_flight", (("direction", self.transfer),), -1)
+            if self.requestline:
+                self.record_request(time.perf_counter() - started)
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.route = route_of(self.path)
+        if self.route in UPLOAD_ROUTES and self.command in ('POST', 'PUT'):
+            self.transfer = "upload"
+        elif self.route in DOWNLOAD_ROUTES and self.command == 'GET':
+            self.transfer = "download"
+        if self.transfer:
+            METRICS.add("fx_transfers_in_flight", (("direction", self.transfer),))
+        return True
+    
+    def record_request(self, elapsed):
+        route = self.route or "other"
+        METRICS.inc("fx_requests_total", (("route", route), ("method", self.command or ""),
+                                          ("status", str(self.status_code or 0))))
+        METRICS.observe("fx_request_duration_seconds", (("route", route),), elapsed)
+        METRICS.inc("fx_received_bytes_total", (("route", route),), self.bytes_in)
+        METRICS.inc("fx_sent_bytes_total", (("route", route),), self.bytes_out)
+        
+        line = (f'{self.address_string()} "{self.requestline}" {self.status_code or "-"} '
+                f'{self.bytes_out} {elapsed * 1000:.1f}ms')
+        totals = REQUEST_SPANS.totals
+        if totals:
+            line += " " + " ".join(f"{name}={t * 1000:.1f}ms" for name, t in sorted(totals.items()))
+        self.log_message("%s", line)
+    
+    def log_request(self, code='-', size='-'):
+        # The access log line is written once the request is done, see record_request
+        self.status_code = getattr(code, "value", code)
+    
+    def serve_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+    
     def log_message(self, format, *args):
-        print(f"[{self.log_date_time_string()}] {format % args}")
+        line = f"[{self.log_date_time_string()}] {format % args}"
+        if self.access_log is None:
+            print(line)
+        else:
+            self.access_log.write(line)
+
+METRICS.register(FileExchangeHandler.storage_metrics)
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP server that handles connections on a bounded pool of worker threads"""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=32,
+                 max_connections=256, max_per_client=32):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.max_connections = max_connections
+        self.max_per_client = max_per_client
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http-worker")
+        self.connections_lock = threading.Lock()
+        self.active_connections = 0
+        self.client_connections = {}  # client ip -> open connections
+
+    def admit(self, client_address):
+        """Reserve a connection slot, False if a limit is reached"""
+        ip = client_address[0]
+        with self.connections_lock:
+            if self.active_connections >= self.max_connections:
+                return False
+            if self.client_connections.get(ip, 0) >= self.max_per_client:
+                return False
+            self.active_connections += 1
+            self.client_connections[ip] = self.client_connections.get(ip, 0) + 1
+            return True
+
+    def release(self, client_address):
+        ip = client_address[0]
+        with self.connections_lock:
+            self.active_connections -= 1
+            count = self.client_connections.get(ip, 0) - 1
+            if count > 0:
+                self.client_connections[ip] = count
+            else:
+                self.client_connections.pop(ip, None)
+
+    def reject(self, request):
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Retry-After: 1\r\nContent-Length: 0\r\n"
+                            b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.admit(client_address):
+            self.reject(request)
+            return
+        self.pool.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.release(client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class AsyncioHTTPServer(ThreadPoolHTTPServer):
+    """Accepts connections on an asyncio event loop and hands them to the worker pool"""
+
+    def serve_forever(self, poll_interval=0.5):
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.stopping = asyncio.Event()
+        self.socket.setblocking(False)
+        accept_task = None
+        while not self.stopping.is_set():
+            accept_task = loop.create_task(loop.sock_accept(self.socket))
+            stop_task = loop.create_task(self.stopping.wait())
+            done, _ = await asyncio.wait({accept_task, stop_task},
+                                         return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+            if accept_task not in done:
+                accept_task.cancel()
+                break
+            request, client_address = accept_task.result()
+            request.setblocking(True)
+            if not self.admit(client_address):
+                self.reject(request)
+                continue
+            loop.run_in_executor(self.pool, self.process_request_worker,
+                                 request, client_address)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+
+def create_server(server_address, handler_class, mode="threaded", workers=32,
+                  max_connections=256, max_per_client=32):
+    """Create the HTTP server for the selected concurrency mode"""
+    if mode == "single":
+        return HTTPServer(server_address, handler_class)
+    server_class = AsyncioHTTPServer if mode == "asyncio" else ThreadPoolHTTPServer
+    return server_class(server_address, handler_class, workers=workers,
+                        max_connections=max_connections, max_per_client=max_per_client)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="File Exchanger server")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--mode", choices=["threaded", "asyncio", "single"], default="threaded",
+                        help="concurrency model of the server core")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="worker threads handling requests")
+    parser.add_argument("--max-connections", type=int, default=256,
+                        help="open connections before new ones get 503")
+    parser.add_argument("--max-per-client", type=int, default=32,
+                        help="open connections allowed from one client IP")
+    parser.add_argument("--max-upload-mb", type=int, default=MAX_UPLOAD_SIZE // 1024 ** 2,
+                        help="maximum size of one uploaded file")
+    parser.add_argument("--compression-cache-mb", type=int, default=COMPRESSION_CACHE_SIZE // 1024 ** 2,
+                        help="disk space for cached compressed downloads, 0 disables the cache")
+    parser.add_argument("--preview-workers", type=int, default=1,
+                        help="processes building image thumbnails and text previews, 0 disables previews")
+    parser.add_argument("--preview-cache-mb", type=int, default=PREVIEW_CACHE_SIZE // 1024 ** 2,
+                        help="disk space for cached previews")
+    parser.add_argument("--access-log", default="access.log",
+                        help='access log file, "-" for stdout, "off" to disable')
+    parser.add_argument("--trace-spans", action="store_true",
+                        help="time directory scans, hashing and disk I/O per request")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    PORT = 8888
+    args = parse_args()
+    PORT = args.port
+    MAX_UPLOAD_SIZE = args.max_upload_mb * 1024 ** 2
+    # Event streams may take up to half of the workers, none in single mode
+    FileExchangeHandler.event_slots = threading.Semaphore(0 if args.mode == "single" else max(1, args.workers // 2))
     server_address = ("0.0.0.0", PORT)
-    httpd = HTTPServer(server_address, FileExchangeHandler)
+    FileExchangeHandler.access_log = AccessLog(None if args.access_log == "off" else args.access_log)
+    METRICS.spans_enabled = args.trace_spans
+    if args.compression_cache_mb > 0:
+        FileExchangeHandler.compression_cache = CompressionCache(max_size=args.compression_cache_mb * 1024 ** 2)
+    if args.preview_workers > 0:
+        FileExchangeHandler.previews = PreviewService(PreviewCache(max_size=args.preview_cache_mb * 1024 ** 2),
+                                                      args.preview_workers)
+    httpd = create_server(server_address, FileExchangeHandler, mode=args.mode,
+                          workers=args.workers, max_connections=args.max_connections,
+                          max_per_client=args.max_per_client)
     
     local_ip = get_local_ip()
     
@@ -175,11 +2007,20 @@ if __name__ == "__main__":
     print(f"  → http://{local_ip}:{PORT}")
     print(f"  → http://localhost:{PORT} (local access)")
     print(f"\nShared files folder: {UPLOAD_FOLDER.absolute()}")
+    print(f"Mode: {args.mode}, workers: {args.workers}")
+    print(f"Compression: {', '.join(ENCODINGS)}")
+    print(f"Access log: {args.access_log}, metrics: /api/metrics")
+    if args.preview_workers > 0:
+        print(f"Previews: {args.preview_workers} processes, thumbnails " +
+              ("on" if Image else "off (pip install Pillow)"))
     print(f"\nPress Ctrl+C to stop the server")
     print("="*50 + "\n")
     
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
+        FileExchangeHandler.access_log.close()
+        if FileExchangeHandler.previews:
+            FileExchangeHandler.previews.close()
         print("\n\n✗ Server stopped")
         sys.exit(0)
@@ -0,0 +1,35 @@
+"""Shared helpers for the tests: load a server as a module, reach the bench helpers."""
+import atexit
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "bench"))
+
+SERVERS = {"web": ROOT / "web" / "server.py", "server": ROOT / "server" / "server.py"}
+_modules = {}
+
+
+def load_server(which):
+    """Import web/server.py or server/server.py without starting it.
+
+    Importing creates the data folders in the working directory, so it is
+    done from a temporary one.
+    """
+    if which not in _modules:
+        cwd = os.getcwd()
+        workdir = tempfile.mkdtemp(prefix=f"fx-test-{which}-")
+        atexit.register(shutil.rmtree, workdir, True)
+        os.chdir(workdir)
+        try:
+            spec = importlib.util.spec_from_file_location(f"fx_{which}_server", SERVERS[which])
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            os.chdir(cwd)
+        _modules[which] = module
+    return _modules[which]
@@ -0,0 +1,153 @@
+"""Batch uploads of the rooms server: multipart and TAR bodies, per-file results, failures."""
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from support import load_server
+
+from batch_upload import BOUNDARY, multipart_body, tar_body
+from common import ServerProcess, create_room, request, room_folder, room_headers
+
+server = load_server("web")
+
+
+class BatchWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix="fx-test-batch-")
+        self.folder = Path(self.tmp.name)
+        self.writer = server.BatchWriter(self.folder)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self):
+        return sorted(p.name for p in self.folder.iterdir())
+
+    def test_flush_publishes_pending(self):
+        self.assertEqual(self.writer.add("a.txt", [b"aa", b"a"]), 3)
+        self.writer.add("b.txt", [b"b"])
+        self.assertEqual(len(self.writer.pending), 2)
+        self.assertEqual(self.writer.flush(), [self.folder / "a.txt", self.folder / "b.txt"])
+        self.assertEqual(self.names(), ["a.txt", "b.txt"])
+        self.assertEqual((self.folder / "a.txt").read_bytes(), b"aaa")
+        self.assertEqual((self.writer.pending, self.writer.pending_bytes), ([], 0))
+
+    def test_group_is_flushed_on_its_own(self):
+        with mock.patch.object(server, "BATCH_SYNC_FILES", 2):
+            for name in ("a", "b", "c"):
+                self.writer.add(name, [b"x"])
+        self.assertEqual(self.writer.published, [self.folder / "a", self.folder / "b"])
+        self.assertEqual(len(self.writer.pending), 1)
+
+    def test_failed_write_leaves_no_temp_file(self):
+        def chunks():
+            yield b"partial"
+            raise ConnectionResetError()
+        with self.assertRaises(ConnectionResetError):
+            self.writer.add("broken.txt", chunks())
+        self.assertEqual(self.names(), [])
+        self.assertEqual(self.writer.pending, [])
+
+    def test_partial_flush_and_discard(self):
+        for name in ("a", "b", "c"):
+            self.writer.add(name, [name.encode()])
+        replace = os.replace
+        calls = []
+
+        def failing_replace(src, dst):
+            calls.append(dst)
+            if len(calls) == 2:
+                raise OSError("disk gone")
+            replace(src, dst)
+
+        with mock.patch.object(server.os, "replace", failing_replace):
+            with self.assertRaises(OSError):
+                self.writer.flush()
+        self.assertEqual(self.writer.published, [self.folder / "a"])
+        self.assertEqual([target for _, target, _ in self.writer.pending], [self.folder / "b", self.folder / "c"])
+        self.writer.discard()
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(self.writer.pending, [])
+
+
+class BatchUploadTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess("web").start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.room = create_room(self.server.port)
+        self.folder = room_folder(self.server.workdir, self.room["room_id"])
+
+    def post(self, body, content_type):
+        status, _, data = request(self.server.port, "POST", f"/api/room/{self.room['room_id']}/upload-batch",
+                                  body=body, headers=dict(room_headers(self.room), **{"Content-Type": content_type}))
+        return status, json.loads(data)
+
+    def listed(self):
+        status, _, data = request(self.server.port, "GET", f"/api/room/{self.room['room_id']}/files",
+                                  headers=room_headers(self.room))
+        self.assertEqual(status, 200)
+        return sorted(f["name"] for f in json.loads(data))
+
+    def leftovers(self):
+        return [p.name for p in self.folder.iterdir() if p.name.startswith(server.UPLOAD_PREFIX)]
+
+    def test_multipart(self):
+        files = [("one.txt", b"1"), ("dir/two.txt", b"22"), ("one.txt", b"again"), ("..", b"bad")]
+        status, result = self.post(multipart_body(files), f"multipart/form-data; boundary={BOUNDARY}")
+        self.assertEqual(status, 200)
+        self.assertEqual((result["uploaded"], result["failed"]), (3, 1))
+        self.assertEqual([r.get("filename") for r in result["files"]], ["one.txt", "two.txt", "one (2).txt", None])
+        self.assertIn("error", result["files"][3])
+        self.assertEqual((self.folder / "one (2).txt").read_bytes(), b"again")
+        self.assertEqual(self.listed(), ["one (2).txt", "one.txt", "two.txt"])
+
+    def test_tar(self):
+        files = [(f"folder/f{i}.bin", os.urandom(1000 + i)) for i in range(5)]
+        for content_type, body in (("application/x-tar", tar_body(files)),
+                                   ("application/gzip", gzip.compress(tar_body(files)))):
+            with self.subTest(content_type=content_type):
+                self.setUp()
+                status, result = self.post(body, content_type)
+                self.assertEqual((status, result["uploaded"]), (200, len(files)))
+                self.assertEqual([r["size"] for r in result["files"]], [len(data) for _, data in files])
+                for name, data in files:
+                    self.assertEqual((self.folder / os.path.basename(name)).read_bytes(), data)
+
+    def test_unsupported_type(self):
+        status, _ = self.post(b"plain", "text/plain")
+        self.assertEqual(status, 415)
+        self.assertEqual(self.listed(), [])
+
+    def test_broken_body_keeps_complete_files(self):
+        body = multipart_body([("good.txt", b"good")])
+        broken = body[:-len(f"--{BOUNDARY}--\r\n")] + (
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="files"; filename="cut.txt"\r\n\r\n'
+            'no closing boundary').encode()
+        status, result = self.post(broken, f"multipart/form-data; boundary={BOUNDARY}")
+        self.assertEqual(status, 400)
+        self.assertEqual(result["files"][0]["filename"], "good.txt")
+        self.assertEqual(self.listed(), ["good.txt"])
+        self.assertEqual(self.leftovers(), [])
+
+    def test_broken_tar_keeps_complete_files(self):
+        body = tar_body([("first.txt", b"first"), ("second.txt", os.urandom(5000))])
+        status, result = self.post(body[:2048], "application/x-tar")
+        self.assertEqual(status, 400)
+        self.assertEqual(self.listed(), ["first.txt"])
+        self.assertEqual(self.leftovers(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+"""Content-addressed blob store of the rooms server (--dedup)."""
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from support import load_server
+
+from common import ServerProcess, create_room, request, room_folder, room_headers
+
+server = load_server("web")
+
+
+class BlobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix="fx-test-blobs-")
+        root = Path(self.tmp.name)
+        self.store = server.BlobStore(root / ".blobs")
+        self.room_a, self.room_b = root / "a", root / "b"
+        self.room_a.mkdir()
+        self.room_b.mkdir()
+
+    def tearDown(self):
+        if self.store.lock_file:
+            self.store.lock_file.close()
+        self.tmp.cleanup()
+
+    def add(self, folder, name, data):
+        tmp_path = folder / f"{server.UPLOAD_PREFIX}{name}"
+        tmp_path.write_bytes(data)
+        return self.store.intern(tmp_path, hashlib.sha256(data).hexdigest(), folder / name)
+
+    def test_intern_shares_content(self):
+        data = b"same content" * 100
+        self.assertFalse(self.add(self.room_a, "one.txt", data))
+        self.assertTrue(self.add(self.room_b, "two.txt", data))
+        blob = self.store.blob_path(hashlib.sha256(data).hexdigest())
+        self.assertEqual(blob.read_bytes(), data)
+        self.assertTrue(os.path.samefile(blob, self.room_a / "one.txt"))
+        self.assertTrue(os.path.samefile(blob, self.room_b / "two.txt"))
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+        self.assertEqual(sorted(p.name for p in self.room_a.iterdir()), ["one.txt"])
+
+    def test_link_within_room(self):
+        data = b"report"
+        digest = hashlib.sha256(data).hexdigest()
+        self.add(self.room_a, "report.txt", data)
+        self.assertTrue(self.store.link(digest, len(data), self.room_a / "copy.txt"))
+        self.assertEqual((self.room_a / "copy.txt").read_bytes(), data)
+
+    def test_link_refuses_other_rooms_blob(self):
+        data = b"secret of room a"
+        digest = hashlib.sha256(data).hexdigest()
+        self.add(self.room_a, "secret.txt", data)
+        self.assertFalse(self.store.link(digest, len(data), self.room_b / "stolen.txt"))
+        self.assertFalse((self.room_b / "stolen.txt").exists())
+        self.assertEqual(list(self.room_b.iterdir()), [])
+
+    def test_link_unknown(self):
+        data = b"known"
+        self.add(self.room_a, "known.txt", data)
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertFalse(self.store.link(digest, len(data) + 1, self.room_a / "x.txt"))
+        self.assertFalse(self.store.link("0" * 64, len(data), self.room_a / "x.txt"))
+        self.assertFalse(self.store.link("../" + digest[3:], len(data), self.room_a / "x.txt"))
+        self.assertFalse((self.room_a / "x.txt").exists())
+
+    def test_release_when_last_link_goes(self):
+        data = b"shared" * 10
+        blob = self.store.blob_path(hashlib.sha256(data).hexdigest())
+        self.add(self.room_a, "f.txt", data)
+        self.add(self.room_b, "f.txt", data)
+        for folder in (self.room_a, self.room_b):
+            st = os.stat(folder / "f.txt")
+            os.remove(folder / "f.txt")
+            self.store.release(st)
+            self.assertEqual(blob.exists(), folder is self.room_a)
+
+    def test_collect(self):
+        kept, dropped = b"kept", b"dropped!"
+        self.add(self.room_a, "kept.txt", kept)
+        self.add(self.room_a, "dropped.txt", dropped)
+        # Removed behind the server's back, without release()
+        os.remove(self.room_a / "dropped.txt")
+        self.assertEqual(self.store.collect(), (1, len(dropped)))
+        self.assertFalse(self.store.blob_path(hashlib.sha256(dropped).hexdigest()).exists())
+        self.assertTrue(self.store.blob_path(hashlib.sha256(kept).hexdigest()).exists())
+        self.assertEqual(self.store.collect(), (0, 0))
+
+
+class UploadByHashTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess("web", ["--dedup"]).start()
+        cls.room = create_room(cls.server.port)
+        cls.other = create_room(cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def upload(self, room, name, data):
+        status, _, _ = request(self.server.port, "POST", f"/api/room/{room['room_id']}/upload", body=data,
+                               headers=dict(room_headers(room), **{"X-Filename": name}))
+        self.assertEqual(status, 200)
+
+    def by_hash(self, room, name, data):
+        body = json.dumps({"filename": name, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+        return request(self.server.port, "POST", f"/api/room/{room['room_id']}/upload-by-hash",
+                       body=body, headers=dict(room_headers(room), **{"Content-Type": "application/json"}))[0]
+
+    def test_same_room(self):
+        data = os.urandom(5000)
+        self.upload(self.room, "original.bin", data)
+        self.assertEqual(self.by_hash(self.room, "again.bin", data), 200)
+        folder = room_folder(self.server.workdir, self.room["room_id"])
+        self.assertTrue(os.path.samefile(folder / "original.bin", folder / "again.bin"))
+
+    def test_other_room_cannot_claim(self):
+        data = os.urandom(5000)
+        self.upload(self.room, "private.bin", data)
+        self.assertEqual(self.by_hash(self.other, "private.bin", data), 404)
+        status, _, _ = request(self.server.port, "GET",
+                               f"/api/room/{self.other['room_id']}/download/private.bin",
+                               headers=room_headers(self.other))
+        self.assertEqual(status, 404)
+        # Uploading the content for real still shares the blob on disk
+        self.upload(self.other, "private.bin", data)
+        self.assertTrue(os.path.samefile(room_folder(self.server.workdir, self.room["room_id"]) / "private.bin",
+                                         room_folder(self.server.workdir, self.other["room_id"]) / "private.bin"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Delta sync: the signature, make_delta and apply_delta of the rooms server."""
+import io
+import random
+import tempfile
+import unittest
+
+from support import load_server
+
+server = load_server("web")
+
+
+class DeltaTests(unittest.TestCase):
+    size = 300 * 1024 + 777  # the last block is shorter than the others
+
+    def setUp(self):
+        self.random = random.Random(20)
+        self.base = self.random.randbytes(self.size)
+        self.block_size = server.delta_block_size(self.size)
+
+    def signature(self, data):
+        weak, strong = server.block_signature(io.BytesIO(data), self.block_size)
+        signature = {"size": len(data), "block_size": self.block_size, "weak": weak, "strong": strong}
+        server.check_signature(signature)
+        return signature
+
+    def sync(self, new, base=None):
+        """Delta from base to new, checked to rebuild new; returns (delta, stats)"""
+        base = self.base if base is None else base
+        stats = {}
+        delta = b"".join(server.make_delta(io.BytesIO(new), self.signature(base), stats))
+        self.assertEqual(stats["copied"] + stats["literal"], len(new))
+        self.assertEqual(self.apply(delta, base), new)
+        return delta, stats
+
+    def apply(self, delta, base, limit=2 ** 40):
+        with tempfile.TemporaryFile() as f:
+            f.write(base)
+            f.flush()
+            return b"".join(server.apply_delta([delta], f, self.block_size, limit))
+
+    def assertDeltaSize(self, delta, changed, edits=1):
+        # Every edit can spoil the block it starts in and the one it ends in and
+        # adds a few records; the short last block is a COPY of its own and END
+        # carries the checksum
+        overhead = (8 * edits + 3) * server.DELTA_HEADER.size + 32
+        self.assertLessEqual(len(delta), changed + 2 * edits * self.block_size + overhead)
+
+    def test_unchanged(self):
+        delta, stats = self.sync(self.base)
+        self.assertEqual(stats["literal"], 0)
+        self.assertDeltaSize(delta, 0, edits=0)
+
+    def test_in_place_edit(self):
+        new = bytearray(self.base)
+        new[100001:100101] = self.random.randbytes(100)
+        delta, _ = self.sync(bytes(new))
+        self.assertDeltaSize(delta, 100)
+
+    def test_insertion(self):
+        inserted = self.random.randbytes(1000)
+        new = self.base[:50001] + inserted + self.base[50001:]
+        delta, stats = self.sync(new)
+        self.assertDeltaSize(delta, len(inserted))
+        # Blocks after the insertion are found again at their shifted offsets
+        self.assertGreaterEqual(stats["copied"], self.size - 2 * self.block_size)
+
+    def test_deletion(self):
+        new = self.base[:70000] + self.base[72000:]
+        delta, _ = self.sync(new)
+        self.assertDeltaSize(delta, 0)
+
+    def test_several_edits(self):
+        new = bytearray(self.base)
+        for offset in (5000, 150000, 250000):
+            new[offset:offset + 10] = self.random.randbytes(10)
+        delta, _ = self.sync(bytes(new))
+        self.assertDeltaSize(delta, 30, edits=3)
+
+    def test_short_last_block_is_copied(self):
+        self.assertNotEqual(self.size % self.block_size, 0)
+        new = b"prefix" + self.base
+        delta, stats = self.sync(new)
+        self.assertDeltaSize(delta, 6)
+        self.assertEqual(stats["literal"], 6)
+
+    def test_new_last_block_shorter(self):
+        new = self.base[:-300]
+        delta, _ = self.sync(new)
+        self.assertDeltaSize(delta, 0)
+
+    def test_empty_base(self):
+        new = self.random.randbytes(10000)
+        delta, stats = self.sync(new, base=b"")
+        self.assertEqual(stats["literal"], len(new))
+
+    def test_corrupt_delta(self):
+        delta, _ = self.sync(self.base[:1000] + b"x" + self.base[1000:])
+        with self.assertRaises(ValueError):
+            self.apply(delta[:-1] + bytes([delta[-1] ^ 1]), self.base)
+        with self.assertRaises(ValueError):
+            self.apply(delta[:-40], self.base)
+        with self.assertRaises(ValueError):
+            self.apply(server.delta_record(server.DELTA_COPY, len(self.base), 1), self.base)
+
+    def test_limit(self):
+        delta, _ = self.sync(self.base)
+        with self.assertRaises(server.UploadTooLarge):
+            self.apply(delta, self.base, limit=self.size - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Lifetimes of rooms and files, enforced by the janitor of the rooms server."""
+import json
+import time
+import unittest
+
+import support  # noqa: F401, puts bench/ on the path
+
+from common import ServerProcess, request, room_folder
+
+SECOND = 1 / 3600  # in the hours the API takes
+
+
+class JanitorTests(unittest.TestCase):
+    # Rooms and files expire after a second unless they set their own lifetime
+    args = ["--room-ttl-hours", str(SECOND), "--janitor-interval", "0.2"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess("web", cls.args).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def create(self, **lifetimes):
+        status, _, data = request(self.server.port, "POST", "/api/create-room",
+                                  body=json.dumps(dict(lifetimes, password="testpass")),
+                                  headers={"Content-Type": "application/json"})
+        self.assertEqual(status, 200)
+        room = json.loads(data)
+        room["folder"] = room_folder(self.server.workdir, room["room_id"])
+        return room
+
+    def files(self, room):
+        status, _, data = request(self.server.port, "GET", f"/api/room/{room['room_id']}/files",
+                                  headers={"X-Session-Token": room["token"]})
+        return sorted(f["name"] for f in json.loads(data)) if status == 200 else status
+
+    def joins(self, room):
+        status, _, _ = request(self.server.port, "POST", "/api/join-room",
+                               body=json.dumps({"room_id": room["room_id"], "password": "testpass"}),
+                               headers={"Content-Type": "application/json"})
+        return status == 200
+
+    def upload(self, room, name, ttl=None):
+        headers = {"X-Session-Token": room["token"], "X-Filename": name}
+        if ttl is not None:
+            headers["X-File-TTL"] = str(ttl)
+        status, _, _ = request(self.server.port, "POST", f"/api/room/{room['room_id']}/upload",
+                               body=name.encode(), headers=headers)
+        self.assertEqual(status, 200)
+
+    def wait_for(self, condition, timeout=15, keep_alive=()):
+        """Poll until condition() holds, opening the keep_alive rooms meanwhile"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for room in keep_alive:
+                self.assertNotEqual(self.files(room), 404)
+            if condition():
+                return
+            time.sleep(0.2)
+        self.fail("timed out")
+
+    def test_unaccessed_room_expires(self):
+        room = self.create()
+        self.upload(room, "gone.txt")
+        self.wait_for(lambda: not room["folder"].exists())
+        self.assertFalse(self.joins(room))
+        self.assertEqual(self.files(room), 404)
+
+    def test_accessed_room_is_kept(self):
+        idle, busy = self.create(), self.create()
+        self.upload(busy, "kept.txt")
+        self.wait_for(lambda: not idle["folder"].exists(), keep_alive=[busy])
+        self.assertEqual(self.files(busy), ["kept.txt"])
+        self.assertTrue(self.joins(busy))
+
+    def test_room_ttl(self):
+        default, forever, day = self.create(), self.create(ttl_hours=0), self.create(ttl_hours=24)
+        self.wait_for(lambda: not default["folder"].exists())
+        time.sleep(1)
+        for room in (forever, day):
+            self.assertTrue(self.joins(room))
+
+    def test_file_ttl(self):
+        room = self.create(ttl_hours=0)
+        self.upload(room, "short.txt", ttl=1)
+        self.upload(room, "forever.txt")
+        self.upload(room, "replaced.txt", ttl=1)
+        # Uploaded again without a lifetime: the new file is not the one scheduled
+        time.sleep(0.05)
+        self.upload(room, "replaced.txt", ttl=0)
+        self.wait_for(lambda: self.files(room) == ["forever.txt", "replaced.txt"])
+        self.assertFalse((room["folder"] / "short.txt").exists())
+        time.sleep(1)
+        self.assertEqual(self.files(room), ["forever.txt", "replaced.txt"])
+
+    def test_room_file_ttl(self):
+        room = self.create(ttl_hours=0, file_ttl_hours=SECOND)
+        self.upload(room, "default.txt")
+        self.upload(room, "kept.txt", ttl=0)
+        self.wait_for(lambda: self.files(room) == ["kept.txt"])
+
+
+if __name__ == "__main__":
+    unittest.main()
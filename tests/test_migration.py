@@ -0,0 +1,113 @@
+"""Migration of rooms from the flat servers_data/{ID}/ layout into the sharded layout and registry."""
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from support import SERVERS, load_server
+
+from common import ServerProcess, request
+
+server = load_server("web")
+
+# Rooms as earlier versions left them: the original one kept an unsalted
+# SHA-256, later ones a PBKDF2 record and sometimes their own upload limit
+ROOMS = {
+    "A1B2C3": {"password": "first-pass", "files": {"notes.txt": b"notes", "photo.jpg": os.urandom(3000)}},
+    "D4E5F6": {"password": "second-pass", "files": {"report.pdf": os.urandom(5000)}, "pbkdf2": True,
+               "max_upload_size": 5 * 1024 ** 2},
+    "0F0F0F": {"password": "third-pass", "files": {}},
+}
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix="fx-test-migrate-")
+        self.workdir = Path(self.tmp.name)
+        servers_data = self.workdir / "servers_data"
+        for room_id, room in ROOMS.items():
+            folder = servers_data / room_id
+            folder.mkdir(parents=True)
+            if room.get("pbkdf2"):
+                info = {"room_id": room_id, "password": server.hash_password(room["password"]), "created": True,
+                        "max_upload_size": room["max_upload_size"]}
+            else:
+                info = {"room_id": room_id, "created": True,
+                        "password_hash": hashlib.sha256(room["password"].encode()).hexdigest()}
+            (folder / ".room_info").write_text(json.dumps(info))
+            for name, data in room["files"].items():
+                (folder / name).write_bytes(data)
+        # Not a room: no .room_info
+        (servers_data / "stray").mkdir()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def migrate(self):
+        return subprocess.run([sys.executable, str(SERVERS["web"]), "--migrate"], cwd=self.workdir,
+                              capture_output=True, text=True, timeout=60,
+                              env=dict(os.environ, PYTHONIOENCODING="utf-8"))
+
+    def check_rooms(self, port):
+        for room_id, room in ROOMS.items():
+            with self.subTest(room=room_id):
+                status, _, data = request(port, "POST", "/api/join-room", headers={"Content-Type": "application/json"},
+                                          body=json.dumps({"room_id": room_id, "password": room["password"]}))
+                self.assertEqual(status, 200)
+                token = json.loads(data)["token"]
+                headers = {"X-Session-Token": token}
+                status, _, data = request(port, "GET", f"/api/room/{room_id}/files", headers=headers)
+                self.assertEqual(status, 200)
+                self.assertEqual(sorted(f["name"] for f in json.loads(data)), sorted(room["files"]))
+                for name, content in room["files"].items():
+                    self.assertEqual(request(port, "GET", f"/api/room/{room_id}/download/{name}",
+                                             headers=headers)[2], content)
+                status, _, _ = request(port, "POST", "/api/join-room", headers={"Content-Type": "application/json"},
+                                       body=json.dumps({"room_id": room_id, "password": "wrong-pass"}))
+                self.assertNotEqual(status, 200)
+
+    def test_migrate_command(self):
+        result = self.migrate()
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn(f"Migrated {len(ROOMS)} rooms", result.stdout)
+        servers_data = self.workdir / "servers_data"
+        for room_id, room in ROOMS.items():
+            self.assertFalse((servers_data / room_id).exists())
+            folder = servers_data / "rooms" / room_id[:2] / room_id
+            self.assertEqual(sorted(p.name for p in folder.iterdir()), sorted(room["files"]))
+        self.assertTrue((servers_data / "stray").is_dir())
+        with sqlite3.connect(servers_data / "rooms.db") as db:
+            rows = dict(db.execute("SELECT room_id, max_upload_size FROM rooms"))
+        self.assertEqual(rows, {room_id: room.get("max_upload_size") for room_id, room in ROOMS.items()})
+        # Running it again finds nothing left to move
+        self.assertIn("Migrated 0 rooms", self.migrate().stdout)
+        with ServerProcess("web", workdir=self.workdir) as running:
+            self.check_rooms(running.port)
+
+    def test_migrate_on_startup(self):
+        with ServerProcess("web", workdir=self.workdir) as running:
+            self.check_rooms(running.port)
+        self.assertFalse(any((self.workdir / "servers_data" / room_id).exists() for room_id in ROOMS))
+
+    def test_interrupted_migration(self):
+        # Rows written but one folder never moved: the next run finishes the move
+        servers_data = self.workdir / "servers_data"
+        registry = server.RoomRegistry(servers_data / "rooms.db")
+        try:
+            registry.add([("A1B2C3", {"algorithm": "sha256",
+                                      "hash": hashlib.sha256(b"first-pass").hexdigest()}, None, 2, None, None)])
+        finally:
+            registry.close()
+        self.assertEqual(self.migrate().returncode, 0)
+        with ServerProcess("web", workdir=self.workdir) as running:
+            self.check_rooms(running.port)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Range requests on downloads, for both the LAN and the rooms server."""
+import os
+import threading
+import unittest
+from pathlib import Path
+from urllib.parse import quote
+
+from support import load_server
+
+from common import ServerProcess, create_room, request, room_folder, room_headers
+from ranged_fetch import parse_multipart
+
+FILENAME = "data file.bin"
+SIZE = 256 * 1024 + 123  # not a multiple of the segment count
+
+
+class ParseRangeMixin:
+    which = None
+
+    def setUp(self):
+        self.parse_range = load_server(self.which).parse_range
+
+    def test_single(self):
+        self.assertEqual(self.parse_range("bytes=0-9", 100), [(0, 9)])
+
+    def test_end_past_size_is_clamped(self):
+        self.assertEqual(self.parse_range("bytes=90-500", 100), [(90, 99)])
+
+    def test_suffix(self):
+        self.assertEqual(self.parse_range("bytes=-5", 100), [(95, 99)])
+        self.assertEqual(self.parse_range("bytes=-500", 100), [(0, 99)])
+
+    def test_open_ended(self):
+        self.assertEqual(self.parse_range("bytes=10-", 100), [(10, 99)])
+
+    def test_multiple(self):
+        self.assertEqual(self.parse_range("bytes=0-1, 5-6,-2", 100), [(0, 1), (5, 6), (98, 99)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(self.parse_range("bytes=100-", 100), [])
+        self.assertEqual(self.parse_range("bytes=-0", 100), [])
+        # Unsatisfiable ranges are dropped, the rest are still served
+        self.assertEqual(self.parse_range("bytes=200-300,0-0", 100), [(0, 0)])
+
+    def test_invalid(self):
+        for header in (None, "", "items=0-1", "bytes=5-2", "bytes=abc", "bytes=1", "bytes=a-b",
+                       "bytes=" + ",".join(["0-0"] * 33)):
+            with self.subTest(header=header):
+                self.assertIsNone(self.parse_range(header, 100))
+
+
+class WebParseRangeTests(ParseRangeMixin, unittest.TestCase):
+    which = "web"
+
+
+class LanParseRangeTests(ParseRangeMixin, unittest.TestCase):
+    which = "server"
+
+
+class DownloadRangeMixin:
+    which = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess(cls.which).start()
+        cls.headers = {}
+        if cls.which == "web":
+            room = create_room(cls.server.port)
+            folder = room_folder(cls.server.workdir, room["room_id"])
+            cls.path = f"/api/room/{room['room_id']}/download/{quote(FILENAME)}"
+            cls.headers.update(room_headers(room))
+        else:
+            folder = Path(cls.server.workdir, "shared_files")
+            cls.path = f"/api/download/{quote(FILENAME)}"
+        cls.data = os.urandom(SIZE)
+        (folder / FILENAME).write_bytes(cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def get(self, **headers):
+        return request(self.server.port, "GET", self.path, headers=dict(self.headers, **headers))
+
+    def test_full(self):
+        status, headers, body = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(headers.get("Accept-Ranges"), "bytes")
+        self.assertTrue(headers.get("ETag"))
+
+    def test_single(self):
+        status, headers, body = self.get(Range="bytes=100-199")
+        self.assertEqual(status, 206)
+        self.assertEqual(headers.get("Content-Range"), f"bytes 100-199/{SIZE}")
+        self.assertEqual(body, self.data[100:200])
+
+    def test_suffix(self):
+        status, headers, body = self.get(Range="bytes=-50")
+        self.assertEqual(status, 206)
+        self.assertEqual(headers.get("Content-Range"), f"bytes {SIZE - 50}-{SIZE - 1}/{SIZE}")
+        self.assertEqual(body, self.data[-50:])
+
+    def test_open_ended(self):
+        status, headers, body = self.get(Range=f"bytes={SIZE - 1000}-")
+        self.assertEqual(status, 206)
+        self.assertEqual(headers.get("Content-Range"), f"bytes {SIZE - 1000}-{SIZE - 1}/{SIZE}")
+        self.assertEqual(body, self.data[-1000:])
+
+    def test_multiple(self):
+        wanted = [(0, 99), (SIZE - 50, SIZE - 1), (1000, 1999)]
+        status, headers, body = self.get(Range="bytes=" + ",".join(f"{s}-{e}" for s, e in wanted))
+        self.assertEqual(status, 206)
+        self.assertTrue(headers.get("Content-Type", "").startswith("multipart/byteranges"))
+        self.assertEqual(parse_multipart(headers["Content-Type"], body),
+                         [(f"bytes {s}-{e}/{SIZE}", self.data[s:e + 1]) for s, e in wanted])
+
+    def test_unsatisfiable(self):
+        status, headers, _ = self.get(Range=f"bytes={SIZE}-")
+        self.assertEqual(status, 416)
+        self.assertEqual(headers.get("Content-Range"), f"bytes */{SIZE}")
+
+    def test_invalid_sends_full_file(self):
+        status, _, body = self.get(Range="bytes=9-2")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_if_range(self):
+        etag = self.get()[1]["ETag"]
+        status, _, body = self.get(Range="bytes=0-9", **{"If-Range": etag})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[:10])
+        status, _, body = self.get(Range="bytes=0-9", **{"If-Range": '"stale"'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_parallel_segments(self):
+        segments = 8
+        step = -(-SIZE // segments)
+        parts = [None] * segments
+        statuses = [None] * segments
+
+        def fetch(i):
+            start, end = i * step, min((i + 1) * step, SIZE) - 1
+            statuses[i], _, parts[i] = self.get(Range=f"bytes={start}-{end}")
+
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(segments)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(statuses, [206] * segments)
+        self.assertEqual(b"".join(parts), self.data)
+
+
+class WebDownloadRangeTests(DownloadRangeMixin, unittest.TestCase):
+    which = "web"
+
+
+class LanDownloadRangeTests(DownloadRangeMixin, unittest.TestCase):
+    which = "server"
+
+
+if __name__ == "__main__":
+    unittest.main()
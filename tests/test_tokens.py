@@ -0,0 +1,103 @@
+"""Session tokens of the rooms server and the room access built on them."""
+import time
+import unittest
+from pathlib import Path
+from urllib.parse import quote
+
+from support import load_server
+
+from common import ServerProcess, create_room, request, room_headers
+
+server = load_server("web")
+SECRET = b"k" * 32
+
+
+class SessionTokensTests(unittest.TestCase):
+
+    def test_issue_and_validate(self):
+        tokens = server.SessionTokens(SECRET, ttl=60)
+        token, expires = tokens.issue("room1")
+        self.assertAlmostEqual(expires, time.time() + 60, delta=2)
+        self.assertTrue(token.startswith("room1."))
+        self.assertEqual(tokens.validate(token), "room1")
+
+    def test_validate_without_cache(self):
+        # Another process, or the same one after a restart, shares only the secret
+        token, _ = server.SessionTokens(SECRET).issue("room1")
+        self.assertEqual(server.SessionTokens(SECRET).validate(token), "room1")
+        self.assertIsNone(server.SessionTokens(b"x" * 32).validate(token))
+
+    def test_expired(self):
+        tokens = server.SessionTokens(SECRET, ttl=-1)
+        token, _ = tokens.issue("room1")
+        self.assertIsNone(tokens.validate(token))
+        self.assertIsNone(server.SessionTokens(SECRET).validate(token))
+
+    def test_tampered(self):
+        tokens = server.SessionTokens(SECRET)
+        token, _ = tokens.issue("room1")
+        payload, _, signature = token.rpartition(".")
+        other = server.SessionTokens(SECRET)
+        self.assertIsNone(other.validate("room2" + token[len("room1"):]))
+        self.assertIsNone(other.validate(payload + "." + "0" * len(signature)))
+        room, expires, rest = payload.split(".", 2)
+        self.assertIsNone(other.validate(f"{room}.{int(expires) + 3600}.{rest}.{signature}"))
+        for garbage in ("", ".", "room1", "room1.abc.def.ghi"):
+            with self.subTest(token=garbage):
+                self.assertIsNone(other.validate(garbage))
+
+    def test_redact_tokens(self):
+        self.assertEqual(server.redact_tokens("GET /api/room/r/download/a.txt?token=r.1.2.3 HTTP/1.1"),
+                         "GET /api/room/r/download/a.txt?token=*** HTTP/1.1")
+        self.assertEqual(server.redact_tokens("GET /a?x=1&token=r.1.2.3&y=2 HTTP/1.1"),
+                         "GET /a?x=1&token=***&y=2 HTTP/1.1")
+        self.assertEqual(server.redact_tokens("GET /api/limits HTTP/1.1"), "GET /api/limits HTTP/1.1")
+
+
+class RoomAccessTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess("web").start()
+        cls.room = create_room(cls.server.port)
+        cls.other = create_room(cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def files(self, room, headers=None):
+        return request(self.server.port, "GET", f"/api/room/{room['room_id']}/files", headers=headers)[0]
+
+    def test_own_room(self):
+        self.assertEqual(self.files(self.room, room_headers(self.room)), 200)
+
+    def test_wrong_room(self):
+        self.assertEqual(self.files(self.other, room_headers(self.room)), 401)
+
+    def test_without_token(self):
+        self.assertEqual(self.files(self.room), 401)
+        self.assertEqual(self.files(self.room, {"X-Password": "benchpass"}), 401)
+        self.assertEqual(self.files(self.room, {"X-Session-Token": "bad"}), 401)
+
+    def test_token_in_link_is_not_logged(self):
+        room_id, token = self.room["room_id"], self.room["token"]
+        status, _, _ = request(self.server.port, "POST", f"/api/room/{room_id}/upload", body=b"hello",
+                               headers=dict(room_headers(self.room), **{"X-Filename": "link.txt"}))
+        self.assertEqual(status, 200)
+        status, _, body = request(self.server.port, "GET",
+                                  f"/api/room/{room_id}/download/link.txt?token={quote(token)}")
+        self.assertEqual((status, body), (200, b"hello"))
+        log = Path(self.server.workdir, "access.log")
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            text = log.read_text(encoding="utf-8") if log.exists() else ""
+            if "link.txt?token=" in text:
+                break
+            time.sleep(0.05)
+        self.assertIn("/download/link.txt?token=***", text)
+        self.assertNotIn(token, text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Resumable chunked upload sessions, for both the LAN and the rooms server."""
+import http.client
+import json
+import os
+import time
+import unittest
+from pathlib import Path
+
+from support import load_server
+
+from common import ServerProcess, create_room, request, room_folder, room_headers
+
+CHUNK = 256 * 1024  # the smallest chunk size the servers accept
+SIZE = 3 * CHUNK + 12345
+
+
+class UploadSessionMixin:
+    which = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerProcess(cls.which).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.data = os.urandom(SIZE)
+        self.headers = {}
+        if self.which == "web":
+            room = create_room(self.server.port)
+            self.headers = room_headers(room)
+            self.base = f"/api/room/{room['room_id']}"
+            self.folder = room_folder(self.server.workdir, room["room_id"])
+        else:
+            self.base = "/api"
+            self.folder = Path(self.server.workdir, "shared_files")
+
+    def call(self, method, path, body=None, **headers):
+        status, _, data = request(self.server.port, method, self.base + path, body=body,
+                                  headers=dict(self.headers, **headers))
+        try:
+            return status, json.loads(data)
+        except ValueError:
+            return status, None
+
+    def create(self, name):
+        status, info = self.call("POST", "/upload-session", json.dumps(
+            {"filename": name, "size": SIZE, "chunk_size": CHUNK}), **{"Content-Type": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertEqual((info["chunk_size"], info["chunks"], info["received"]), (CHUNK, 4, []))
+        return f"/upload-session/{info['session_id']}"
+
+    def put(self, session, index):
+        return self.call("PUT", f"{session}/{index}", self.data[index * CHUNK:(index + 1) * CHUNK])[0]
+
+    def received(self, session):
+        status, info = self.call("GET", session)
+        self.assertEqual(status, 200)
+        return info["received"]
+
+    def temp_file(self, session):
+        """The file a session assembles its chunks in"""
+        return self.folder / (load_server(self.which).UPLOAD_PREFIX + session.rpartition("/")[2])
+
+    def test_out_of_order(self):
+        session = self.create("reversed.bin")
+        for index in (3, 1, 2, 0):
+            self.assertEqual(self.put(session, index), 200)
+        self.assertEqual(self.received(session), [0, 1, 2, 3])
+        self.assertEqual(self.call("POST", f"{session}/finalize")[0], 200)
+        self.assertEqual((self.folder / "reversed.bin").read_bytes(), self.data)
+        self.assertEqual(self.call("GET", session)[0], 404)
+        self.assertFalse(self.temp_file(session).exists())
+
+    def test_resume_after_disconnect(self):
+        session = self.create("resumed.bin")
+        self.assertEqual(self.put(session, 0), 200)
+        # The connection drops halfway through chunk 1
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=10)
+        conn.putrequest("PUT", f"{self.base}{session}/1")
+        for name, value in dict(self.headers, **{"Content-Length": str(CHUNK)}).items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        conn.send(self.data[CHUNK:CHUNK + CHUNK // 2])
+        conn.close()
+        deadline = time.time() + 10
+        while time.time() < deadline and self.received(session) != [0]:
+            time.sleep(0.05)
+        self.assertEqual(self.received(session), [0])
+        status, info = self.call("POST", f"{session}/finalize")
+        self.assertEqual(status, 409)
+        self.assertEqual(info["missing"], [1, 2, 3])
+        for index in (1, 2, 3):
+            self.assertEqual(self.put(session, index), 200)
+        self.assertEqual(self.call("POST", f"{session}/finalize")[0], 200)
+        self.assertEqual((self.folder / "resumed.bin").read_bytes(), self.data)
+
+    def test_bad_chunks(self):
+        session = self.create("bad.bin")
+        self.assertEqual(self.call("PUT", f"{session}/4", b"x")[0], 400)
+        self.assertEqual(self.call("PUT", f"{session}/0", self.data[:CHUNK - 1])[0], 400)
+        self.assertEqual(self.call("PUT", f"{session}/0", self.data[:CHUNK + 1])[0], 413)
+        self.assertEqual(self.received(session), [])
+        self.assertEqual(self.call("PUT", "/upload-session/unknown/0", b"x")[0], 404)
+
+    def test_abort(self):
+        session = self.create("aborted.bin")
+        self.assertEqual(self.put(session, 2), 200)
+        self.assertTrue(self.temp_file(session).exists())
+        self.assertEqual(self.call("DELETE", session)[0], 200)
+        self.assertEqual(self.call("GET", session)[0], 404)
+        self.assertFalse(self.temp_file(session).exists())
+
+    def test_finalize_failure_discards_session(self):
+        session = self.create("blocked.bin")
+        for index in range(4):
+            self.assertEqual(self.put(session, index), 200)
+        # A folder in the way makes moving the assembled file into place fail
+        (self.folder / "blocked.bin").mkdir()
+        try:
+            self.assertEqual(self.call("POST", f"{session}/finalize")[0], 500)
+            self.assertEqual(self.call("GET", session)[0], 404)
+            self.assertFalse(self.temp_file(session).exists())
+        finally:
+            (self.folder / "blocked.bin").rmdir()
+
+
+class WebUploadSessionTests(UploadSessionMixin, unittest.TestCase):
+    which = "web"
+
+    def test_resume_after_restart(self):
+        session = self.create("restarted.bin")
+        self.assertEqual(self.put(session, 2), 200)
+        # Sessions live in the room registry, so a new server process picks them up
+        with ServerProcess("web", workdir=self.server.workdir) as restarted:
+            port, self.server.port = self.server.port, restarted.port
+            try:
+                self.assertEqual(self.received(session), [2])
+                for index in (0, 1, 3):
+                    self.assertEqual(self.put(session, index), 200)
+                self.assertEqual(self.call("POST", f"{session}/finalize")[0], 200)
+            finally:
+                self.server.port = port
+        self.assertEqual((self.folder / "restarted.bin").read_bytes(), self.data)
+
+
+class LanUploadSessionTests(UploadSessionMixin, unittest.TestCase):
+    which = "server"
+
+
+if __name__ == "__main__":
+    unittest.main()
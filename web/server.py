@@ -1,329 +1,4090 @@
 import os
+import errno
+import stat
 import socket
+import threading
+import asyncio
+import argparse
 import json
 import mimetypes
 import hashlib
+import hmac
 import secrets
+import tempfile
+import time
 from pathlib import Path
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse, unquote, parse_qs
+from urllib.parse import unquote, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+import io
+import re
+import zlib
+import queue
+from contextlib import contextmanager
+import tarfile
+import zipfile
 import sys
+import sqlite3
+import shutil
+import signal
+import math
+import struct
+import operator
+import csv
+import multiprocessing
+
+# Дополнительные кодеки, используются если установлены
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Миниатюры картинок строятся, только если установлен Pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+# Блокировки между процессами (--processes), есть только на Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Время запуска процесса, для метрики fx_startup_seconds
+STARTED = time.time()
 
 # Папка для хранения данных серверов
 SERVERS_FOLDER = Path("servers_data")
 SERVERS_FOLDER.mkdir(exist_ok=True)
+# Папки комнат разложены по подпапкам из первых двух символов ID: rooms/A1/A1B2C3
+ROOMS_FOLDER = SERVERS_FOLDER / "rooms"
+# Реестр комнат (пароль, лимит, число файлов) — одна база SQLite, читается по мере надобности
+REGISTRY_PATH = SERVERS_FOLDER / "rooms.db"
 
-class Room:
-    def __init__(self, room_id, password_hash):
-        self.room_id = room_id
-        self.password_hash = password_hash
-        self.folder = SERVERS_FOLDER / room_id
+# Размер блока при потоковой передаче файлов
+CHUNK_SIZE = 1024 * 1024
+SENDFILE_BLOCK = 8 * 1024 * 1024
+# Ошибки os.sendfile, при которых переходим на чтение блоками
+SENDFILE_FALLBACK_ERRORS = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                            errno.EOPNOTSUPP, errno.EAGAIN}
+# Незавершённые загрузки пишутся во временные файлы с этим префиксом
+UPLOAD_PREFIX = ".upload-"
+# Права новых файлов как у обычного open()
+UMASK = os.umask(0)
+os.umask(UMASK)
+RESERVED_NAMES = {'.room_info', '.room_info.tmp'}
+# Максимальный размер файла по умолчанию (можно изменить в реестре комнат)
+MAX_UPLOAD_SIZE = 10 * 1024 ** 3
+# Загрузка по частям: размер части и время жизни незавершённой сессии
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+# Срок жизни комнат и файлов: уборщик проверяет их раз в JANITOR_INTERVAL
+# секунд и удаляет не больше JANITOR_BATCH за раз, с паузой между порциями
+JANITOR_INTERVAL = 60.0
+JANITOR_BATCH = 100
+JANITOR_PAUSE = 0.05
+# События об изменениях файлов (SSE / long-poll)
+EVENT_HISTORY = 256
+RESCAN_INTERVAL = 2.0
+EVENT_HEARTBEAT = 15.0
+EVENT_STREAM_LIFETIME = 300.0
+LONG_POLL_TIMEOUT = 30.0
+
+# Пароли комнат: PBKDF2 с солью, считается только при входе
+PBKDF2_ITERATIONS = 200_000
+# Токены сессий: срок жизни и размер кэша проверенных токенов
+SESSION_TTL = 12 * 60 * 60
+SESSION_CACHE_SIZE = 100_000
+# Сжатие ответов: минимальный размер тела и уровень сжатия
+COMPRESS_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+# Сжатые варианты файлов кэшируются на диске до этого общего размера
+COMPRESSION_CACHE_FOLDER = SERVERS_FOLDER / ".cache" / "compressed"
+COMPRESSION_CACHE_SIZE = 512 * 1024 ** 2
+# Файлы интерфейса: держатся в памяти, изменения на диске проверяются не чаще раза в секунду
+STATIC_FOLDER = Path(__file__).resolve().parent
+STATIC_FILES = {"/": "index.html", "/index.html": "index.html"}
+STATIC_CHECK_INTERVAL = 1.0
+# Дельта-синхронизация: блок подписи около корня из размера файла, в этих пределах;
+# байт, которые можно перебрать скользящей суммой за один запрос, и кэш подписей в памяти
+DELTA_MIN_BLOCK = 4 * 1024
+DELTA_MAX_BLOCK = 1024 * 1024
+DELTA_ROLL_LIMIT = 4 * 1024 ** 2
+DELTA_SIGNATURE_LIMIT = 64 * 1024 ** 2
+SIGNATURE_CACHE_SIZE = 64 * 1024 ** 2
+# Предпросмотр: миниатюры картинок и начало текстовых файлов, кэш на диске по хешу содержимого
+PREVIEW_CACHE_FOLDER = SERVERS_FOLDER / ".cache" / "previews"
+PREVIEW_CACHE_SIZE = 256 * 1024 ** 2
+PREVIEW_SIZE = 256
+PREVIEW_QUALITY = 80
+PREVIEW_IMAGE_LIMIT = 64 * 1024 ** 2
+PREVIEW_TEXT_BYTES = 8 * 1024
+PREVIEW_TEXT_LINES = 40
+PREVIEW_TABLE_ROWS = 20
+PREVIEW_CELL_LENGTH = 200
+PREVIEW_TIMEOUT = 10.0
+PREVIEW_KEYS = 10000
+PREVIEW_IMAGE_TYPES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+PREVIEW_TABLE_TYPES = {".csv", ".tsv"}
+PREVIEW_TEXT_TYPES = {".txt", ".md", ".log", ".json", ".xml", ".yaml", ".yml", ".ini", ".cfg",
+                      ".conf", ".py", ".js", ".ts", ".html", ".css", ".sql", ".sh", ".bat"}
+# Без Pillow небольшие картинки в форматах браузера служат предпросмотром сами себе
+PREVIEW_PASSTHROUGH_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+                             ".gif": "image/gif", ".webp": "image/webp"}
+PREVIEW_PASSTHROUGH_LIMIT = 256 * 1024
+# Кодировки в порядке предпочтения, gzip доступен всегда
+ENCODINGS = [name for name, codec in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if codec]
+# Типы, которые уже сжаты и не выигрывают от повторного сжатия
+PRECOMPRESSED_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/zstd", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/vnd.rar", "application/java-archive",
+    "application/pdf", "application/epub+zip", "application/x-iso9660-image",
+}
+# Пакетная загрузка: файлы сбрасываются на диск (fsync) группами
+BATCH_SYNC_FILES = 256
+BATCH_SYNC_BYTES = 64 * 1024 * 1024
+# Хранилище блобов для дедупликации (--dedup) и период сборки мусора
+BLOBS_FOLDER = SERVERS_FOLDER / ".blobs"
+BLOB_GC_INTERVAL = 10 * 60
+
+# Ограничения (0 — без ограничения); меняются на лету через PUT /api/limits
+LIMIT_DEFAULTS = {
+    "room_quota_mb": 0,              # место на диске на один сервер
+    "client_requests_per_sec": 0,    # запросов в секунду с одного IP
+    "room_requests_per_sec": 0,      # запросов в секунду к одному серверу
+    "client_mb_per_sec": 0,          # приём и отдача для одного IP
+    "room_mb_per_sec": 0,            # приём и отдача для одного сервера
+    "egress_mb_per_sec": 0,          # общая отдача, делится поровну между скачиваниями
+}
+# Какие ограничения можно переопределить для отдельного сервера
+ROOM_LIMITS = ("room_quota_mb", "room_requests_per_sec", "room_mb_per_sec")
+# Запас запросов сверх скорости (секунд), порция отдачи, блок sendfile при ограничении скорости
+REQUEST_BURST = 2.0
+EGRESS_QUANTUM = 64 * 1024
+PACED_BLOCK = 256 * 1024
+# Как часто рабочий процесс перечитывает ограничения из реестра и сколько корзин хранит
+LIMITS_REFRESH = 5.0
+MAX_BUCKETS = 100_000
+
+# Метрики: границы гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Журнал запросов: очередь строк, размер файла до ротации и число старых копий
+ACCESS_LOG_QUEUE = 10000
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 5
+
+class UploadTooLarge(Exception):
+    pass
+
+class QuotaExceeded(UploadTooLarge):
+    """The upload does not fit into the room's storage quota"""
+
+def safe_filename(name):
+    """Strip directories from a client supplied name, None if it is unusable"""
+    name = Path(name.replace('\\', '/')).name
+    if not name or name in ('.', '..') or name in RESERVED_NAMES or name.startswith(UPLOAD_PREFIX):
+        return None
+    return name
+
+MAX_RANGES = 32
+
+def file_etag(st):
+    """Strong ETag derived from file size and modification time"""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def parse_range(header, size):
+    """Parse a Range header into a list of inclusive (start, end) byte ranges.
+
+    Returns None when the header is absent, malformed or asks for too many
+    ranges (the full file is sent), and [] when no range is satisfiable.
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    specs = header.split('=', 1)[1].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else max(start, size - 1)
+                if end < start:
+                    return None
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if start < 0:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    return ranges
+
+def negotiate_encoding(accept_encoding):
+    """Preferred content coding the client accepts, None for identity"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+class BrotliStream:
+    """brotli.Compressor with the compress/flush interface of zlib"""
+    
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=COMPRESSION_LEVEL)
+    
+    def compress(self, data):
+        return self.compressor.process(data)
+    
+    def flush(self):
+        return self.compressor.finish()
+
+def new_compressor(encoding):
+    """Streaming compressor for a content coding from ENCODINGS"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+    if encoding == "br":
+        return BrotliStream()
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+def compress_bytes(data, encoding):
+    compressor = new_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+def is_compressible(filepath, f):
+    """Whether a download is worth compressing.
+
+    Archives, media and other precompressed types are skipped by MIME type;
+    files of unknown type are judged by how well their first block packs.
+    """
+    content_type, encoding = mimetypes.guess_type(str(filepath))
+    if encoding:
+        return False
+    if content_type:
+        major = content_type.split('/')[0]
+        if content_type in PRECOMPRESSED_TYPES or (major in ('image', 'audio', 'video')
+                                                   and not content_type.endswith('+xml')):
+            return False
+        if major == 'text' or content_type.endswith(('json', 'xml', 'javascript', 'sql')):
+            return True
+    sample = f.read(64 * 1024)
+    f.seek(0)
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+class CompressionCache:
+    """Compressed variants of downloaded files kept on disk, least recently used evicted first.
+
+    Entries are keyed by the file path, its ETag and the coding, so a file
+    that changes never gets a stale variant; old variants just age out.
+    """
+    
+    def __init__(self, folder=COMPRESSION_CACHE_FOLDER, max_size=COMPRESSION_CACHE_SIZE):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # name -> size, oldest first
+        self.total = 0
+        paths = []
+        for path in self.folder.iterdir():
+            st = path.stat()
+            if not path.name.startswith(UPLOAD_PREFIX):
+                paths.append((st.st_mtime, path))
+            elif time.time() - st.st_mtime > 60:
+                # Свежие временные файлы может дописывать другой рабочий процесс
+                os.remove(path)
+        for _, path in sorted(paths):
+            self.entries[path.name] = path.stat().st_size
+            self.total += self.entries[path.name]
+        with self.lock:
+            self.evict()
+    
+    def key(self, filepath, etag, encoding):
+        digest = hashlib.blake2b(f"{filepath}\0{etag}".encode(), digest_size=16).hexdigest()
+        return f"{digest}.{encoding}"
+    
+    def open(self, key):
+        """Open a cached variant for reading, None on a miss.
+
+        A variant stored by another worker process is picked up from disk.
+        """
+        with self.lock:
+            try:
+                f = open(self.folder / key, 'rb')
+            except OSError:
+                self.total -= self.entries.pop(key, 0)
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = os.fstat(f.fileno()).st_size
+                self.total += self.entries[key]
+            return f
+    
+    def create(self):
+        """Temp file to write a new variant into, returns (file, path)"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=UPLOAD_PREFIX)
+        return os.fdopen(fd, 'wb'), tmp_path
+    
+    def store(self, key, tmp_path):
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.folder / key)
+        with self.lock:
+            self.total += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.evict()
+    
+    def evict(self):
+        # Вызывается под self.lock
+        while self.total > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.folder / name)
+            except OSError:
+                pass
+
+def preview_kind(name):
+    """"image", "table", "text" or None: what kind of preview a file name gets"""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in PREVIEW_IMAGE_TYPES:
+        return "image"
+    if ext in PREVIEW_TABLE_TYPES:
+        return "table"
+    if ext in PREVIEW_TEXT_TYPES or (mimetypes.guess_type(name)[0] or "").startswith("text/"):
+        return "text"
+    return None
+
+def text_preview(data, kind, delimiter=","):
+    """JSON preview of the head of a text file: its first lines, or first rows for a table
+    (delimiter is the fallback when the sample does not reveal one)"""
+    truncated = len(data) > PREVIEW_TEXT_BYTES
+    data = data[:PREVIEW_TEXT_BYTES]
+    if b"\0" in data:
+        raise ValueError("binary file")
+    text = data.decode("utf-8", errors="replace")
+    lines = text.splitlines()
+    if truncated and len(lines) > 1:
+        # Последняя строка могла оборваться посередине
+        lines.pop()
+    truncated = truncated or len(lines) > (PREVIEW_TABLE_ROWS if kind == "table" else PREVIEW_TEXT_LINES)
+    if kind == "table":
+        try:
+            delimiter = csv.Sniffer().sniff("\n".join(lines[:PREVIEW_TABLE_ROWS]), ",;\t|").delimiter
+        except csv.Error:
+            pass
+        rows = [[cell[:PREVIEW_CELL_LENGTH] for cell in row]
+                for row in csv.reader(lines[:PREVIEW_TABLE_ROWS], delimiter=delimiter)]
+        preview = {"kind": "table", "rows": rows, "truncated": truncated}
+    else:
+        preview = {"kind": "text", "lines": lines[:PREVIEW_TEXT_LINES], "truncated": truncated}
+    return json.dumps(preview, ensure_ascii=False).encode()
+
+def image_preview(data):
+    """JPEG thumbnail no larger than PREVIEW_SIZE on either side"""
+    image = Image.open(io.BytesIO(data))
+    # JPEG можно декодировать сразу в уменьшенном виде
+    image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=PREVIEW_QUALITY, optimize=True)
+    return out.getvalue()
+
+def render_preview(path, kind, folder):
+    """Build the preview of one file; runs in a preview pool process.
+
+    The key is the SHA-256 of exactly the bytes the preview is made from
+    (the whole image, the head of a text file), so copies and renamed
+    files share one cached preview. Returns (key, tmp_path), tmp_path
+    being None when the cache already has the key. Raises ValueError if
+    the file has no usable preview.
+    """
+    with open(path, 'rb') as f:
+        limit = PREVIEW_IMAGE_LIMIT if kind == "image" else PREVIEW_TEXT_BYTES
+        data = f.read(limit + 1)
+    if kind == "image" and len(data) > limit:
+        raise ValueError("image too large for a preview")
+    key = f"{hashlib.sha256(data).hexdigest()[:40]}.{'jpg' if kind == 'image' else kind + '.json'}"
+    if os.path.exists(os.path.join(folder, key)):
+        return key, None
+    try:
+        if kind == "image":
+            body = image_preview(data)
+        else:
+            body = text_preview(data, kind, "\t" if path.lower().endswith(".tsv") else ",")
+    except Exception as e:
+        raise ValueError(f"no preview: {e}") from None
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=UPLOAD_PREFIX)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    return key, tmp_path
+
+def watch_parent(parent):
+    """Initializer of preview pool processes: exit once the server process is gone,
+    even if it was killed without shutting the pool down"""
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+class PreviewCache(CompressionCache):
+    """Rendered previews on disk, named by content key, least recently used evicted first"""
+    
+    def __init__(self, folder=PREVIEW_CACHE_FOLDER, max_size=PREVIEW_CACHE_SIZE):
+        super().__init__(folder, max_size)
+
+class PreviewService:
+    """Previews built by a pool of processes and kept in a PreviewCache.
+
+    Decoding a large image would stall a request thread, so rendering runs
+    in worker processes (spawned on first use, so each pre-forked server
+    process gets its own pool). Previews are queued when a file is
+    uploaded and built lazily for files that have none yet. The content
+    key of each file version (path, size, mtime) is remembered, so a
+    preview that is already cached is found without reading the file;
+    a file that has no preview is remembered as such.
+    """
+    
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.keys = OrderedDict()  # (path, size, mtime_ns) -> content key, None if no preview
+        self.pending = {}  # (path, size, mtime_ns) -> Future of the key
+    
+    def request(self, path, st, kind):
+        """Future of the content key of a file's preview, None if it has none"""
+        version = (str(path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if version in self.keys:
+                self.keys.move_to_end(version)
+                future = Future()
+                future.set_result(self.keys[version])
+                return future
+            future = self.pending.get(version)
+            if future is not None:
+                return future
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=watch_parent, initargs=(os.getpid(),))
+            future = self.pending[version] = Future()
+            job = self.pool.submit(render_preview, str(path), kind, str(self.cache.folder))
+        job.add_done_callback(lambda job: self.finish(version, job, future))
+        return future
+    
+    def finish(self, version, job, future):
+        key = error = None
+        try:
+            key, tmp_path = job.result()
+            if tmp_path:
+                self.cache.store(key, tmp_path)
+            METRICS.inc("fx_previews_total", (("result", "built" if tmp_path else "cached"),))
+        except ValueError:
+            METRICS.inc("fx_previews_total", (("result", "none"),))
+        except Exception as e:
+            # Например, упавший процесс пула: в следующий раз попробуем снова
+            METRICS.inc("fx_previews_total", (("result", "error"),))
+            error = e
+        with self.lock:
+            self.pending.pop(version, None)
+            if error is None:
+                self.keys[version] = key
+                while len(self.keys) > PREVIEW_KEYS:
+                    self.keys.popitem(last=False)
+        if error is None:
+            future.set_result(key)
+        else:
+            future.set_exception(error)
+    
+    def forget(self, path, st):
+        """Drop the remembered key of a file version whose preview was evicted"""
+        with self.lock:
+            self.keys.pop((str(path), st.st_size, st.st_mtime_ns), None)
+    
+    def prefetch(self, paths):
+        """Queue previews of freshly uploaded files"""
+        for path in paths:
+            kind = preview_kind(path.name)
+            if kind is None or (kind == "image" and Image is None):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if kind != "image" or st.st_size <= PREVIEW_IMAGE_LIMIT:
+                self.request(path, st, kind)
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+class StaticAsset:
+    """One UI file held in memory with every compressed variant of it"""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.body = f.read()
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.etag = file_etag(st)
+        self.mtime = int(st.st_mtime)
+        self.content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        if self.content_type.startswith("text/"):
+            self.content_type += "; charset=utf-8"
+        self.variants = {}
+        if len(self.body) >= COMPRESS_MIN_SIZE:
+            for encoding in ENCODINGS:
+                self.variants[encoding] = compress_bytes(self.body, encoding)
+        self.checked = time.monotonic()
+
+class StaticAssets:
+    """UI files served from memory instead of being read on every request.
+
+    A file is loaded and compressed once, then served as is until its
+    mtime or size changes; the file is stat()ed at most once per
+    STATIC_CHECK_INTERVAL, so an edited index.html shows up within a second.
+    """
+    
+    def __init__(self, folder=STATIC_FOLDER):
+        self.folder = Path(folder)
+        self.lock = threading.Lock()
+        self.assets = {}  # name -> StaticAsset
+    
+    def get(self, name):
+        """The current StaticAsset for a file name, None if there is no such file"""
+        asset = self.assets.get(name)
+        now = time.monotonic()
+        if asset and now - asset.checked < STATIC_CHECK_INTERVAL:
+            return asset
+        path = self.folder / name
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.assets.pop(name, None)
+            return None
+        if asset and asset.stamp == (st.st_mtime_ns, st.st_size):
+            asset.checked = now
+            return asset
+        with self.lock:
+            # Пока ждали блокировку, файл мог перечитать другой поток
+            asset = self.assets.get(name)
+            if asset and asset.stamp == (st.st_mtime_ns, st.st_size):
+                return asset
+            try:
+                asset = StaticAsset(path)
+            except OSError:
+                return None
+            self.assets[name] = asset
+            METRICS.inc("fx_static_loads_total")
+            return asset
+
+class FileIndex:
+    """In-memory listing of a folder, kept current by the upload and delete paths.
+
+    Every read stats only the folder itself; the files are rescanned when the
+    folder's mtime shows a change made behind our back (a file copied in by
+    hand, another process). A folder modified within the last couple of
+    seconds is not trusted, since a coarse mtime could hide a second change.
+
+    Each change bumps the version and is kept in a short event history that
+    event stream clients wait on.
+    """
+    
+    def __init__(self, folder, hidden=()):
+        self.folder = Path(folder)
+        self.hidden = set(hidden)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = {}  # name -> {"name", "size", "modified"}
+        self.dir_mtime = None
+        self.listing = None
+        self.encoded = None
+        self.etag = None
+        # epoch отличает историю событий после перезапуска сервера
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self.events = deque(maxlen=EVENT_HISTORY)
+    
+    def is_hidden(self, name):
+        return name in self.hidden or name.startswith(UPLOAD_PREFIX)
+    
+    def remember_dir_mtime(self):
+        mtime = os.stat(self.folder).st_mtime
+        self.dir_mtime = None if time.time() - mtime < 2 else mtime
+    
+    def record(self, event_type, name, entry=None):
+        self.version += 1
+        self.listing = None
+        self.encoded = None
+        event = {"id": f"{self.epoch}:{self.version}", "type": event_type, "name": name}
+        if entry:
+            event["file"] = entry
+        self.events.append((self.version, event))
+        self.changed.notify_all()
+    
+    def refresh(self):
+        mtime = os.stat(self.folder).st_mtime
+        if mtime == self.dir_mtime:
+            return
+        entries = {}
+        with span("scan"), os.scandir(self.folder) as it:
+            for entry in it:
+                if self.is_hidden(entry.name) or not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries[entry.name] = {"name": entry.name, "size": st.st_size, "modified": st.st_mtime}
+        self.dir_mtime = None if time.time() - mtime < 2 else mtime
+        if entries != self.entries:
+            old = self.entries
+            self.entries = entries
+            for name in old.keys() - entries.keys():
+                self.record("file-deleted", name)
+            for name, entry in entries.items():
+                if old.get(name) != entry:
+                    self.record("file-added", name, entry)
+    
+    def files(self):
+        with self.lock:
+            self.refresh()
+            if self.listing is None:
+                self.listing = list(self.entries.values())
+            return self.listing
+    
+    def files_json(self, encoding=None):
+        """The listing encoded as JSON and its ETag, cached until the next change.
+
+        With a content coding the compressed body and its variant ETag are
+        returned (and cached) instead.
+        """
+        with self.lock:
+            self.refresh()
+            if self.encoded is None:
+                body = json.dumps(list(self.entries.values())).encode()
+                self.encoded = {None: body}
+                self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            if encoding is None:
+                return self.encoded[None], self.etag
+            if encoding not in self.encoded:
+                self.encoded[encoding] = compress_bytes(self.encoded[None], encoding)
+            return self.encoded[encoding], f'{self.etag[:-1]}-{encoding}"'
+
+    
+    def count(self):
+        with self.lock:
+            self.refresh()
+            return len(self.entries)
+    
+    def total_size(self):
+        with self.lock:
+            self.refresh()
+            return sum(e["size"] for e in self.entries.values())
+    
+    def add(self, path):
+        st = os.stat(path)
+        entry = {"name": path.name, "size": st.st_size, "modified": st.st_mtime}
+        with self.lock:
+            self.entries[path.name] = entry
+            self.record("file-added", path.name, entry)
+            self.remember_dir_mtime()
+    
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.record("file-deleted", name)
+            self.remember_dir_mtime()
+    
+    def cursor(self):
+        with self.lock:
+            return f"{self.epoch}:{self.version}"
+    
+    def wait_for_changes(self, since, timeout):
+        """Block until there are events after the cursor since, or timeout.
+
+        Returns (cursor, events); events is None when since is unknown or
+        too old for the history, and the client has to reload the listing.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            self.refresh()
+            epoch, _, version = (since or "").partition(":")
+            if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+                return f"{self.epoch}:{self.version}", None
+            since_version = int(version)
+            while self.version <= since_version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Периодически перепроверяем папку на внешние изменения
+                self.changed.wait(min(remaining, RESCAN_INTERVAL))
+                self.refresh()
+            if self.version > since_version and (not self.events or self.events[0][0] > since_version + 1):
+                return f"{self.epoch}:{self.version}", None
+            events = [event for v, event in self.events if v > since_version]
+            return f"{self.epoch}:{self.version}", events
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterable of byte strings (a request body)"""
+    
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+class MultipartReader:
+    """Streaming parser for multipart/form-data bodies.
+
+    parts() yields (headers, data) for each part, data being an iterator
+    over its bytes that has to be consumed before moving to the next part,
+    so any number of files passes through in constant memory.
+    """
+    
+    def __init__(self, chunks, boundary):
+        self.chunks = iter(chunks)
+        self.delimiter = b'\r\n--' + boundary
+        # Первой границе не предшествует CRLF, добавляем его сами
+        self.buffer = b'\r\n'
+    
+    def fill(self):
+        chunk = next(self.chunks, b'')
+        if not chunk:
+            raise ValueError("multipart body ended before the closing boundary")
+        self.buffer += chunk
+    
+    def read_line(self):
+        while b'\r\n' not in self.buffer:
+            if len(self.buffer) > 65536:
+                raise ValueError("multipart header line too long")
+            self.fill()
+        line, _, self.buffer = self.buffer.partition(b'\r\n')
+        return line
+    
+    def read_part_data(self):
+        # Хвост буфера короче разделителя придерживаем: граница может прийти разрезанной
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                data, self.buffer = self.buffer[:index], self.buffer[index + len(self.delimiter):]
+                if data:
+                    yield data
+                return
+            if len(self.buffer) > keep:
+                yield self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            self.fill()
+    
+    def parts(self):
+        for _ in self.read_part_data():
+            pass  # преамбула
+        while True:
+            while len(self.buffer) < 2:
+                self.fill()
+            if self.buffer.startswith(b'--'):
+                return
+            self.read_line()
+            headers = {}
+            while True:
+                line = self.read_line()
+                if not line:
+                    break
+                name, _, value = line.decode('utf-8', 'replace').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            data = self.read_part_data()
+            yield headers, data
+            for _ in data:
+                pass
+
+def disposition_filename(value):
+    """File name from a Content-Disposition header value, None for plain fields"""
+    match = re.search(r"filename\*=(?:utf-8|UTF-8)''([^;]+)", value)
+    if match:
+        return unquote(match.group(1).strip())
+    match = re.search(r'filename="((?:[^"\\]|\\.)*)"', value) or re.search(r'filename=([^;]+)', value)
+    if match:
+        # Браузеры кодируют кавычку в имени как %22
+        return match.group(1).replace('\\"', '"').replace('%22', '"').strip()
+    return None
+
+class BatchWriter:
+    """Writes the files of a batch upload, publishing them in groups.
+
+    Each file goes to its own temp file without an fsync. Every
+    BATCH_SYNC_FILES files or BATCH_SYNC_BYTES bytes the pending group is
+    flushed: each temp file is fsynced, all of them are renamed into place
+    and the folder is fsynced once for the group rather than after every
+    rename. Temp files that were never flushed are removed by discard().
+    """
+    
+    def __init__(self, folder, blobs=None):
+        self.folder = folder
+        self.blobs = blobs
+        self.pending = []  # (tmp_path, target, digest)
+        self.pending_bytes = 0
+        self.published = []
+    
+    def add(self, filename, chunks):
+        """Write one file from an iterable of byte strings, returns its size"""
+        digest = hashlib.sha256() if self.blobs else None
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=UPLOAD_PREFIX)
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    with span("write"):
+                        f.write(chunk)
+                    if digest:
+                        with span("hash"):
+                            digest.update(chunk)
+                    size += len(chunk)
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.pending.append((tmp_path, self.folder / filename, digest.hexdigest() if digest else None))
+        self.pending_bytes += size
+        if len(self.pending) >= BATCH_SYNC_FILES or self.pending_bytes >= BATCH_SYNC_BYTES:
+            self.flush()
+        return size
+    
+    def flush(self):
+        """Sync and publish the pending files, returns their final paths.
+
+        If this fails part way, the files already renamed are in published
+        and the rest stay pending.
+        """
+        for tmp_path, _, _ in self.pending:
+            fd = os.open(tmp_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                with span("fsync"):
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        paths = []
+        try:
+            for tmp_path, target, digest in self.pending:
+                if digest:
+                    self.blobs.intern(tmp_path, digest, target)
+                else:
+                    os.replace(tmp_path, target)
+                paths.append(target)
+        finally:
+            del self.pending[:len(paths)]
+            if not self.pending:
+                self.pending_bytes = 0
+            self.published.extend(paths)
+        if paths and hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.folder, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return paths
+    
+    def discard(self):
+        """Remove the temp files of files still pending"""
+        for tmp_path, _, _ in self.pending:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self.pending, self.pending_bytes = [], 0
+
+# Записи дельты: заголовок (тип, a, b), у COPY это первый блок и число блоков,
+# у LITERAL — длина данных после заголовка, END завершает дельту SHA-256 результата
+DELTA_HEADER = struct.Struct(">BII")
+DELTA_COPY, DELTA_LITERAL, DELTA_END = 0, 1, 2
+ADLER_MOD = 65521
+
+def delta_block_size(size):
+    """Signature block size for a file of size bytes: a power of two near its square root"""
+    block = DELTA_MIN_BLOCK
+    while block * block < size and block < DELTA_MAX_BLOCK:
+        block *= 2
+    return block
+
+def strong_checksum(block):
+    """First 16 bytes of the SHA-256 as hex, computable in browsers through crypto.subtle"""
+    return hashlib.sha256(block).hexdigest()[:32]
+
+def block_signature(f, block_size):
+    """(weak, strong) checksums of the consecutive blocks of an open file.
+
+    The weak one is Adler-32, which can be rolled one byte at a time by
+    whoever looks for these blocks at any offset of another file.
+    """
+    weak, strong = [], []
+    for block in iter(lambda: f.read(block_size), b''):
+        weak.append(zlib.adler32(block))
+        strong.append(strong_checksum(block))
+    return weak, strong
+
+def delta_record(op, a=0, b=0):
+    return DELTA_HEADER.pack(op, a, b)
+
+def make_delta(f, signature, stats=None, roll_limit=DELTA_ROLL_LIMIT):
+    """Yield delta records that rebuild the file open as f from a base with the given signature.
+
+    Blocks of the base are found at any offset with a rolling Adler-32,
+    confirmed by their strong checksum and sent as runs of COPY records;
+    everything in between goes out as LITERAL data. Rolling is plain
+    Python, so after roll_limit bytes without a match the rest is only
+    compared block by block. stats, if given, counts the "copied" and
+    "literal" bytes.
+    """
+    block_size = signature["block_size"]
+    weak, strong = signature["weak"], signature["strong"]
+    count = len(weak)
+    if not count:
+        roll_limit = 0
+    last_length = signature["size"] - (count - 1) * block_size if count else 0
+    blocks = {}
+    for index, checksum in enumerate(weak):
+        blocks.setdefault(checksum, []).append(index)
+    stats = stats if stats is not None else {}
+    stats.setdefault("copied", 0)
+    stats.setdefault("literal", 0)
+    digest = hashlib.sha256()
+    data = b''
+    start = pos = 0      # начало ещё не отправленных байт и окна в data
+    eof = False
+    run = None           # [первый блок, число блоков] копирования, которое ещё копится
+    checksum = None
+    rolled = 0
+    
+    def flush_literal(end):
+        if run:
+            yield delta_record(DELTA_COPY, *run)
+            run.clear()
+        if end > start:
+            yield delta_record(DELTA_LITERAL, end - start)
+            yield data[start:end]
+            stats["literal"] += end - start
+    
+    def match(window, index):
+        return strong[index] == strong_checksum(window) and \
+            len(window) == (block_size if index < count - 1 else last_length)
+    
+    while True:
+        if len(data) - pos <= block_size and not eof:
+            data = data[start:]
+            pos -= start
+            start = 0
+            chunk = f.read(max(CHUNK_SIZE, block_size))
+            digest.update(chunk)
+            data += chunk
+            eof = not chunk
+            continue
+        if len(data) - pos < block_size:
+            # Хвост короче блока может совпасть только с коротким последним блоком базы
+            tail = len(data) - last_length
+            if count and 0 < last_length < block_size and tail >= pos and \
+                    zlib.adler32(data[tail:]) == weak[-1] and match(data[tail:], count - 1):
+                yield from flush_literal(tail)
+                yield delta_record(DELTA_COPY, count - 1, 1)
+                stats["copied"] += last_length
+                start = len(data)
+            yield from flush_literal(len(data))
+            break
+        
+        window = data[pos:pos + block_size]
+        if checksum is None:
+            checksum = zlib.adler32(window)
+        found = None
+        for index in blocks.get(checksum, ()):
+            if match(window, index):
+                found = index
+                break
+        if found is not None:
+            if start < pos:
+                yield from flush_literal(pos)
+            if run and run[0] + run[1] == found:
+                run[1] += 1
+            else:
+                if run:
+                    yield delta_record(DELTA_COPY, *run)
+                run = [found, 1]
+            stats["copied"] += block_size
+            pos += block_size
+            start = pos
+            checksum = None
+            continue
+        
+        if rolled >= roll_limit:
+            pos += block_size
+            checksum = None
+        else:
+            # Сдвигаем окно по байту, пока слабая сумма не совпадёт с каким-нибудь блоком
+            end = min(len(data) - block_size, pos + roll_limit - rolled, start + CHUNK_SIZE)
+            a, b = checksum & 0xffff, checksum >> 16
+            rolled -= pos
+            for out, new in zip(data[pos:end], data[pos + block_size:end + block_size]):
+                a = (a - out + new) % ADLER_MOD
+                b = (b - block_size * out + a - 1) % ADLER_MOD
+                pos += 1
+                if (b << 16 | a) in blocks:
+                    break
+            rolled += pos
+            checksum = b << 16 | a
+            if pos == len(data) - block_size and eof:
+                # Дальше только хвост короче блока
+                pos += 1
+                checksum = None
+        if pos - start >= CHUNK_SIZE:
+            yield from flush_literal(pos)
+            start = pos
+    
+    if run:
+        yield delta_record(DELTA_COPY, *run)
+    yield delta_record(DELTA_END) + digest.digest()
+
+def check_signature(signature):
+    """Raise ValueError unless signature is a well-formed block signature"""
+    if not isinstance(signature, dict):
+        raise ValueError("signature must be an object")
+    size, block_size = signature.get("size"), signature.get("block_size")
+    weak, strong = signature.get("weak"), signature.get("strong")
+    if not isinstance(block_size, int) or not DELTA_MIN_BLOCK <= block_size <= DELTA_MAX_BLOCK:
+        raise ValueError("block_size out of range")
+    if not isinstance(size, int) or size < 0 or not isinstance(weak, list) or not isinstance(strong, list):
+        raise ValueError("size, weak and strong are required")
+    if len(weak) != len(strong) or len(weak) != (size + block_size - 1) // block_size:
+        raise ValueError("block count does not match the size")
+    if not all(isinstance(w, int) and 0 <= w < 2 ** 32 for w in weak) or \
+            not all(isinstance(h, str) and len(h) == 32 for h in strong):
+        raise ValueError("malformed checksums")
+
+class ChunkStream:
+    """Exact-size reads from an iterable of byte strings, such as a request body"""
+    
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.pos = 0
+    
+    def at_end(self):
+        if self.pos == len(self.buffer):
+            self.buffer = next(self.chunks, b'')
+            self.pos = 0
+        return not self.buffer
+    
+    def pieces(self, n):
+        """Yield the next n bytes in pieces, ValueError if the stream ends first"""
+        while n > 0:
+            if self.at_end():
+                raise ValueError("delta ends inside a record")
+            piece = self.buffer[self.pos:self.pos + n]
+            self.pos += len(piece)
+            n -= len(piece)
+            yield piece
+    
+    def read(self, n):
+        return b''.join(self.pieces(n))
+
+def apply_delta(chunks, base, block_size, limit, stats=None):
+    """Yield the file a delta rebuilds from the open base file.
+
+    Raises ValueError for a malformed delta or when the result does not
+    match the SHA-256 of its END record, UploadTooLarge once the result
+    grows past limit bytes.
+    """
+    stream = ChunkStream(chunks)
+    base_size = os.fstat(base.fileno()).st_size
+    stats = stats if stats is not None else {}
+    stats.setdefault("copied", 0)
+    stats.setdefault("literal", 0)
+    digest = hashlib.sha256()
+    size = 0
+    while not stream.at_end():
+        op, a, b = DELTA_HEADER.unpack(stream.read(DELTA_HEADER.size))
+        if op == DELTA_COPY:
+            offset = a * block_size
+            if not b or (a + b - 1) * block_size >= base_size:
+                raise ValueError("copy outside the base file")
+            length = min(b * block_size, base_size - offset)
+            pieces = read_range(base, offset, length)
+            stats["copied"] += length
+        elif op == DELTA_LITERAL:
+            pieces = stream.pieces(a)
+            stats["literal"] += a
+        elif op == DELTA_END:
+            if stream.read(digest.digest_size) != digest.digest():
+                raise ValueError("result does not match the checksum of the delta")
+            if not stream.at_end():
+                raise ValueError("data after the end of the delta")
+            return
+        else:
+            raise ValueError(f"unknown delta record {op}")
+        for piece in pieces:
+            size += len(piece)
+            if size > limit:
+                raise UploadTooLarge()
+            digest.update(piece)
+            yield piece
+
+def read_range(f, offset, length):
+    """Yield length bytes of an open file from offset in CHUNK_SIZE pieces"""
+    f.seek(offset)
+    while length > 0:
+        data = f.read(min(CHUNK_SIZE, length))
+        if not data:
+            raise ValueError("base file is shorter than its signature")
+        length -= len(data)
+        yield data
+
+class SignatureCache:
+    """Block signatures of files as encoded JSON, least recently used evicted first.
+
+    Keyed by path, ETag and block size, so a file that changes gets a new
+    signature and the old one just ages out. Compressed variants of a
+    signature are kept next to it.
+    """
+    
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> {coding or None: body}
+        self.total = 0
+    
+    def get(self, key, encoding=None):
+        with self.lock:
+            variants = self.entries.get(key)
+            if variants is None:
+                return None
+            self.entries.move_to_end(key)
+            body = variants.get(encoding)
+            if body is not None or encoding is None:
+                return body
+            identity = variants[None]
+        body = compress_bytes(identity, encoding)
+        self.put(key, body, encoding)
+        return body
+    
+    def put(self, key, body, encoding=None):
+        with self.lock:
+            variants = self.entries.setdefault(key, {})
+            self.total += len(body) - len(variants.get(encoding, b''))
+            variants[encoding] = body
+            self.entries.move_to_end(key)
+            while self.total > self.max_size and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total -= sum(len(v) for v in evicted.values())
+
+class Route:
+    """One entry of the route table: the handler method and its typed parameters"""
+    
+    __slots__ = ("template", "handler", "label", "params")
+    
+    def __init__(self, template, handler, label, params):
+        self.template = template
+        self.handler = handler
+        self.label = label
+        self.params = params  # [(segment index, converter)]
+
+
+class Router:
+    """Route table compiled into dictionaries.
+
+    Templates such as "/api/room/{room}/download/{name:file}" are split
+    into segments once. Routes with the same method, segment count and
+    parameter positions share a dict keyed by their literal segments, so a
+    path is split once and matched with one lookup per parameter layout
+    (at most two here), however many routes there are. Parameters are
+    converted by type (str, int, or file: a percent-decoded safe file name)
+    and passed to the handler positionally; a value that does not convert
+    means the route does not match.
+    """
+    
+    CONVERTERS = {
+        "str": str,
+        "int": int,
+        "file": lambda value: safe_filename(unquote(value)),
+    }
+    
+    def __init__(self):
+        # (method, segment count) -> {literal positions: (getter, {literal segments: Route})}
+        self.layouts = {}
+    
+    def add(self, methods, template, handler, label=None):
+        segments = template.split('/')
+        params = []
+        literal = []
+        for i, segment in enumerate(segments):
+            if segment.startswith('{') and segment.endswith('}'):
+                name, _, kind = segment[1:-1].partition(':')
+                params.append((i, self.CONVERTERS[kind or "str"]))
+                segments[i] = f"{{{name}}}"
+            else:
+                literal.append(i)
+        # Метрики группируют маршрут по действию, без имени файла или сессии
+        route = Route(template, handler, label or "/".join(segments[:5]), params)
+        literal = tuple(literal)
+        for method in methods.split():
+            layouts = self.layouts.setdefault((method, len(segments)), {})
+            if literal not in layouts:
+                layouts[literal] = (operator.itemgetter(*literal), {})
+            getter, routes = layouts[literal]
+            routes[getter(segments)] = route
+    
+    def match(self, method, path):
+        """(route, params) for a path without its query string, (None, None) if nothing matches"""
+        segments = path.split('/')
+        for getter, routes in self.layouts.get((method, len(segments)), {}).values():
+            route = routes.get(getter(segments))
+            if route is None:
+                continue
+            try:
+                return route, [convert(segments[i]) for i, convert in route.params]
+            except ValueError:
+                continue
+        return None, None
+    
+    def allowed(self, path):
+        """Methods that have a route for path, for 405 responses"""
+        return [m for m in ("GET", "HEAD", "POST", "PUT", "DELETE")
+                if self.match(m, path)[0] is not None]
+
+ROUTER = Router()
+for methods, template, handler in [
+    ("GET HEAD", "/", "serve_page"),
+    ("GET HEAD", "/index.html", "serve_page"),
+    ("GET", "/api/rooms", "list_rooms"),
+    ("GET", "/api/metrics", "serve_metrics"),
+    ("GET PUT", "/api/limits", "limits"),
+    ("POST", "/api/create-room", "create_room"),
+    ("POST", "/api/join-room", "join_room"),
+    ("GET", "/api/room/{room}/files", "list_room_files"),
+    ("GET", "/api/room/{room}/events", "room_events"),
+    ("GET HEAD", "/api/room/{room}/download/{name:file}", "download_file"),
+    ("GET HEAD POST", "/api/room/{room}/archive", "download_archive"),
+    ("GET", "/api/room/{room}/signature/{name:file}", "file_signature"),
+    ("GET", "/api/room/{room}/preview/{name:file}", "file_preview"),
+    ("POST", "/api/room/{room}/patch/{name:file}", "patch_file"),
+    ("POST", "/api/room/{room}/delta/{name:file}", "file_delta"),
+    ("POST", "/api/room/{room}/upload", "upload_file"),
+    ("POST", "/api/room/{room}/upload-by-hash", "upload_by_hash"),
+    ("POST", "/api/room/{room}/upload-batch", "upload_batch"),
+    ("POST", "/api/room/{room}/upload-session", "create_upload_session"),
+    ("GET", "/api/room/{room}/upload-session/{session}", "upload_session_status"),
+    ("DELETE", "/api/room/{room}/upload-session/{session}", "abort_upload_session"),
+    ("PUT", "/api/room/{room}/upload-session/{session}/{index:int}", "upload_chunk"),
+    ("POST", "/api/room/{room}/upload-session/{session}/finalize", "finalize_upload_session"),
+    ("DELETE", "/api/room/{room}/delete/{name:file}", "delete_file"),
+]:
+    ROUTER.add(methods, template, handler, label="/" if template in STATIC_FILES else None)
+
+# Служебные маршруты, на которые не действуют ограничения частоты запросов
+UNLIMITED_ROUTES = {"/api/metrics", "/api/limits"}
+UPLOAD_ROUTES = {"/api/room/{room}/upload", "/api/room/{room}/upload-session",
+                 "/api/room/{room}/upload-batch", "/api/room/{room}/patch"}
+DOWNLOAD_ROUTES = {"/api/room/{room}/download", "/api/room/{room}/archive", "/api/room/{room}/delta"}
+
+METRIC_HELP = {
+    "fx_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "fx_request_duration_seconds": ("histogram", "Time to handle a request"),
+    "fx_received_bytes_total": ("counter", "Request bytes read, headers included"),
+    "fx_sent_bytes_total": ("counter", "Response bytes written, headers included"),
+    "fx_open_connections": ("gauge", "Client connections being served"),
+    "fx_transfers_in_flight": ("gauge", "Uploads and downloads in progress"),
+    "fx_span_duration_seconds": ("histogram", "Time spent in instrumented sections (--trace-spans)"),
+    "fx_access_log_dropped_total": ("counter", "Access log lines dropped because the queue was full"),
+    "fx_room_storage_bytes": ("gauge", "Bytes stored per room"),
+    "fx_room_files": ("gauge", "Files per room"),
+    "fx_upload_sessions": ("gauge", "Unfinished chunked upload sessions"),
+    "fx_rooms": ("gauge", "Rooms in the registry"),
+    "fx_rooms_loaded": ("gauge", "Rooms loaded into memory since startup"),
+    "fx_startup_seconds": ("gauge", "Time from process start to accepting connections"),
+    "fx_limit": ("gauge", "Configured limits, 0 means unlimited"),
+    "fx_room_quota_bytes": ("gauge", "Storage quota per room with a quota"),
+    "fx_rate_limited_total": ("counter", "Requests refused with 429 by scope"),
+    "fx_quota_rejections_total": ("counter", "Uploads refused because the room quota is full"),
+    "fx_throttle_seconds_total": ("counter", "Time transfers were held back by scope"),
+    "fx_egress_waiting": ("gauge", "Downloads waiting for their share of the egress rate"),
+    "fx_static_loads_total": ("counter", "UI files read from disk into memory"),
+    "fx_previews_total": ("counter", "Preview jobs by result: built, cached (same content seen before), none or error"),
+    "fx_delta_bytes_total": ("counter", "Bytes of delta transfers, copied from the old version or sent literally"),
+    "fx_expired_total": ("counter", "Rooms, files and upload sessions deleted by the janitor"),
+    "fx_expired_bytes_total": ("counter", "Bytes of room files deleted by the janitor"),
+    "fx_janitor_duration_seconds": ("histogram", "Time of one janitor pass"),
+    "fx_janitor_last_run_timestamp": ("gauge", "Unix time the last janitor pass finished"),
+    "fx_disk_total_bytes": ("gauge", "Size of the file system holding servers_data"),
+    "fx_disk_free_bytes": ("gauge", "Free space on the file system holding servers_data"),
+}
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Series are keyed by metric name and a tuple of (label, value) pairs.
+    Gauges that are cheaper to read on demand come from collector
+    callbacks run at scrape time.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = []
+        self.spans_enabled = False
+    
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+    
+    def add(self, name, labels=(), value=1):
+        with self.lock:
+            self.gauges[name, labels] = self.gauges.get((name, labels), 0) + value
+    
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.histograms.get((name, labels))
+            if series is None:
+                series = self.histograms[name, labels] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def register(self, collector):
+        """collector() returns [(name, labels, value)] gauge samples"""
+        self.collectors.append(collector)
+    
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), series in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(LATENCY_BUCKETS, series):
+                    lines.append((name + "_bucket", labels + (("le", repr(bound)),), count))
+                lines.append((name + "_bucket", labels + (("le", "+Inf"),), series[-1]))
+                lines.append((name + "_sum", labels, series[-2]))
+                lines.append((name + "_count", labels, series[-1]))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((name, labels, value))
+        out = []
+        for name in sorted(samples):
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples[name]:
+                if labels:
+                    rendered = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                          .replace('"', '\\"').replace('\n', '\\n'))
+                                        for k, v in labels)
+                    sample = f"{sample}{{{rendered}}}"
+                out.append(f"{sample} {value}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+# Суммы спанов запроса, который обрабатывает текущий поток
+REQUEST_SPANS = threading.local()
+
+@contextmanager
+def span(name):
+    """Time a section of work when --trace-spans is on.
+
+    The time goes to the fx_span_duration_seconds histogram and is added to
+    the current request's spans, which end up in its access log line.
+    """
+    if not METRICS.spans_enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        METRICS.observe("fx_span_duration_seconds", (("span", name),), elapsed)
+        totals = getattr(REQUEST_SPANS, "totals", None)
+        if totals is not None:
+            totals[name] = totals.get(name, 0.0) + elapsed
+
+def redact_tokens(requestline):
+    """The request line with ?token= values masked: links carry session tokens
+    that anyone reading the log could otherwise replay until they expire"""
+    return re.sub(r'([?&]token=)[^&#\s]*', r'\1***', requestline)
+
+class AccessLog:
+    """Access log written by a background thread.
+
+    Request threads only queue their line. The writer drains the queue in
+    batches into a buffered file, flushes whenever it runs dry and rotates
+    the file past max_bytes, keeping `backups` old copies (access.log.1 is
+    the newest). path "-" writes to stdout, None disables the log.
+    """
+    
+    def __init__(self, path, max_bytes=ACCESS_LOG_MAX_BYTES, backups=ACCESS_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(ACCESS_LOG_QUEUE)
+        self.thread = None
+        if path:
+            self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+            self.thread.start()
+    
+    def write(self, line):
+        if not self.thread:
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            METRICS.inc("fx_access_log_dropped_total")
+    
+    def open(self):
+        if self.path == "-":
+            return sys.stdout
+        return open(self.path, "a", encoding="utf-8", buffering=64 * 1024)
+    
+    def rotate(self, stream):
+        stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return self.open()
+    
+    def run(self):
+        stream = self.open()
+        size = 0 if self.path == "-" else os.path.getsize(self.path)
+        while True:
+            line = self.queue.get()
+            while line is not None:
+                stream.write(line + "\n")
+                size += len(line) + 1
+                if self.path != "-" and size >= self.max_bytes:
+                    stream = self.rotate(stream)
+                    size = 0
+                try:
+                    line = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stream.flush()
+            if line is None:
+                return
+    
+    def close(self, timeout=5):
+        """Write out the queued lines before exit"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+class CountingReader:
+    """Wraps a handler's rfile, counts the bytes read through it and paces
+    them to the handler's rate limits"""
+    
+    def __init__(self, raw, handler):
+        self.raw = raw
+        self.handler = handler
+    
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.handler.bytes_in += len(data)
+        if self.handler.pacing:
+            self.handler.pace(len(data))
+        return data
+    
+    def readline(self, size=-1):
+        data = self.raw.readline(size)
+        self.handler.bytes_in += len(data)
+        if self.handler.pacing:
+            self.handler.pace(len(data))
+        return data
+    
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class CountingWriter:
+    """Wraps a handler's wfile, counts the bytes written through it and paces
+    them to the handler's rate limits"""
+    
+    def __init__(self, raw, handler):
+        self.raw = raw
+        self.handler = handler
+    
+    def write(self, data):
+        if self.handler.pacing:
+            self.handler.pace(len(data), outgoing=True)
+        n = self.raw.write(data)
+        self.handler.bytes_out += len(data)
+        return n
+    
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+def tar_layout(members):
+    """Byte layout of an uncompressed TAR of members [(name, path, stat)].
+
+    Returns (parts, size) with parts a list of (offset, length, data, path):
+    data holds header or padding bytes, path names a file whose first
+    length bytes go there. Any byte range of the archive can be produced
+    from this without building the archive.
+    """
+    parts = []
+    offset = 0
+    for name, path, st in members:
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+        parts.append((offset, len(header), header, None))
+        offset += len(header)
+        if st.st_size:
+            parts.append((offset, st.st_size, None, path))
+            offset += st.st_size
+        padding = -st.st_size % tarfile.BLOCKSIZE
+        if padding:
+            parts.append((offset, padding, bytes(padding), None))
+            offset += padding
+    # Архив заканчивается двумя нулевыми блоками
+    trailer = bytes(2 * tarfile.BLOCKSIZE)
+    parts.append((offset, len(trailer), trailer, None))
+    return parts, offset + len(trailer)
+
+class BlobStore:
+    """Content-addressed store that keeps each distinct file once.
+
+    Blobs live in BLOBS_FOLDER/ab/<sha256> and room files are hard links to
+    them, so downloads, listings and Range requests see ordinary files and
+    the link count is the reference count: a blob whose only remaining link
+    is the store itself is garbage. A file system without hard links just
+    keeps plain copies.
+
+    Worker processes sharing the store also take an flock on .lock, so
+    a collector in one process never removes a blob another one is
+    linking to.
+    """
+    
+    def __init__(self, folder=BLOBS_FOLDER):
+        self.folder = Path(folder)
         self.folder.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.lock_file = open(self.folder / ".lock", "a") if fcntl else None
+        self.inodes = {}  # (st_dev, st_ino) -> путь блоба
+        self.collect()
+    
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if self.lock_file:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self.lock_file:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+    
+    def blob_path(self, digest):
+        return self.folder / digest[:2] / digest
+    
+    def lookup(self, digest, size):
+        """Path of the blob with this SHA-256 and size, None if not stored"""
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return None
+        try:
+            st = os.stat(self.blob_path(digest))
+        except OSError:
+            return None
+        return self.blob_path(digest) if st.st_size == size else None
+    
+    def intern(self, tmp_path, digest, target):
+        """Move a complete temp file to target, sharing its blob if the content is known.
+
+        Returns True when an identical blob already existed.
+        """
+        blob = self.blob_path(digest)
+        with self.locked():
+            blob.parent.mkdir(exist_ok=True)
+            existed = False
+            try:
+                os.link(tmp_path, blob)
+            except FileExistsError:
+                # Такое содержимое уже есть: заменяем временный файл ссылкой на блоб
+                existed = True
+                os.remove(tmp_path)
+                os.link(blob, tmp_path)
+            except OSError:
+                # Жёсткие ссылки не поддерживаются, храним обычную копию
+                os.replace(tmp_path, target)
+                return False
+            st = os.stat(blob)
+            self.inodes[(st.st_dev, st.st_ino)] = blob
+            os.replace(tmp_path, target)
+            return existed
+    
+    def link(self, digest, size, target):
+        """Point target at a stored blob without any upload, False if there is none.
+
+        Only blobs that a file in target's folder already links to are
+        found: knowing the hash of a file in another room proves nothing
+        about holding its content, so it must not copy the file over.
+        """
+        tmp_path = target.parent / f"{UPLOAD_PREFIX}{secrets.token_hex(8)}"
+        with self.locked():
+            blob = self.lookup(digest, size)
+            if not blob or not self.referenced(blob, target.parent):
+                return False
+            try:
+                os.link(blob, tmp_path)
+            except OSError:
+                return False
+            os.replace(tmp_path, target)
+            return True
+    
+    def referenced(self, blob, folder):
+        """True if a file in folder is a hard link to blob"""
+        st = os.stat(blob)
+        if st.st_nlink < 2:
+            return False
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.inode() != st.st_ino or not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.stat(follow_symlinks=False).st_dev == st.st_dev:
+                    return True
+        return False
+    
+    def release(self, st):
+        """Drop a blob once the room file with stat result st has been deleted"""
+        with self.locked():
+            blob = self.inodes.get((st.st_dev, st.st_ino))
+            if blob is None:
+                return
+            try:
+                if os.stat(blob).st_nlink > 1:
+                    return
+                os.remove(blob)
+            except OSError:
+                pass
+            del self.inodes[(st.st_dev, st.st_ino)]
+    
+    def collect(self):
+        """Remove blobs no room links to any more, returns (count, bytes) freed.
+
+        Also rebuilds the inode map, so files removed behind the server's
+        back are reclaimed too.
+        """
+        freed = count = 0
+        with self.locked():
+            inodes = {}
+            for blob in self.folder.glob("??/*"):
+                try:
+                    st = os.stat(blob)
+                    if st.st_nlink > 1:
+                        inodes[(st.st_dev, st.st_ino)] = blob
+                        continue
+                    os.remove(blob)
+                except OSError:
+                    continue
+                count += 1
+                freed += st.st_size
+            self.inodes = inodes
+        return count, freed
+    
+    def run_collector(self, interval=BLOB_GC_INTERVAL):
+        def loop():
+            while True:
+                time.sleep(interval)
+                count, freed = self.collect()
+                if count:
+                    print(f"Blob GC: removed {count} blobs, {freed} bytes")
+        threading.Thread(target=loop, name="blob-gc", daemon=True).start()
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    """Salted PBKDF2 record of a room password as stored in .room_info"""
+    salt = salt or secrets.token_bytes(16)
+    with span("kdf"):
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return {"algorithm": "pbkdf2_sha256", "iterations": iterations,
+            "salt": salt.hex(), "hash": digest.hex()}
+
+def check_password(password, record):
+    if record.get("algorithm") == "pbkdf2_sha256":
+        with span("kdf"):
+            digest = hashlib.pbkdf2_hmac('sha256', password.encode(),
+                                         bytes.fromhex(record["salt"]), record["iterations"])
+        return hmac.compare_digest(digest.hex(), record["hash"])
+    # Комнаты, созданные до перехода на PBKDF2, хранят несолёный SHA-256
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), record["hash"])
+
+class SessionTokens:
+    """Signed, expiring room access tokens issued at join time.
+
+    A token is "room_id.expires.nonce.signature" with an HMAC-SHA256
+    signature, so any token can be checked without server-side state; the
+    checks themselves are cached until the token expires.
+    """
+    
+    def __init__(self, secret=None, ttl=SESSION_TTL):
+        self.secret = secret or secrets.token_bytes(32)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cache = {}  # token -> (room_id, expires)
+        self.next_sweep = 0
+    
+    def sign(self, payload):
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()[:32]
+    
+    def issue(self, room_id):
+        expires = int(time.time() + self.ttl)
+        payload = f"{room_id}.{expires}.{secrets.token_hex(8)}"
+        token = f"{payload}.{self.sign(payload)}"
+        with self.lock:
+            self.cache[token] = (room_id, expires)
+        return token, expires
+    
+    def validate(self, token):
+        """Room id the token grants access to, None if invalid or expired"""
+        now = time.time()
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            cached = self.cache.get(token)
+        if cached:
+            return cached[0] if cached[1] > now else None
         
+        payload, _, signature = token.rpartition('.')
+        room_id, _, rest = payload.partition('.')
+        expires = rest.partition('.')[0]
+        if not expires.isdigit() or int(expires) <= now:
+            return None
+        if not hmac.compare_digest(self.sign(payload), signature):
+            return None
+        with self.lock:
+            if len(self.cache) < SESSION_CACHE_SIZE:
+                self.cache[token] = (room_id, int(expires))
+        return room_id
+    
+    def sweep(self, now):
+        # Вызывается под self.lock
+        self.cache = {t: v for t, v in self.cache.items() if v[1] > now}
+        self.next_sweep = now + 60
+
+class TokenBucket:
+    """rate tokens per second, holding up to burst.
+
+    try_take() refuses when the bucket is short; take() always succeeds,
+    possibly running into debt, and returns how long the caller should
+    sleep to pay it back, which paces a stream to the rate.
+    """
+    
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+    
+    def refill(self, now):
+        # Вызывается под self.lock
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+    
+    def try_take(self, n=1):
+        """0 if n tokens were taken, otherwise seconds until they will be there"""
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            return (n - self.tokens) / self.rate
+    
+    def take(self, n):
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+    
+    def idle(self):
+        with self.lock:
+            self.refill(time.monotonic())
+            return self.tokens >= self.burst
+
+class EgressScheduler:
+    """Shares one egress rate between the downloads in progress.
+
+    Downloads take turns: each asks for its next quantum and queues
+    behind the ones already waiting, so N active downloads get about 1/N
+    of the rate each, and one held back by its own slow client leaves
+    its share to the others.
+    """
+    
+    def __init__(self, quantum=EGRESS_QUANTUM):
+        self.cond = threading.Condition()
+        self.quantum = quantum
+        self.rate = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.turns = deque()
+    
+    def set_rate(self, rate):
+        with self.cond:
+            self.rate = rate
+            self.cond.notify_all()
+    
+    def waiting(self):
+        with self.cond:
+            return len(self.turns)
+    
+    def acquire(self, n):
+        """Wait for the turns to send n bytes, returns seconds waited"""
+        started = time.monotonic()
+        while n > 0 and self.rate:
+            part = min(n, self.quantum)
+            self.take_turn(part)
+            n -= part
+        return time.monotonic() - started
+    
+    def take_turn(self, n):
+        turn = object()
+        with self.cond:
+            self.turns.append(turn)
+            try:
+                while self.rate:
+                    if self.turns[0] is not turn:
+                        self.cond.wait()
+                        continue
+                    now = time.monotonic()
+                    # Простаивающий канал копит не больше десятой доли секунды
+                    self.tokens = min(max(self.quantum, self.rate / 10),
+                                      self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    if self.tokens >= n:
+                        self.tokens -= n
+                        return
+                    self.cond.wait((n - self.tokens) / self.rate)
+            finally:
+                self.turns.remove(turn)
+                self.cond.notify_all()
+
+class Limiter:
+    """Quotas and rate limits, with the token buckets that enforce them.
+
+    The settings live in the registry, so every worker process applies the
+    same ones, and each worker re-reads them every LIMITS_REFRESH seconds.
+    Rates are split evenly between the worker processes. Per-room
+    overrides of ROOM_LIMITS sit under "rooms".
+    """
+    
+    def __init__(self, processes=1):
+        self.lock = threading.Lock()
+        self.processes = processes
+        self.settings = dict(LIMIT_DEFAULTS, rooms={})
+        self.buckets = {}  # (scope, key, kind) -> TokenBucket
+        self.egress = EgressScheduler()
+        self.next_refresh = 0
+    
+    def refresh(self):
+        now = time.monotonic()
+        if now < self.next_refresh or Room.registry is None:
+            return
+        self.next_refresh = now + LIMITS_REFRESH
+        settings = json.loads(Room.registry.setting("limits", "{}"))
+        self.apply(settings)
+    
+    def apply(self, settings):
+        settings = dict(dict(LIMIT_DEFAULTS, rooms={}), **settings)
+        with self.lock:
+            if settings == self.settings:
+                return
+            self.settings = settings
+            # Корзины пересоздаются с новыми скоростями при следующем запросе
+            self.buckets = {}
+        self.egress.set_rate(self.settings["egress_mb_per_sec"] * 1024 ** 2 / self.processes)
+    
+    def value(self, name, room_id=None):
+        room = self.settings["rooms"].get(room_id) if room_id else None
+        if room and name in room:
+            return room[name]
+        return self.settings[name]
+    
+    def bucket(self, scope, key, kind, rate, burst):
+        with self.lock:
+            bucket = self.buckets.get((scope, key, kind))
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    self.buckets = {k: b for k, b in self.buckets.items() if not b.idle()}
+                bucket = self.buckets[scope, key, kind] = TokenBucket(rate, burst)
+            return bucket
+    
+    def admit(self, ip, room_id=None):
+        """0 if a request may go ahead, otherwise (scope, seconds to wait)"""
+        self.refresh()
+        for scope, key in (("client", ip), ("room", room_id)):
+            rate = key and self.value(f"{scope}_requests_per_sec", room_id) / self.processes
+            if not rate:
+                continue
+            wait = self.bucket(scope, key, "requests", rate, max(1, rate * REQUEST_BURST)).try_take()
+            if wait:
+                return scope, wait
+        return 0
+    
+    def byte_buckets(self, ip, room_id=None):
+        """[(scope, bucket)] a transfer for this client and room is paced by"""
+        buckets = []
+        for scope, key in (("client", ip), ("room", room_id)):
+            rate = key and self.value(f"{scope}_mb_per_sec", room_id) * 1024 ** 2 / self.processes
+            if rate:
+                buckets.append((scope, self.bucket(scope, key, "bytes", rate, max(rate, EGRESS_QUANTUM))))
+        return buckets
+    
+    def quota(self, room_id):
+        """Storage quota of a room in bytes, 0 if unlimited"""
+        self.refresh()
+        return int(self.value("room_quota_mb", room_id) * 1024 ** 2)
+    
+    def metrics(self):
+        samples = [("fx_limit", (("name", name),), self.settings[name]) for name in LIMIT_DEFAULTS]
+        samples.append(("fx_egress_waiting", (), self.egress.waiting()))
+        return samples
+
+def merge_limits(settings, changes):
+    """Apply a PUT /api/limits body to stored settings, raises ValueError if it is invalid"""
+    if not isinstance(changes, dict):
+        raise ValueError("expected a JSON object")
+    settings = dict(settings, rooms=dict(settings.get("rooms", {})))
+    for name, value in changes.items():
+        if name == "rooms":
+            if not isinstance(value, dict):
+                raise ValueError("rooms must be an object")
+            for room_id, room in value.items():
+                if room is None:
+                    settings["rooms"].pop(room_id.upper(), None)
+                    continue
+                if not isinstance(room, dict) or any(k not in ROOM_LIMITS for k in room):
+                    raise ValueError(f"room limits must be some of {', '.join(ROOM_LIMITS)}")
+                settings["rooms"][room_id.upper()] = dict(settings["rooms"].get(room_id.upper(), {}),
+                                                          **{k: limit_value(k, v) for k, v in room.items()})
+        elif name in LIMIT_DEFAULTS:
+            settings[name] = limit_value(name, value)
+        else:
+            raise ValueError(f"unknown limit {name}")
+    return settings
+
+def limit_value(name, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"{name} must be a number >= 0")
+    return value
+
+def room_path(room_id):
+    """Data folder of a room in the sharded layout"""
+    return ROOMS_FOLDER / room_id[:2] / room_id
+
+def count_files(folder):
+    """Number of user files in a room folder, for the registry"""
+    with os.scandir(folder) as it:
+        return sum(1 for entry in it if entry.name not in RESERVED_NAMES
+                   and not entry.name.startswith(UPLOAD_PREFIX) and entry.is_file())
+
+class RoomRegistry:
+    """Rooms, unfinished chunked uploads and server settings in one SQLite database.
+
+    Rows are read when a room is first used, so startup does not depend on
+    the number of rooms. The file count is only a hint for /api/rooms: it
+    is refreshed from the live index of rooms that are loaded.
+
+    The database is in WAL mode and every worker process (--processes)
+    opens its own connection, so a room created or an upload chunk
+    received by one worker is seen by all of them.
+    """
+    
+    def __init__(self, path=REGISTRY_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
+            self.db.execute("""CREATE TABLE IF NOT EXISTS rooms (
+                room_id TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                max_upload_size INTEGER,
+                created REAL NOT NULL,
+                file_count INTEGER NOT NULL DEFAULT 0,
+                accessed REAL,
+                ttl REAL,
+                file_ttl REAL)""")
+            # Реестры старых версий получают столбцы срока жизни здесь
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(rooms)")}
+            for column in ("accessed", "ttl", "file_ttl"):
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE rooms ADD COLUMN {column} REAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS upload_sessions (
+                session_id TEXT PRIMARY KEY,
+                room_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                updated REAL NOT NULL)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS upload_chunks (
+                session_id TEXT NOT NULL,
+                chunk INTEGER NOT NULL,
+                PRIMARY KEY (session_id, chunk)) WITHOUT ROWID""")
+            self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # Файлы со сроком жизни; mtime_ns отличает файл от загруженного поверх него
+            self.db.execute("""CREATE TABLE IF NOT EXISTS file_expiry (
+                room_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                expires REAL NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                PRIMARY KEY (room_id, name)) WITHOUT ROWID""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS file_expiry_expires ON file_expiry (expires)")
+    
+    @contextmanager
+    def transaction(self):
+        """Write transaction; IMMEDIATE takes the write lock up front, so
+        concurrent writers in other processes wait instead of failing"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def get(self, room_id):
+        """(password record, max_upload_size, ttl, file_ttl) of a room, None if there is no such room"""
+        with self.lock:
+            row = self.db.execute("SELECT password, max_upload_size, ttl, file_ttl FROM rooms WHERE room_id = ?",
+                                  (room_id,)).fetchone()
+        return (json.loads(row[0]),) + tuple(row[1:]) if row else None
+    
+    def add(self, rows):
+        """Insert (room_id, password record, max_upload_size, file_count, ttl, file_ttl)
+        rows in one transaction, returns how many were new"""
+        now = time.time()
+        with self.transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO rooms (room_id, password, max_upload_size, created, file_count, ttl, file_ttl) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(room_id, json.dumps(password), limit, now, files, ttl, file_ttl)
+                 for room_id, password, limit, files, ttl, file_ttl in rows])
+            return db.total_changes - before
+    
+    def update(self, room_id, password, max_upload_size):
+        with self.lock:
+            self.db.execute("UPDATE rooms SET password = ?, max_upload_size = ? WHERE room_id = ?",
+                            (json.dumps(password), max_upload_size, room_id))
+    
+    def rooms(self):
+        """[(room_id, file_count)] in creation order"""
+        with self.lock:
+            return self.db.execute("SELECT room_id, file_count FROM rooms ORDER BY rowid").fetchall()
+    
+    def set_file_counts(self, counts):
+        """Store [(file_count, room_id)] pairs"""
+        with self.transaction() as db:
+            db.executemany("UPDATE rooms SET file_count = ? WHERE room_id = ?", counts)
+    
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM rooms").fetchone()[0]
+    
+    def setting(self, name, default):
+        """Value of a setting, storing default first if it is not set yet"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        if row:
+            return row[0]
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", (name, default))
+            return db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0]
+    
+    def update_setting(self, name, default, update):
+        """Replace a setting with update(current value) in one transaction, returns the new value"""
+        with self.transaction() as db:
+            row = db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+            value = update(row[0] if row else default)
+            db.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+            return value
+    
+    def add_upload(self, session):
+        with self.lock:
+            self.db.execute("INSERT INTO upload_sessions (session_id, room_id, filename, size, chunk_size, updated) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", (session.session_id, session.owner, session.filename,
+                                                          session.size, session.chunk_size, time.time()))
+    
+    def upload(self, session_id):
+        """(room_id, filename, size, chunk_size) of an upload session, None if unknown"""
+        with self.lock:
+            return self.db.execute("SELECT room_id, filename, size, chunk_size FROM upload_sessions "
+                                   "WHERE session_id = ?", (session_id,)).fetchone()
+    
+    def add_chunk(self, session_id, index):
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO upload_chunks (session_id, chunk) VALUES (?, ?)", (session_id, index))
+            db.execute("UPDATE upload_sessions SET updated = ? WHERE session_id = ?", (time.time(), session_id))
+    
+    def chunks(self, session_id):
+        with self.lock:
+            return {row[0] for row in self.db.execute(
+                "SELECT chunk FROM upload_chunks WHERE session_id = ?", (session_id,))}
+    
+    def remove_upload(self, session_id):
+        """Forget an upload session, False if it was already gone (finalized elsewhere)"""
+        with self.transaction() as db:
+            removed = db.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,)).rowcount
+            db.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+        return removed > 0
+    
+    def expire_uploads(self, deadline):
+        """Remove sessions not updated since deadline, returns their (session_id, room_id)"""
+        with self.transaction() as db:
+            expired = db.execute("SELECT session_id, room_id FROM upload_sessions WHERE updated < ?",
+                                 (deadline,)).fetchall()
+            for session_id, _ in expired:
+                db.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,))
+                db.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+        return expired
+    
+    def count_uploads(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM upload_sessions").fetchone()[0]
+    
+    def touch(self, accessed):
+        """Store [(last access time, room_id)] pairs; a time older than the stored one is ignored"""
+        with self.transaction() as db:
+            db.executemany("UPDATE rooms SET accessed = MAX(COALESCE(accessed, 0), ?) WHERE room_id = ?", accessed)
+    
+    def existing(self, room_ids):
+        """The subset of room_ids that are still registered"""
+        room_ids = list(room_ids)
+        found = set()
+        with self.lock:
+            for i in range(0, len(room_ids), 500):
+                part = room_ids[i:i + 500]
+                found.update(row[0] for row in self.db.execute(
+                    f"SELECT room_id FROM rooms WHERE room_id IN ({','.join('?' * len(part))})", part))
+        return found
+    
+    # Комната истекает, если её не открывали дольше ttl (своего или по умолчанию)
+    EXPIRED_ROOM = "COALESCE(ttl, ?) > 0 AND COALESCE(accessed, created) + COALESCE(ttl, ?) < ?"
+    
+    def expired_rooms(self, now, default_ttl, limit):
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                f"SELECT room_id FROM rooms WHERE {self.EXPIRED_ROOM} LIMIT ?",
+                (default_ttl, default_ttl, now, limit))]
+    
+    def remove_room(self, room_id, now, default_ttl):
+        """Forget an expired room with its upload sessions and file expiries.
+
+        Returns False if it was accessed in the meantime (or is gone already),
+        so a room is never removed under a client that just opened it.
+        """
+        with self.transaction() as db:
+            removed = db.execute(f"DELETE FROM rooms WHERE room_id = ? AND {self.EXPIRED_ROOM}",
+                                 (room_id, default_ttl, default_ttl, now)).rowcount
+            if removed:
+                db.execute("DELETE FROM upload_chunks WHERE session_id IN "
+                           "(SELECT session_id FROM upload_sessions WHERE room_id = ?)", (room_id,))
+                db.execute("DELETE FROM upload_sessions WHERE room_id = ?", (room_id,))
+                db.execute("DELETE FROM file_expiry WHERE room_id = ?", (room_id,))
+        return removed > 0
+    
+    def schedule_files(self, rows):
+        """Store (room_id, name, expires, mtime_ns) rows, replacing earlier ones"""
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO file_expiry (room_id, name, expires, mtime_ns) "
+                           "VALUES (?, ?, ?, ?)", rows)
+    
+    def expired_files(self, now, limit):
+        """[(room_id, name, mtime_ns)] of files past their expiry, oldest first"""
+        with self.lock:
+            return self.db.execute("SELECT room_id, name, mtime_ns FROM file_expiry WHERE expires < ? "
+                                   "ORDER BY expires LIMIT ?", (now, limit)).fetchall()
+    
+    def unschedule_files(self, rows):
+        """Drop [(room_id, name, mtime_ns)] expiries; a row replaced by a newer upload stays"""
+        with self.transaction() as db:
+            db.executemany("DELETE FROM file_expiry WHERE room_id = ? AND name = ? AND mtime_ns = ?", rows)
+
+def migrate_rooms(registry, folder=SERVERS_FOLDER):
+    """Move rooms from the flat servers_data/{ID}/ layout with a .room_info
+    per room into the sharded layout and the registry, returns how many.
+
+    Rows are written first and folders moved after, so an interrupted run
+    is simply finished by the next one.
+    """
+    legacy = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            info_path = os.path.join(entry.path, '.room_info')
+            if not entry.name.isalnum() or not entry.is_dir() or not os.path.exists(info_path):
+                continue
+            with open(info_path, 'r') as f:
+                room_info = json.load(f)
+            password = room_info.get('password') or {"algorithm": "sha256",
+                                                     "hash": room_info['password_hash']}
+            legacy.append((entry.name, password, room_info.get('max_upload_size'),
+                           count_files(entry.path), None, None))
+    registry.add(legacy)
+    for room_id, *_ in legacy:
+        target = room_path(room_id)
+        if target.exists():
+            print(f"Room {room_id}: {target} already exists, left in {folder / room_id}")
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(folder / room_id, target)
+        for name in RESERVED_NAMES:
+            try:
+                os.remove(target / name)
+            except FileNotFoundError:
+                pass
+    return len(legacy)
+
+class Room:
+    max_upload_size = MAX_UPLOAD_SIZE
+    # Реестр комнат, открывается при запуске сервера
+    registry = None
+    # Срок жизни в секундах для комнат, где он не задан; None — хранить вечно
+    default_ttl = None
+    default_file_ttl = None
+    # Предпросмотр файлов (PreviewService), None если выключен
+    previews = None
+    
+    def __init__(self, room_id, password, max_upload_size=None, ttl=None, file_ttl=None):
+        self.room_id = room_id
+        self.password = password
+        if max_upload_size:
+            self.max_upload_size = max_upload_size
+        # None — срок по умолчанию, 0 — хранить вечно
+        self.ttl = ttl
+        self.file_ttl = file_ttl
+        # Время последнего обращения; уборщик переносит его в реестр
+        self.accessed = self.flushed = time.time()
+        self.folder = room_path(room_id)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.index = FileIndex(self.folder, hidden=RESERVED_NAMES)
+        # Байты загрузок, идущих сейчас, уже учитываются в квоте
+        self.lock = threading.Lock()
+        self.reserved = 0
+    
+    @classmethod
+    def load(cls, room_id):
+        """Read a room from the registry, None if there is no such room"""
+        record = cls.registry.get(room_id)
+        if record is None:
+            return None
+        return cls(room_id, *record)
+    
+    @classmethod
+    def create(cls, room_id, password, ttl=None, file_ttl=None):
+        """Register a new room, None if the ID is already taken"""
+        if not cls.registry.add([(room_id, password, None, 0, ttl, file_ttl)]):
+            return None
+        return cls(room_id, password, ttl=ttl, file_ttl=file_ttl)
+    
+    def reserve(self, size, quota):
+        """Count an upload of size bytes against quota until release().
+
+        Returns the free space before the reservation, raises QuotaExceeded
+        if the upload does not fit.
+        """
+        with self.lock:
+            free = quota - self.index.total_size() - self.reserved
+            if size > free:
+                raise QuotaExceeded()
+            self.reserved += size
+            return free
+    
+    def release(self, size):
+        with self.lock:
+            self.reserved -= size
+    
+    def save_info(self):
+        limit = self.max_upload_size if self.max_upload_size != Room.max_upload_size else None
+        self.registry.update(self.room_id, self.password, limit)
+    
     def verify_password(self, password):
-        return hashlib.sha256(password.encode()).hexdigest() == self.password_hash
+        return check_password(password, self.password)
+    
+    def upgrade_password(self, password):
+        """Re-hash a legacy SHA-256 password with PBKDF2 after a successful join"""
+        if self.password.get("algorithm") != "pbkdf2_sha256":
+            self.password = hash_password(password)
+            self.save_info()
+    
+    def get_files(self):
+        return self.index.files()
+    
+    def effective_ttl(self):
+        return self.ttl if self.ttl is not None else Room.default_ttl
+    
+    def effective_file_ttl(self):
+        return self.file_ttl if self.file_ttl is not None else Room.default_file_ttl
+    
+    def publish(self, paths, ttl=None):
+        """Add finished uploads to the index; with a TTL they are also scheduled for deletion"""
+        rows = []
+        for path in paths:
+            self.index.add(path)
+            if ttl:
+                rows.append((self.room_id, path.name, time.time() + ttl, os.stat(path).st_mtime_ns))
+        if rows:
+            self.registry.schedule_files(rows)
+        if self.previews:
+            self.previews.prefetch(paths)
+
+class UploadSession:
+    """A resumable upload assembled from numbered chunks.
+
+    The target is preallocated as a temp file in the destination folder and
+    every chunk is written at its own offset through a separate descriptor,
+    so chunks may arrive out of order and in parallel. The session and the
+    chunks received so far are kept in the registry, so any worker process
+    can take the next chunk and the upload survives a restart.
+    """
+    
+    def __init__(self, session_id, folder, filename, size, chunk_size, owner, registry):
+        self.session_id = session_id
+        self.folder = folder
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.owner = owner
+        self.registry = registry
+        self.chunk_count = (size + chunk_size - 1) // chunk_size
+        self.path = folder / f"{UPLOAD_PREFIX}{session_id}"
+    
+    def allocate(self):
+        """Create the temp file and register the session"""
+        with open(self.path, 'wb') as f:
+            if self.size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, self.size)
+                except OSError:
+                    pass
+            f.truncate(self.size)
+        self.registry.add_upload(self)
+    
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+    
+    def write_chunk(self, index, chunks):
+        """Write one chunk from an iterable of byte strings, returns its length"""
+        offset = index * self.chunk_size
+        written = 0
+        fd = os.open(self.path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for data in chunks:
+                view = memoryview(data)
+                while view:
+                    with span("write"):
+                        if hasattr(os, "pwrite"):
+                            n = os.pwrite(fd, view, offset + written)
+                        else:
+                            os.lseek(fd, offset + written, os.SEEK_SET)
+                            n = os.write(fd, view)
+                    view = view[n:]
+                    written += n
+        finally:
+            os.close(fd)
+        if written == self.chunk_length(index):
+            self.registry.add_chunk(self.session_id, index)
+        return written
+    
+    def missing(self):
+        received = self.registry.chunks(self.session_id)
+        return [i for i in range(self.chunk_count) if i not in received]
+    
+    def status(self):
+        received = sorted(self.registry.chunks(self.session_id))
+        return {
+            "session_id": self.session_id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunk_count,
+            "received": received,
+            "complete": len(received) == self.chunk_count,
+        }
+    
+    def finalize(self, blobs=None):
+        """Move the assembled file into place, returns the final path.
+
+        With a blob store the file is hashed first, since chunks may have
+        arrived in any order, and stored once by content.
+        """
+        digest = hashlib.sha256() if blobs else None
+        with open(self.path, 'rb+') as f:
+            if digest:
+                with span("hash"):
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            with span("fsync"):
+                os.fsync(f.fileno())
+        os.chmod(self.path, 0o666 & ~UMASK)
+        target = self.folder / self.filename
+        if blobs:
+            blobs.intern(self.path, digest.hexdigest(), target)
+        else:
+            os.replace(self.path, target)
+        return target
+    
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class FileExchangeHandler(SimpleHTTPRequestHandler):
+    rooms = {}  # room_id -> Room
+    rooms_lock = threading.Lock()
+    tokens = SessionTokens()
+    # Открытые потоки событий и long-poll, каждый занимает рабочий поток
+    event_slots = threading.Semaphore(16)
+    # Кэш сжатых вариантов файлов, None — сжимать каждый раз заново
+    compression_cache = None
+    # Файлы интерфейса в памяти
+    static = StaticAssets()
+    # Фоновый журнал запросов, None — печатать строки сразу в stdout
+    access_log = None
+    # Хранилище блобов, None пока дедупликация не включена (--dedup)
+    blobs = None
+    # Квоты и ограничения скорости, общие для всех соединений процесса
+    limiter = Limiter()
+    # Токен для /api/limits, None — изменять ограничения можно только с localhost
+    admin_token = None
+    # Уборщик устаревших комнат и файлов, запускается в start_worker
+    janitor = None
+    # Подписи блоков для дельта-загрузок
+    signatures = SignatureCache()
+
+    @classmethod
+    def storage_metrics(cls):
+        with cls.rooms_lock:
+            rooms = list(cls.rooms.values())
+        samples = [("fx_rooms_loaded", (), len(rooms))]
+        if Room.registry:
+            samples.append(("fx_rooms", (), Room.registry.count()))
+            samples.append(("fx_upload_sessions", (), Room.registry.count_uploads()))
+        for room in rooms:
+            samples.append(("fx_room_storage_bytes", (("room", room.room_id),), room.index.total_size()))
+            samples.append(("fx_room_files", (("room", room.room_id),), room.index.count()))
+            quota = cls.limiter.quota(room.room_id)
+            if quota:
+                samples.append(("fx_room_quota_bytes", (("room", room.room_id),), quota))
+        return samples
+    
+    @classmethod
+    def get_room(cls, room_id):
+        """Cached room, loaded from disk on first use"""
+        if not room_id:
+            return None
+        with cls.rooms_lock:
+            room = cls.rooms.get(room_id)
+            if room is None and room_id.isalnum():
+                room = Room.load(room_id)
+                if room:
+                    cls.rooms[room_id] = room
+            return room
+    
+    def dispatch(self):
+        """Call the handler of the route matched in parse_request"""
+        if self.endpoint is not None:
+            getattr(self, self.endpoint.handler)(*self.params)
+        elif self.route_path.startswith("/api/"):
+            allowed = ROUTER.allowed(self.route_path)
+            if allowed:
+                self.send_json_bytes(json.dumps({"error": "Метод не поддерживается"}).encode(), 405,
+                                     {"Allow": ", ".join(allowed + ["OPTIONS"])})
+            else:
+                self.send_json_response({"error": "Неизвестный адрес API"}, 404)
+        elif self.command in ('GET', 'HEAD'):
+            # Остальные адреса открывают интерфейс, например ссылки с ?room=
+            self.serve_static("index.html")
+        else:
+            self.send_error(404)
+    
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = dispatch
+    
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, POST, PUT, DELETE, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Filename, X-Session-Token, X-Content-SHA256, X-Admin-Token, X-File-TTL, Range, If-Range, If-Match, If-None-Match, Last-Event-ID")
+        self.send_header("Access-Control-Expose-Headers", "Content-Range, Accept-Ranges, ETag, Content-Length, Content-Encoding, Content-Disposition, Retry-After")
+        self.end_headers()
+    
+    def serve_page(self):
+        self.serve_static(STATIC_FILES[self.route_path])
+    
+    def serve_static(self, name):
+        """Send a UI file from memory.
+
+        The variant for the client's Accept-Encoding was compressed when the
+        file was loaded; If-None-Match and If-Modified-Since get a 304, and
+        Cache-Control: no-cache makes browsers revalidate on every visit so
+        an updated interface is picked up at once.
+        """
+        asset = self.static.get(name)
+        if asset is None:
+            self.send_error(404, f"File {name} not found")
+            return
+        
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if asset.variants else None
+        body = asset.variants.get(encoding, asset.body)
+        etag = f'{asset.etag[:-1]}-{encoding}"' if encoding in asset.variants else asset.etag
+        last_modified = self.date_time_string(asset.mtime)
+        
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+        else:
+            try:
+                since = parsedate_to_datetime(self.headers.get('If-Modified-Since'))
+                not_modified = asset.mtime <= since.timestamp()
+            except (TypeError, ValueError, IndexError):
+                not_modified = False
+        
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if not not_modified:
+            self.send_header("Content-type", asset.content_type)
+            self.send_header("Content-Length", len(body))
+            if encoding in asset.variants:
+                self.send_header("Content-Encoding", encoding)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        if not not_modified and self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def create_room(self):
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            
+            password = data.get('password', '')
+            if not password or len(password) < 4:
+                self.send_json_response({"error": "Пароль должен быть минимум 4 символа"}, 400)
+                return
+            
+            # Срок хранения в часах: ttl_hours — комнаты после последнего входа,
+            # file_ttl_hours — файлов после загрузки; 0 — вечно, без поля — по умолчанию сервера
+            lifetimes = []
+            for field in ('ttl_hours', 'file_ttl_hours'):
+                hours = data.get(field)
+                if hours is not None and (isinstance(hours, bool) or not isinstance(hours, (int, float))
+                                          or not 0 <= hours < float('inf')):
+                    self.send_json_response({"error": "Срок хранения должен быть числом часов"}, 400)
+                    return
+                lifetimes.append(None if hours is None else hours * 3600)
+            
+            password_record = hash_password(password)
+            
+            with self.rooms_lock:
+                # Генерируем уникальный ID комнаты (6 символов), занятые ID отсеивает реестр
+                room = None
+                while room is None:
+                    room_id = secrets.token_hex(3).upper()
+                    room = Room.create(room_id, password_record, *lifetimes)
+                
+                self.rooms[room_id] = room
+            
+            token, expires = self.tokens.issue(room_id)
+            self.send_json_response({
+                "success": True,
+                "room_id": room_id,
+                "token": token,
+                "expires": expires,
+                "dedup": self.blobs is not None,
+                "message": f"Комната создана! ID: {room_id}"
+            })
+            
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def join_room(self):
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            
+            room_id = data.get('room_id', '').upper().strip()
+            password = data.get('password', '')
+            
+            if not room_id:
+                self.send_json_response({"error": "Введите ID комнаты"}, 400)
+                return
+            
+            # Информация о комнате читается с диска один раз и кэшируется
+            room = self.get_room(room_id)
+            if not room:
+                self.send_json_response({"error": "Комната не найдена"}, 404)
+                return
+            
+            # Проверяем пароль
+            if not room.verify_password(password):
+                self.send_json_response({"error": "Неверный пароль"}, 403)
+                return
+            room.upgrade_password(password)
+            room.accessed = time.time()
+            
+            token, expires = self.tokens.issue(room_id)
+            self.send_json_response({
+                "success": True,
+                "room_id": room_id,
+                "token": token,
+                "expires": expires,
+                "dedup": self.blobs is not None,
+                "message": "Успешный вход!"
+            })
+            
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def list_room_files(self, room_id):
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            
+            body, etag = room.index.files_json()
+            encoding = self.response_encoding(len(body))
+            if encoding:
+                body, etag = room.index.files_json(encoding)
+            if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            self.send_json_bytes(body, headers={"ETag": etag, "Cache-Control": "no-cache"},
+                                 encoding=encoding)
+            
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def upload_file(self, room_id):
+        try:
+            filename = safe_filename(self.headers.get('X-Filename', 'uploaded_file'))
+            
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            
+            if not filename:
+                self.close_connection = True
+                self.send_json_response({"error": "Недопустимое имя файла"}, 400)
+                return
+            
+            with self.quota_allowance(room, int(self.headers.get('Content-Length') or 0)) as limit:
+                size = self.receive_upload(room.folder, filename, limit, self.blobs)
+            room.publish([room.folder / filename], self.file_ttl(room))
+            
+            self.send_json_response({
+                "success": True,
+                "filename": filename,
+                "size": size,
+                "message": "Файл загружен"
+            })
+            
+        except QuotaExceeded:
+            self.close_connection = True
+            self.send_quota_exceeded()
+        except UploadTooLarge:
+            self.close_connection = True
+            self.send_json_response({"error": "Файл слишком большой"}, 413)
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json_response({"error": f"Некорректное тело запроса: {e}"}, 400)
+        except ConnectionError:
+            # Клиент оборвал загрузку, временный файл уже удалён
+            self.close_connection = True
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def upload_batch(self, room_id):
+        """Upload many files in one request, as multipart/form-data or a TAR stream.
+
+        Entries are written in a single pass through a BatchWriter. Folder
+        structure is flattened to file names, and a name repeated within
+        the batch gets a " (2)" style suffix. The room's upload limit
+        applies to the whole request. The answer lists a result per entry.
+        """
+        writer = None
+        results = []
+        room = None
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('multipart/form-data'):
+                match = re.search(r'boundary="?([^";]+)"?', content_type)
+                if not match:
+                    raise ValueError("multipart boundary missing")
+                boundary = match.group(1).encode()
+                parse = lambda body: self.multipart_entries(body, boundary)
+            elif content_type.split(';')[0].strip() in ('application/x-tar', 'application/tar',
+                                                         'application/gzip', 'application/x-gzip'):
+                parse = self.tar_entries
+            else:
+                self.close_connection = True
+                self.send_json_response({"error": "Ожидается multipart/form-data или TAR"}, 415)
+                return
+            
+            writer = BatchWriter(room.folder, self.blobs)
+            used = set()
+            with self.quota_allowance(room, int(self.headers.get('Content-Length') or 0)) as limit:
+                for name, data in parse(self.read_body_chunks(limit)):
+                    filename = safe_filename(name)
+                    if not filename:
+                        results.append({"name": name, "error": "Недопустимое имя файла"})
+                        continue
+                    stem, suffix = os.path.splitext(filename)
+                    number = 2
+                    while filename in used:
+                        filename = f"{stem} ({number}){suffix}"
+                        number += 1
+                    used.add(filename)
+                    size = writer.add(filename, data)
+                    results.append({"name": name, "filename": filename, "size": size})
+            
+            self.publish_batch(room, writer)
+            self.send_json_response({
+                "success": True,
+                "uploaded": sum(1 for r in results if "error" not in r),
+                "failed": sum(1 for r in results if "error" in r),
+                "files": results
+            })
+        
+        except QuotaExceeded:
+            self.close_connection = True
+            self.publish_batch(room, writer)
+            self.send_quota_exceeded({"files": results})
+        except UploadTooLarge:
+            self.close_connection = True
+            self.publish_batch(room, writer)
+            self.send_json_response({"error": "Пакет слишком большой", "files": results}, 413)
+        except (ValueError, tarfile.TarError) as e:
+            self.close_connection = True
+            self.publish_batch(room, writer)
+            self.send_json_response({"error": f"Некорректное тело запроса: {e}", "files": results}, 400)
+        except ConnectionError:
+            # Файлы, полученные целиком, остаются, оборванный последний удалён
+            self.close_connection = True
+            self.publish_batch(room, writer)
+        except Exception as e:
+            self.close_connection = True
+            if writer:
+                # Непонятно, что сломалось: публикуем только уже переименованные файлы
+                room.publish(writer.published, self.file_ttl(room))
+            self.send_json_response({"error": str(e)}, 500)
+        finally:
+            # Временные файлы, которые так и не опубликованы, не должны остаться в папке
+            if writer:
+                writer.discard()
+    
+    def publish_batch(self, room, writer):
+        if writer:
+            writer.flush()
+            room.publish(writer.published, self.file_ttl(room))
+            writer.published = []
+    
+    def multipart_entries(self, body, boundary):
+        """(name, data) for each file part of a multipart body, other fields are skipped"""
+        for headers, data in MultipartReader(body, boundary).parts():
+            filename = disposition_filename(headers.get('content-disposition', ''))
+            if filename is not None:
+                yield filename, data
+    
+    def tar_entries(self, body):
+        """(name, data) for each regular file of a (possibly gzipped) TAR stream"""
+        with tarfile.open(fileobj=ChunkReader(body), mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                f = archive.extractfile(member)
+                yield member.name, iter(lambda: f.read(CHUNK_SIZE), b'')
+    
+    def upload_by_hash(self, room_id):
+        """Add a file whose content is already stored, identified by its SHA-256.
+
+        The client sends {"filename", "size", "sha256"} before uploading;
+        a 404 means the room holds no file with that content and the file
+        has to be uploaded as usual. Blobs of other rooms are not linked,
+        the hash alone does not prove the client has the file.
+        """
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            
+            content_length = int(self.headers.get('Content-Length') or 0)
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            filename = safe_filename(str(data.get('filename', '')))
+            size = int(data.get('size', -1))
+            digest = str(data.get('sha256', '')).lower()
+            
+            if not filename:
+                self.send_json_response({"error": "Недопустимое имя файла"}, 400)
+                return
+            if size > room.max_upload_size:
+                self.send_json_response({"error": "Файл слишком большой"}, 413)
+                return
+            self.check_quota(room, size)
+            if not self.blobs or not self.blobs.link(digest, size, room.folder / filename):
+                self.send_json_response({"error": "Файл с таким содержимым не найден", "found": False}, 404)
+                return
+            room.publish([room.folder / filename], self.file_ttl(room))
+            
+            self.send_json_response({
+                "success": True,
+                "filename": filename,
+                "size": size,
+                "deduplicated": True,
+                "message": "Файл уже был на сервере"
+            })
+            
+        except QuotaExceeded:
+            self.send_quota_exceeded()
+        except (ValueError, TypeError) as e:
+            self.send_json_response({"error": f"Некорректный запрос: {e}"}, 400)
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def check_quota(self, room, size):
+        """Raise QuotaExceeded if size more bytes do not fit into the room's quota"""
+        quota = self.limiter.quota(room.room_id)
+        if quota:
+            room.reserve(size, quota)
+            room.release(size)
+    
+    @contextmanager
+    def quota_allowance(self, room, size=0):
+        """Upload limit for a body of (declared) size, reserved against the
+        room's quota while it streams in. Running past a limit set by the
+        quota raises QuotaExceeded rather than UploadTooLarge."""
+        quota = self.limiter.quota(room.room_id)
+        if not quota:
+            yield room.max_upload_size
+            return
+        free = room.reserve(size, quota)
+        try:
+            if free >= room.max_upload_size:
+                yield room.max_upload_size
+            else:
+                try:
+                    yield free
+                except UploadTooLarge:
+                    raise QuotaExceeded()
+        finally:
+            room.release(size)
+    
+    def send_quota_exceeded(self, extra=None):
+        METRICS.inc("fx_quota_rejections_total")
+        self.send_json_response(dict({"error": "Недостаточно места: квота сервера исчерпана"}, **(extra or {})), 507)
+    
+    def read_body_chunks(self, limit):
+        """Yield the request body in bounded chunks.
+
+        Handles both Content-Length and Transfer-Encoding: chunked bodies and
+        raises UploadTooLarge as soon as more than limit bytes have arrived.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            received = 0
+            while True:
+                line = self.rfile.readline(65537)
+                if not line:
+                    raise ConnectionAbortedError("connection closed inside chunked body")
+                try:
+                    chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ValueError("bad chunk size line")
+                if chunk_size == 0:
+                    # Пропускаем trailer-заголовки до пустой строки
+                    while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                received += chunk_size
+                if received > limit:
+                    raise UploadTooLarge()
+                yield from self.read_exact_chunks(chunk_size)
+                self.rfile.readline(65537)
+        else:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            if content_length < 0:
+                raise ValueError("negative Content-Length")
+            if content_length > limit:
+                raise UploadTooLarge()
+            yield from self.read_exact_chunks(content_length)
+    
+    def read_exact_chunks(self, count):
+        while count > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                raise ConnectionAbortedError("connection closed before the body was complete")
+            count -= len(chunk)
+            yield chunk
+    
+    def receive_upload(self, folder, filename, limit, blobs=None, chunks=None):
+        """Stream the request body into folder/filename, returns its size.
+
+        The body goes to a temporary file next to the target which is renamed
+        into place only once complete, so listings never show partial files.
+        The SHA-256 is computed on the way in when a blob store is given or
+        the client sent X-Content-SHA256, which must then match. chunks
+        replaces the raw body with content the caller decodes from it.
+        """
+        expected = self.headers.get('X-Content-SHA256', '').strip().lower()
+        digest = hashlib.sha256() if blobs or expected else None
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=UPLOAD_PREFIX)
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.read_body_chunks(limit) if chunks is None else chunks:
+                    with span("write"):
+                        f.write(chunk)
+                    if digest:
+                        with span("hash"):
+                            digest.update(chunk)
+                    size += len(chunk)
+                with span("fsync"):
+                    f.flush()
+                    os.fsync(f.fileno())
+            if expected and digest.hexdigest() != expected:
+                raise ValueError("content does not match X-Content-SHA256")
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+            if blobs:
+                blobs.intern(tmp_path, digest.hexdigest(), folder / filename)
+            else:
+                os.replace(tmp_path, folder / filename)
+            return size
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def download_file(self, room_id, filename):
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            
+            filepath = room.folder / filename if filename else None
+            if not filepath or not filepath.is_file():
+                self.send_json_response({"error": "Файл не найден"}, 404)
+                return
+            
+            self.send_file(filepath)
+                
+        except ConnectionError:
+            # Клиент прервал скачивание
+            self.close_connection = True
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    def send_file(self, filepath):
+        """Send a file as a download, honouring conditional and Range headers.
+
+        Answers 304 for a matching If-None-Match, 206 with one range or a
+        multipart/byteranges body, 416 for unsatisfiable ranges and 200 with
+        the whole file otherwise. HEAD requests get the headers only.
+        """
+        with open(filepath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = file_etag(st)
+            last_modified = self.date_time_string(int(st.st_mtime))
+            content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+            
+            # Сжимаем только ответ целиком, диапазоны относятся к исходным байтам
+            encoding = None
+            if not self.headers.get('Range'):
+                encoding = self.response_encoding(size)
+                if encoding and not is_compressible(filepath, f):
+                    encoding = None
+            if encoding:
+                etag = f'{etag[:-1]}-{encoding}"'
+            
+            if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+            
+            if encoding:
+                self.send_compressed(f, filepath, etag, encoding, content_type, last_modified)
+                return
+            
+            ranges = parse_range(self.headers.get('Range'), size)
+            if_range = self.headers.get('If-Range')
+            if ranges is not None and if_range and if_range.strip() not in (etag, last_modified):
+                ranges = None
+            
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return
+            
+            if ranges is None:
+                self.send_response(200)
+                self.send_header("Content-type", content_type)
+                self.send_header("Content-Length", size)
+                parts = [(None, 0, size)]
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-type", content_type)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", end - start + 1)
+                parts = [(None, start, end - start + 1)]
+            else:
+                boundary = secrets.token_hex(16)
+                parts = []
+                length = 0
+                for start, end in ranges:
+                    head = (f"\r\n--{boundary}\r\n"
+                            f"Content-Type: {content_type}\r\n"
+                            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                    parts.append((head, start, end - start + 1))
+                    length += len(head) + end - start + 1
+                tail = f"\r\n--{boundary}--\r\n".encode()
+                length += len(tail)
+                parts.append((tail, 0, 0))
+                self.send_response(206)
+                self.send_header("Content-type", f"multipart/byteranges; boundary={boundary}")
+                self.send_header("Content-Length", length)
+            
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Disposition", f'attachment; filename="{filepath.name}"')
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            
+            if self.command == 'HEAD':
+                return
+            for head, offset, count in parts:
+                if head:
+                    self.wfile.write(head)
+                self.send_file_range(f, offset, count)
     
-    def get_files(self):
-        files = []
-        for item in self.folder.iterdir():
-            if item.is_file() and item.name != '.room_info':
-                files.append({
-                    "name": item.name,
-                    "size": item.stat().st_size,
-                    "modified": item.stat().st_mtime
-                })
-        return files
+    def send_compressed(self, f, filepath, etag, encoding, content_type, last_modified):
+        """Send a whole file with a Content-Encoding.
 
-class FileExchangeHandler(SimpleHTTPRequestHandler):
-    rooms = {}  # room_id -> Room
+        A cached variant goes out through sendfile with a Content-Length.
+        Otherwise the file is compressed while it streams, copied into the
+        cache on the way, and the end of the body is marked by closing the
+        connection.
+        """
+        cache = self.compression_cache
+        key = cache.key(filepath, etag, encoding) if cache else None
+        cached = cache.open(key) if cache else None
+        
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Content-Disposition", f'attachment; filename="{filepath.name}"')
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if cached:
+            with cached:
+                length = os.fstat(cached.fileno()).st_size
+                self.send_header("Content-Length", length)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.send_file_range(cached, 0, length)
+            return
+        
+        self.close_connection = True
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        # Сжатые варианты очень больших файлов вытеснили бы весь кэш
+        size = os.fstat(f.fileno()).st_size
+        out, tmp_path = cache.create() if cache and size <= cache.max_size // 4 else (None, None)
+        try:
+            compressor = new_compressor(encoding)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                data = compressor.compress(chunk)
+                if data:
+                    self.wfile.write(data)
+                    if out:
+                        out.write(data)
+            data = compressor.flush()
+            self.wfile.write(data)
+            if out:
+                out.write(data)
+                out.close()
+                cache.store(key, tmp_path)
+                out = None
+        finally:
+            if out:
+                out.close()
+                os.remove(tmp_path)
     
-    def do_GET(self):
-        if self.path == "/" or self.path == "/index.html":
-            self.serve_file("index.html")
-        elif self.path == "/api/rooms":
-            self.list_rooms()
-        elif self.path.startswith("/api/room/") and "/files" in self.path:
-            self.list_room_files()
-        elif self.path.startswith("/api/room/") and "/download/" in self.path:
-            self.download_file()
-        else:
-            self.serve_file("index.html")
-    
-    def do_POST(self):
-        if self.path == "/api/create-room":
-            self.create_room()
-        elif self.path == "/api/join-room":
-            self.join_room()
-        elif self.path.startswith("/api/room/") and "/upload" in self.path:
-            self.upload_file()
-        else:
-            self.send_error(404)
+    def room_file(self, room_id, filename):
+        """(room, path) of a room file, None after sending the error if there
+        is no such room or file"""
+        room = self.authorized_room(room_id)
+        if not room:
+            return None
+        filepath = room.folder / filename if filename else None
+        if not filepath or not filepath.is_file():
+            self.send_json_response({"error": "Файл не найден"}, 404)
+            return None
+        return room, filepath
     
-    def do_DELETE(self):
-        if self.path.startswith("/api/room/") and "/delete/" in self.path:
-            self.delete_file()
-        else:
-            self.send_error(404)
+    def delta_block(self, size):
+        """Block size from ?block= or the default for a file of size bytes"""
+        value = self.query.get('block', [''])[0]
+        if not value:
+            return delta_block_size(size)
+        block_size = int(value)
+        if not DELTA_MIN_BLOCK <= block_size <= DELTA_MAX_BLOCK:
+            raise ValueError("block size out of range")
+        return block_size
     
-    def do_OPTIONS(self):
+    def file_preview(self, room_id, filename):
+        """A small preview of a room file instead of the whole file.
+
+        Images get a JPEG thumbnail (with Pillow; without it small images
+        are sent as they are), text files their first lines and CSV/TSV
+        files their first rows as JSON. A preview not built yet is waited
+        for up to PREVIEW_TIMEOUT, then the answer is 503 with Retry-After.
+        """
+        try:
+            found = self.room_file(room_id, filename)
+            if not found:
+                return
+            room, filepath = found
+            st = os.stat(filepath)
+            kind = preview_kind(filepath.name) if Room.previews else None
+            if kind == "image" and Image is None:
+                content_type = PREVIEW_PASSTHROUGH_TYPES.get(filepath.suffix.lower())
+                if content_type and st.st_size <= PREVIEW_PASSTHROUGH_LIMIT:
+                    with open(filepath, 'rb') as f:
+                        self.send_preview(f.read(), content_type, file_etag(st))
+                    return
+                kind = None
+            if kind is None or (kind == "image" and st.st_size > PREVIEW_IMAGE_LIMIT):
+                self.send_json_response({"error": "Предпросмотр недоступен"}, 404)
+                return
+            
+            try:
+                key = Room.previews.request(filepath, st, kind).result(PREVIEW_TIMEOUT)
+            except FutureTimeout:
+                key = False
+            f = Room.previews.cache.open(key) if key else None
+            if key is None:
+                self.send_json_response({"error": "Предпросмотр недоступен"}, 404)
+                return
+            if f is None:
+                if key:
+                    # Вытеснен из кэша, соберётся заново при следующем запросе
+                    Room.previews.forget(filepath, st)
+                body = json.dumps({"error": "Предпросмотр готовится"}).encode()
+                self.send_json_bytes(body, 503, {"Retry-After": "2"})
+                return
+            with f:
+                body = f.read()
+            self.send_preview(body, "image/jpeg" if key.endswith(".jpg") else "application/json", f'"{key}"')
+            
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def send_preview(self, body, content_type, etag):
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            return
+        encoding = self.response_encoding(len(body)) if content_type == "application/json" else None
+        if encoding:
+            body = compress_bytes(body, encoding)
         self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", len(body))
+        self.send_header("ETag", etag)
+        # Имя файла может начать указывать на другое содержимое, поэтому браузер переспрашивает
+        self.send_header("Cache-Control", "private, no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Filename, X-Password")
         self.end_headers()
+        self.wfile.write(body)
     
-    def serve_file(self, filename):
+    def file_signature(self, room_id, filename):
+        """Block signature of a room file for delta uploads.
+
+        JSON with the file's size, ETag, block size and per-block weak and
+        strong checksums. Signatures are cached until the file changes.
+        """
         try:
-            filepath = Path(__file__).parent / filename
-            if not filepath.exists():
-                self.send_error(404, f"File {filename} not found")
+            found = self.room_file(room_id, filename)
+            if not found:
                 return
-                
-            self.send_response(200)
-            self.send_header("Content-type", "text/html; charset=utf-8")
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            
+            _, filepath = found
             with open(filepath, 'rb') as f:
-                self.wfile.write(f.read())
+                st = os.fstat(f.fileno())
+                etag = file_etag(st)
+                block_size = self.delta_block(st.st_size)
+                key = (str(filepath), etag, block_size)
+                body = self.signatures.get(key)
+                if body is None:
+                    with span("hash"):
+                        weak, strong = block_signature(f, block_size)
+                    body = json.dumps({"size": st.st_size, "etag": etag, "block_size": block_size,
+                                       "weak": weak, "strong": strong}).encode()
+                    self.signatures.put(key, body)
+            
+            signature_etag = f'{etag[:-1]}-{block_size:x}"'
+            encoding = self.response_encoding(len(body))
+            if encoding:
+                body = self.signatures.get(key, encoding)
+                signature_etag = f'{signature_etag[:-1]}-{encoding}"'
+            if signature_etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header("ETag", signature_etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            self.send_json_bytes(body, headers={"ETag": signature_etag, "Cache-Control": "no-cache"},
+                                 encoding=encoding)
+        
+        except ValueError as e:
+            self.send_json_response({"error": f"Некорректный запрос: {e}"}, 400)
         except Exception as e:
-            self.send_error(500, str(e))
+            self.send_json_response({"error": str(e)}, 500)
     
-    def create_room(self):
+    def patch_file(self, room_id, filename):
+        """Rebuild a room file from a delta against its current version.
+
+        The body is a delta made from the signature (see make_delta);
+        If-Match must carry the ETag the signature was taken from, so a
+        file changed in the meantime is refused with 412 instead of being
+        patched wrongly. The result is written like any upload: to a temp
+        file that replaces the old one once it is complete and checked.
+        """
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            password = data.get('password', '')
-            if not password or len(password) < 4:
-                self.send_json_response({"error": "Пароль должен быть минимум 4 символа"}, 400)
+            found = self.room_file(room_id, filename)
+            if not found:
+                return
+            room, filepath = found
+            if_match = self.headers.get('If-Match')
+            if not if_match:
+                self.close_connection = True
+                self.send_json_response({"error": "Нужен заголовок If-Match с ETag из подписи"}, 428)
                 return
             
-            # Генерируем уникальный ID комнаты (6 символов)
-            room_id = secrets.token_hex(3).upper()
-            while room_id in self.rooms or (SERVERS_FOLDER / room_id).exists():
-                room_id = secrets.token_hex(3).upper()
-            
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
-            room = Room(room_id, password_hash)
-            
-            # Сохраняем информацию о комнате
-            room_info = {
-                'room_id': room_id,
-                'password_hash': password_hash,
-                'created': True
-            }
-            
-            with open(room.folder / '.room_info', 'w') as f:
-                json.dump(room_info, f)
-            
-            self.rooms[room_id] = room
+            with open(filepath, 'rb') as base:
+                st = os.fstat(base.fileno())
+                if file_etag(st) not in [t.strip() for t in if_match.split(',')]:
+                    self.close_connection = True
+                    self.send_json_response({"error": "Файл изменился, запросите подпись заново"}, 412)
+                    return
+                block_size = self.delta_block(st.st_size)
+                stats = {}
+                with self.quota_allowance(room) as limit:
+                    chunks = apply_delta(self.read_body_chunks(limit), base, block_size, limit, stats)
+                    size = self.receive_upload(room.folder, filepath.name, limit, self.blobs, chunks)
+            room.publish([filepath], self.file_ttl(room))
+            for kind, count in stats.items():
+                METRICS.inc("fx_delta_bytes_total", (("direction", "upload"), ("kind", kind)), count)
             
             self.send_json_response({
                 "success": True,
-                "room_id": room_id,
-                "message": f"Комната создана! ID: {room_id}"
+                "filename": filepath.name,
+                "size": size,
+                "copied": stats["copied"],
+                "literal": stats["literal"],
+                "message": "Файл обновлён"
             })
-            
+        
+        except QuotaExceeded:
+            self.close_connection = True
+            self.send_quota_exceeded()
+        except UploadTooLarge:
+            self.close_connection = True
+            self.send_json_response({"error": "Файл слишком большой"}, 413)
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json_response({"error": f"Некорректная дельта: {e}"}, 400)
+        except ConnectionError:
+            self.close_connection = True
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
-    def join_room(self):
+    def file_delta(self, room_id, filename):
+        """Delta download: the body is the client's signature of its old copy,
+        the response the delta records that turn it into the current file.
+
+        The records are produced while the file is scanned, so the body has
+        no Content-Length and ends when the connection closes; its END
+        record carries the SHA-256 of the whole file.
+        """
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            room_id = data.get('room_id', '').upper().strip()
-            password = data.get('password', '')
+            found = self.room_file(room_id, filename)
+            if not found:
+                return
+            _, filepath = found
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > DELTA_SIGNATURE_LIMIT:
+                self.close_connection = True
+                self.send_json_response({"error": "Подпись слишком большая"}, 413)
+                return
+            signature = json.loads(self.rfile.read(length).decode('utf-8'))
+            check_signature(signature)
             
-            if not room_id:
-                self.send_json_response({"error": "Введите ID комнаты"}, 400)
+            with open(filepath, 'rb') as f:
+                st = os.fstat(f.fileno())
+                self.send_response(200)
+                self.send_header("Content-type", "application/octet-stream")
+                self.send_header("ETag", file_etag(st))
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.close_connection = True
+                self.end_headers()
+                stats = {}
+                try:
+                    for record in make_delta(f, signature, stats):
+                        self.wfile.write(record)
+                finally:
+                    for kind, count in stats.items():
+                        METRICS.inc("fx_delta_bytes_total", (("direction", "download"), ("kind", kind)), count)
+        
+        except ConnectionError:
+            self.close_connection = True
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json_response({"error": f"Некорректная подпись: {e}"}, 400)
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def download_archive(self, room_id):
+        """Stream the whole room or selected files as one ZIP or TAR archive.
+
+        GET /api/room/{room_id}/archive?format=zip|tar&name=a&name=b, or the
+        same fields (plus token) as a form POST for selections too long for
+        a URL. Without names the whole room is sent. Nothing is built on
+        disk or in memory: TAR has a precomputed layout, so it gets a
+        Content-Length and Range support for resuming; ZIP is written on
+        the fly and ends with the connection.
+        """
+        try:
+            fields = dict(self.query)
+            if self.command == 'POST':
+                content_length = int(self.headers.get('Content-Length') or 0)
+                fields.update(parse_qs(self.rfile.read(content_length).decode('utf-8')))
+            room = self.authorized_room(room_id, fields.get('token', [None])[0])
+            if not room:
                 return
             
-            # Проверяем существование комнаты
-            room_folder = SERVERS_FOLDER / room_id
-            if not room_folder.exists():
-                self.send_json_response({"error": "Комната не найдена"}, 404)
+            archive_format = fields.get('format', ['zip'])[0]
+            if archive_format not in ('zip', 'tar'):
+                self.send_json_response({"error": "Формат архива: zip или tar"}, 400)
                 return
             
-            # Загружаем информацию о комнате
-            room_info_file = room_folder / '.room_info'
-            if not room_info_file.exists():
-                self.send_json_response({"error": "Комната повреждена"}, 500)
+            names = fields.get('name') or sorted(e["name"] for e in room.index.files())
+            members = []
+            seen = set()
+            for name in names:
+                filename = safe_filename(name)
+                if not filename or filename in seen:
+                    continue
+                seen.add(filename)
+                try:
+                    st = os.stat(room.folder / filename)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    members.append((filename, room.folder / filename, st))
+            if not members:
+                self.send_json_response({"error": "Файлы не найдены"}, 404)
                 return
             
-            with open(room_info_file, 'r') as f:
-                room_info = json.load(f)
+            archive_name = f"room-{room.room_id}.{archive_format}"
+            if archive_format == 'tar':
+                self.send_tar(members, archive_name)
+            else:
+                self.send_zip(members, archive_name)
+        
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def send_tar(self, members, archive_name):
+        parts, size = tar_layout(members)
+        manifest = "\0".join(f"{name}\0{st.st_size}\0{st.st_mtime_ns}" for name, _, st in members)
+        etag = '"' + hashlib.blake2b(manifest.encode(), digest_size=12).hexdigest() + '"'
+        
+        ranges = parse_range(self.headers.get('Range'), size)
+        if_range = self.headers.get('If-Range')
+        if ranges is not None and (len(ranges) > 1 or if_range and if_range.strip() != etag):
+            # Для архива поддерживаем один диапазон, этого хватает для докачки
+            ranges = None
+        if ranges == []:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", 0)
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            return
+        
+        if ranges is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-type", "application/x-tar")
+        self.send_header("Content-Length", end - start + 1)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Disposition", f'attachment; filename="{archive_name}"')
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        
+        try:
+            for offset, length, data, path in parts:
+                if offset + length <= start or offset > end:
+                    continue
+                skip = max(start - offset, 0)
+                count = min(offset + length, end + 1) - offset - skip
+                if data is not None:
+                    self.wfile.write(data[skip:skip + count])
+                else:
+                    with open(path, 'rb') as f:
+                        self.send_file_range(f, skip, count)
+        except OSError as e:
+            # Заголовки уже отправлены: обрываем соединение, архив останется неполным
+            self.close_connection = True
+            self.log_error("archive aborted: %s", e)
+    
+    def send_zip(self, members, archive_name):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-type", "application/zip")
+        self.send_header("Content-Disposition", f'attachment; filename="{archive_name}"')
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        
+        # wfile не поддерживает seek, поэтому zipfile пишет размеры в дескрипторы данных после файлов
+        try:
+            with zipfile.ZipFile(self.wfile, 'w') as archive:
+                for name, path, st in members:
+                    with open(path, 'rb') as f:
+                        # ZIP не хранит даты раньше 1980 года
+                        info = zipfile.ZipInfo(name, time.localtime(max(st.st_mtime, 315619200))[:6])
+                        info.file_size = st.st_size
+                        info.external_attr = 0o644 << 16
+                        # Уже сжатые типы кладём как есть (store)
+                        if st.st_size >= COMPRESS_MIN_SIZE and is_compressible(path, f):
+                            info.compress_type = zipfile.ZIP_DEFLATED
+                        with archive.open(info, 'w') as out:
+                            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                                out.write(chunk)
+        except OSError as e:
+            self.close_connection = True
+            self.log_error("archive aborted: %s", e)
+    
+    def send_file_range(self, f, offset, count):
+        """Stream count bytes of an open file starting at offset to the client.
+
+        Uses zero-copy os.sendfile when the platform and socket support it,
+        otherwise falls back to fixed-size chunked reads.
+        """
+        if hasattr(os, "sendfile"):
+            try:
+                out_fd = self.connection.fileno()
+                in_fd = f.fileno()
+                block = PACED_BLOCK if self.pacing else SENDFILE_BLOCK
+                while count > 0:
+                    if self.pacing:
+                        self.pace(min(count, block), outgoing=True)
+                    with span("sendfile"):
+                        sent = os.sendfile(out_fd, in_fd, offset, min(count, block))
+                    if sent == 0:
+                        raise ConnectionAbortedError("file truncated while sending")
+                    self.bytes_out += sent
+                    offset += sent
+                    count -= sent
+                return
+            except OSError as e:
+                if e.errno not in SENDFILE_FALLBACK_ERRORS:
+                    raise
+        f.seek(offset)
+        while count > 0:
+            with span("read"):
+                chunk = f.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                raise ConnectionAbortedError("file truncated while sending")
+            self.wfile.write(chunk)
+            count -= len(chunk)
+    
+    def delete_file(self, room_id, filename):
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
             
-            # Проверяем пароль
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
-            if password_hash != room_info['password_hash']:
-                self.send_json_response({"error": "Неверный пароль"}, 403)
+            filepath = room.folder / filename if filename else None
+            if not filepath or not filepath.is_file():
+                self.send_json_response({"error": "Файл не найден"}, 404)
                 return
             
-            # Загружаем или создаем комнату
-            if room_id not in self.rooms:
-                self.rooms[room_id] = Room(room_id, room_info['password_hash'])
+            st = os.stat(filepath)
+            os.remove(filepath)
+            if self.blobs and st.st_nlink > 1:
+                self.blobs.release(st)
+            room.index.remove(filename)
             
             self.send_json_response({
                 "success": True,
-                "room_id": room_id,
-                "message": "Успешный вход!"
+                "message": "Файл удален"
             })
             
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
-    def list_room_files(self):
+    def authorized_room(self, room_id, token=None):
+        """Return the room if the request may access it, otherwise send an error.
+
+        Access is granted by a session token from join/create (X-Session-Token
+        header, ?token= for plain links or a token form field passed in by
+        the caller). The password itself is only checked by join, so a
+        request without a token gets 401 and the client has to join first.
+        """
+        room = self.get_room(room_id)
+        if not room:
+            self.close_connection = True
+            self.send_json_response({"error": "Комната не найдена"}, 404)
+            return None
+        
+        token = token or self.headers.get('X-Session-Token')
+        if not token:
+            token = self.query.get('token', [''])[0]
+        if not token:
+            self.close_connection = True
+            self.send_json_response({"error": "Войдите в комнату"}, 401)
+            return None
+        if self.tokens.validate(token) != room.room_id:
+            self.close_connection = True
+            self.send_json_response({"error": "Сессия истекла, войдите снова"}, 401)
+            return None
+        room.accessed = time.time()
+        return room
+    
+    def file_ttl(self, room):
+        """Lifetime in seconds of the files this request uploads: the X-File-TTL
+        header (0 keeps them forever), otherwise the room's default"""
+        value = self.headers.get('X-File-TTL')
+        try:
+            return max(0.0, float(value)) if value else room.effective_file_ttl()
+        except ValueError:
+            return room.effective_file_ttl()
+    
+    def get_upload_session(self, room, session_id):
+        record = Room.registry.upload(session_id)
+        if not record or record[0] != room.room_id:
+            self.close_connection = True
+            self.send_json_response({"error": "Сессия загрузки не найдена"}, 404)
+            return None
+        _, filename, size, chunk_size = record
+        return UploadSession(session_id, room.folder, filename, size, chunk_size, room.room_id, Room.registry)
+    
+    @classmethod
+    def expire_upload_sessions(cls):
+        """Drop sessions idle for UPLOAD_SESSION_TTL with their temp files, returns how many"""
+        deadline = time.time() - UPLOAD_SESSION_TTL
+        expired = Room.registry.expire_uploads(deadline)
+        for session_id, room_id in expired:
+            try:
+                os.remove(room_path(room_id) / f"{UPLOAD_PREFIX}{session_id}")
+            except OSError:
+                pass
+        if expired:
+            METRICS.inc("fx_expired_total", (("kind", "upload"),), len(expired))
+        return len(expired)
+    
+    def create_upload_session(self, room_id):
         try:
-            # Парсим путь: /api/room/{room_id}/files
-            parts = self.path.split('/')
-            room_id = parts[3] if len(parts) > 3 else None
+            room = self.authorized_room(room_id)
+            if not room:
+                return
             
-            password = self.headers.get('X-Password', '')
+            content_length = int(self.headers.get('Content-Length') or 0)
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            filename = safe_filename(str(data.get('filename', '')))
+            size = int(data.get('size', -1))
+            chunk_size = int(data.get('chunk_size') or DEFAULT_CHUNK_SIZE)
             
-            if not room_id or room_id not in self.rooms:
-                self.send_json_response({"error": "Комната не найдена"}, 404)
+            if not filename:
+                self.send_json_response({"error": "Недопустимое имя файла"}, 400)
                 return
-            
-            room = self.rooms[room_id]
-            if not room.verify_password(password):
-                self.send_json_response({"error": "Неверный пароль"}, 403)
+            if size < 0:
+                self.send_json_response({"error": "Не указан размер файла"}, 400)
+                return
+            if size > room.max_upload_size:
+                self.send_json_response({"error": "Файл слишком большой"}, 413)
                 return
+            self.check_quota(room, size)
+            chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
             
-            files = room.get_files()
-            self.send_json_response(files)
+            session_id = secrets.token_hex(16)
+            session = UploadSession(session_id, room.folder, filename, size, chunk_size,
+                                    room.room_id, Room.registry)
+            session.allocate()
             
+            self.send_json_response(dict(session.status(), success=True))
+            
+        except QuotaExceeded:
+            self.send_quota_exceeded()
+        except (ValueError, TypeError) as e:
+            self.send_json_response({"error": f"Некорректный запрос: {e}"}, 400)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
-    def upload_file(self):
+    def upload_chunk(self, room_id, session_id, index):
         try:
-            # Парсим путь: /api/room/{room_id}/upload
-            parts = self.path.split('/')
-            room_id = parts[3] if len(parts) > 3 else None
-            
-            password = self.headers.get('X-Password', '')
-            filename = self.headers.get('X-Filename', 'uploaded_file')
-            
-            if not room_id or room_id not in self.rooms:
-                self.send_json_response({"error": "Комната не найдена"}, 404)
+            room = self.authorized_room(room_id)
+            if not room:
                 return
-            
-            room = self.rooms[room_id]
-            if not room.verify_password(password):
-                self.send_json_response({"error": "Неверный пароль"}, 403)
+            session = self.get_upload_session(room, session_id)
+            if not session:
                 return
             
-            content_length = int(self.headers['Content-Length'])
-            filepath = room.folder / filename
+            if not 0 <= index < session.chunk_count:
+                self.close_connection = True
+                self.send_json_response({"error": "Неверный номер части"}, 400)
+                return
             
-            with open(filepath, 'wb') as f:
-                f.write(self.rfile.read(content_length))
+            expected = session.chunk_length(index)
+            written = session.write_chunk(index, self.read_body_chunks(expected))
+            if written != expected:
+                self.send_json_response({"error": "Неполная часть файла"}, 400)
+                return
             
-            self.send_json_response({
-                "success": True,
-                "filename": filename,
-                "message": "Файл загружен"
-            })
+            self.send_json_response({"success": True, "index": index})
             
+        except UploadTooLarge:
+            self.close_connection = True
+            self.send_json_response({"error": "Часть больше ожидаемой"}, 413)
+        except ValueError as e:
+            self.close_connection = True
+            self.send_json_response({"error": f"Некорректный запрос: {e}"}, 400)
+        except ConnectionError:
+            # Часть не отмечена как полученная, клиент отправит её заново
+            self.close_connection = True
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
-    def download_file(self):
+    def upload_session_status(self, room_id, session_id):
         try:
-            # Парсим путь: /api/room/{room_id}/download/{filename}
-            parts = self.path.split('/')
-            room_id = parts[3] if len(parts) > 3 else None
-            filename = unquote(parts[5]) if len(parts) > 5 else None
-            
-            password = self.headers.get('X-Password', '')
-            
-            if not room_id or room_id not in self.rooms:
-                self.send_error(404, "Комната не найдена")
-                return
-            
-            room = self.rooms[room_id]
-            if not room.verify_password(password):
-                self.send_error(403, "Неверный пароль")
+            room = self.authorized_room(room_id)
+            if not room:
                 return
-            
-            filepath = room.folder / filename
-            if not filepath.exists():
-                self.send_error(404, "Файл не найден")
+            session = self.get_upload_session(room, session_id)
+            if not session:
                 return
-            
-            self.send_response(200)
-            self.send_header("Content-type", mimetypes.guess_type(filepath)[0] or "application/octet-stream")
-            self.send_header("Content-Length", filepath.stat().st_size)
-            self.send_header("Content-Disposition", f'attachment; filename="{filepath.name}"')
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            
-            with open(filepath, 'rb') as f:
-                self.wfile.write(f.read())
-                
+            self.send_json_response(session.status())
         except Exception as e:
-            self.send_error(500, str(e))
+            self.send_json_response({"error": str(e)}, 500)
     
-    def delete_file(self):
+    def finalize_upload_session(self, room_id, session_id):
         try:
-            # Парсим путь: /api/room/{room_id}/delete/{filename}
-            parts = self.path.split('/')
-            room_id = parts[3] if len(parts) > 3 else None
-            filename = unquote(parts[5]) if len(parts) > 5 else None
-            
-            password = self.headers.get('X-Password', '')
-            
-            if not room_id or room_id not in self.rooms:
-                self.send_json_response({"error": "Комната не найдена"}, 404)
+            room = self.authorized_room(room_id)
+            if not room:
                 return
-            
-            room = self.rooms[room_id]
-            if not room.verify_password(password):
-                self.send_json_response({"error": "Неверный пароль"}, 403)
+            session = self.get_upload_session(room, session_id)
+            if not session:
                 return
             
-            filepath = room.folder / filename
-            if not filepath.exists():
-                self.send_json_response({"error": "Файл не найден"}, 404)
+            missing = session.missing()
+            if missing:
+                self.send_json_response({"error": "Получены не все части", "missing": missing}, 409)
                 return
+            # Пока части шли, место могли занять другие загрузки; сессия остаётся
+            self.check_quota(room, session.size)
             
-            os.remove(filepath)
+            if not Room.registry.remove_upload(session.session_id):
+                self.send_json_response({"error": "Сессия загрузки не найдена"}, 404)
+                return
+            try:
+                target = session.finalize(self.blobs)
+            except Exception:
+                # Сессии в реестре уже нет, повторить её нельзя: убираем собранный файл
+                session.discard()
+                raise
+            room.publish([target], self.file_ttl(room))
             
             self.send_json_response({
                 "success": True,
-                "message": "Файл удален"
+                "filename": session.filename,
+                "size": session.size,
+                "message": "Файл загружен"
             })
             
+        except QuotaExceeded:
+            self.send_quota_exceeded()
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def abort_upload_session(self, room_id, session_id):
+        try:
+            room = self.authorized_room(room_id)
+            if not room:
+                return
+            session = self.get_upload_session(room, session_id)
+            if not session:
+                return
+            Room.registry.remove_upload(session.session_id)
+            session.discard()
+            self.send_json_response({"success": True})
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def room_events(self, room_id):
+        try:
+            room = self.authorized_room(room_id)
+            if room:
+                self.stream_events(room.index)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
+    def stream_events(self, index):
+        """Push changes of a file index to the client.
+
+        Default is a Server-Sent Events stream; ?mode=poll turns it into a
+        long-poll that answers with the events as JSON as soon as there are
+        any. The cursor comes from ?since= or the Last-Event-ID header.
+        """
+        query = self.query
+        since = query.get('since', [self.headers.get('Last-Event-ID', '')])[0] or index.cursor()
+        
+        if not self.event_slots.acquire(blocking=False):
+            if query.get('mode') == ['poll']:
+                # Нет свободных слотов: отвечаем сразу, клиент повторит позже
+                cursor, events = index.wait_for_changes(since, 0)
+                self.send_json_response({"cursor": cursor, "events": events or [],
+                                         "reset": events is None})
+            else:
+                self.send_response(503)
+                self.send_header("Retry-After", "5")
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+            return
+        try:
+            if query.get('mode') == ['poll']:
+                timeout = min(float(query.get('timeout', [LONG_POLL_TIMEOUT])[0]), LONG_POLL_TIMEOUT)
+                cursor, events = index.wait_for_changes(since, max(timeout, 0))
+                self.send_json_response({"cursor": cursor, "events": events or [],
+                                         "reset": events is None})
+                return
+            
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(f"retry: 3000\nid: {since}\nevent: ready\ndata: {{}}\n\n".encode())
+            
+            deadline = time.monotonic() + EVENT_STREAM_LIFETIME
+            while time.monotonic() < deadline:
+                cursor, events = index.wait_for_changes(since, EVENT_HEARTBEAT)
+                if events is None:
+                    self.wfile.write(f"id: {cursor}\nevent: reset\ndata: {{}}\n\n".encode())
+                elif events:
+                    self.wfile.write("".join(
+                        f"id: {e['id']}\nevent: {e['type']}\ndata: {json.dumps(e)}\n\n" for e in events
+                    ).encode())
+                else:
+                    self.wfile.write(b": ping\n\n")
+                since = cursor
+        except ConnectionError:
+            self.close_connection = True
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, 400)
+        finally:
+            self.event_slots.release()
+    
     def list_rooms(self):
         try:
             rooms_list = []
-            for room_id, room in self.rooms.items():
-                file_count = len(room.get_files())
+            with self.rooms_lock:
+                loaded = dict(self.rooms)
+            # Незагруженные комнаты берут число файлов из реестра, загруженные — из индекса
+            changed = []
+            for room_id, file_count in Room.registry.rooms():
+                room = loaded.get(room_id)
+                if room is not None and room.index.count() != file_count:
+                    file_count = room.index.count()
+                    changed.append((file_count, room_id))
                 rooms_list.append({
                     "room_id": room_id,
                     "file_count": file_count
                 })
+            if changed:
+                Room.registry.set_file_counts(changed)
             
             self.send_json_response(rooms_list)
         except Exception as e:
             self.send_json_response({"error": str(e)}, 500)
     
     def send_json_response(self, data, status=200):
+        body = json.dumps(data).encode()
+        encoding = self.response_encoding(len(body))
+        if encoding:
+            body = compress_bytes(body, encoding)
+        self.send_json_bytes(body, status, encoding=encoding)
+    
+    def send_json_bytes(self, body, status=200, headers=None, encoding=None):
+        """Send a JSON body, already compressed with encoding if one is given"""
         self.send_response(status)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+    
+    def response_encoding(self, size):
+        """Content coding for a response body of size bytes, None to send it as is"""
+        if size < COMPRESS_MIN_SIZE:
+            return None
+        return negotiate_encoding(self.headers.get('Accept-Encoding'))
+    
+    def setup(self):
+        self.pacing = False
+        super().setup()
+        self.bytes_in = self.bytes_out = 0
+        self.rfile = CountingReader(self.rfile, self)
+        self.wfile = CountingWriter(self.wfile, self)
+        METRICS.add("fx_open_connections")
+    
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            METRICS.add("fx_open_connections", value=-1)
+    
+    def handle_one_request(self):
+        """Handle one request and record its metrics and access log line"""
+        self.requestline = ""
+        self.status_code = None
+        self.route = None
+        self.route_path = ""
+        self.endpoint = None
+        self.params = ()
+        self.query = {}
+        self.transfer = None
+        self.pacing = False
+        self.buckets = []
+        self.egress = None
+        self.bytes_in = self.bytes_out = 0
+        REQUEST_SPANS.totals = {} if METRICS.spans_enabled else None
+        started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            if self.transfer:
+                METRICS.add("fx_transfers_in_flight", (("direction", self.transfer),), -1)
+            if self.requestline:
+                self.record_request(time.perf_counter() - started)
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Путь разбирается один раз: маршрут, параметры и строка запроса
+        self.route_path, _, query = self.path.partition('?')
+        self.query = parse_qs(query) if query else {}
+        self.endpoint, self.params = ROUTER.match(self.command, self.route_path)
+        if self.endpoint is not None:
+            self.route = self.endpoint.label
+        else:
+            self.route = "other" if self.route_path.startswith("/api/") else "/"
+        if self.route in UPLOAD_ROUTES and self.command in ('POST', 'PUT'):
+            self.transfer = "upload"
+        elif self.route in DOWNLOAD_ROUTES and self.command in ('GET', 'POST'):
+            self.transfer = "download"
+        if self.transfer:
+            METRICS.add("fx_transfers_in_flight", (("direction", self.transfer),))
+        if self.route in UNLIMITED_ROUTES:
+            return True
+        
+        room_id = self.params[0].upper() if self.route.startswith("/api/room/") else None
+        ip = self.client_address[0]
+        refused = self.limiter.admit(ip, room_id)
+        if refused:
+            scope, wait = refused
+            METRICS.inc("fx_rate_limited_total", (("scope", scope),))
+            self.close_connection = True
+            body = json.dumps({"error": "Слишком много запросов, повторите позже"}).encode()
+            self.send_json_bytes(body, 429, {"Retry-After": str(math.ceil(wait))})
+            return False
+        self.buckets = self.limiter.byte_buckets(ip, room_id)
+        if self.transfer == "download" and self.limiter.egress.rate:
+            self.egress = self.limiter.egress
+        self.pacing = bool(self.buckets or self.egress)
+        return True
+    
+    def pace(self, n, outgoing=False):
+        """Hold a transfer of n bytes back to the client and room rates and,
+        for downloads, to their turn in the shared egress rate"""
+        if outgoing and self.egress:
+            METRICS.inc("fx_throttle_seconds_total", (("scope", "egress"),), self.egress.acquire(n))
+        delays = [(bucket.take(n), scope) for scope, bucket in self.buckets]
+        delay, scope = max(delays) if delays else (0, None)
+        if delay > 0:
+            METRICS.inc("fx_throttle_seconds_total", (("scope", scope),), delay)
+            time.sleep(delay)
+    
+    def record_request(self, elapsed):
+        route = self.route or "other"
+        METRICS.inc("fx_requests_total", (("route", route), ("method", self.command or ""),
+                                          ("status", str(self.status_code or 0))))
+        METRICS.observe("fx_request_duration_seconds", (("route", route),), elapsed)
+        METRICS.inc("fx_received_bytes_total", (("route", route),), self.bytes_in)
+        METRICS.inc("fx_sent_bytes_total", (("route", route),), self.bytes_out)
+        
+        requestline = redact_tokens(self.requestline)
+        line = (f'{self.address_string()} "{requestline}" {self.status_code or "-"} '
+                f'{self.bytes_out} {elapsed * 1000:.1f}ms')
+        totals = REQUEST_SPANS.totals
+        if totals:
+            line += " " + " ".join(f"{name}={t * 1000:.1f}ms" for name, t in sorted(totals.items()))
+        self.log_message("%s", line)
+    
+    def log_request(self, code='-', size='-'):
+        # Строка журнала пишется после завершения запроса, см. record_request
+        self.status_code = getattr(code, "value", code)
+    
+    def limits(self):
+        """GET /api/limits shows the current limits, PUT merges a JSON object
+        into them. Only with X-Admin-Token, or from localhost when the server
+        has no --admin-token."""
+        try:
+            if self.admin_token:
+                allowed = hmac.compare_digest(self.headers.get('X-Admin-Token', ''), self.admin_token)
+            else:
+                allowed = self.client_address[0] in ('127.0.0.1', '::1')
+            if not allowed:
+                self.close_connection = True
+                self.send_json_response({"error": "Нет доступа"}, 403)
+                return
+            if self.command == 'PUT':
+                content_length = int(self.headers.get('Content-Length') or 0)
+                changes = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+                merged = Room.registry.update_setting(
+                    "limits", "{}", lambda current: json.dumps(merge_limits(json.loads(current), changes)))
+                self.limiter.apply(json.loads(merged))
+            self.send_json_response(self.limiter.settings)
+        except ValueError as e:
+            self.send_json_response({"error": f"Некорректные ограничения: {e}"}, 400)
+        except Exception as e:
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def serve_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
     
     def log_message(self, format, *args):
-        print(f"[{self.log_date_time_string()}] {format % args}")
+        line = f"[{self.log_date_time_string()}] {format % args}"
+        if self.access_log is None:
+            print(line)
+        else:
+            self.access_log.write(line)
+
+METRICS.register(FileExchangeHandler.storage_metrics)
+METRICS.register(lambda: FileExchangeHandler.limiter.metrics())
+METRICS.register(lambda: FileExchangeHandler.janitor.metrics() if FileExchangeHandler.janitor else [])
 
 def get_local_ip():
     try:
@@ -335,23 +4096,430 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP server that handles connections on a bounded pool of worker threads"""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=32,
+                 max_connections=256, max_per_client=32):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.max_connections = max_connections
+        self.max_per_client = max_per_client
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http-worker")
+        self.connections_lock = threading.Lock()
+        self.active_connections = 0
+        self.client_connections = {}  # client ip -> open connections
+
+    def admit(self, client_address):
+        """Reserve a connection slot, False if a limit is reached"""
+        ip = client_address[0]
+        with self.connections_lock:
+            if self.active_connections >= self.max_connections:
+                return False
+            if self.client_connections.get(ip, 0) >= self.max_per_client:
+                return False
+            self.active_connections += 1
+            self.client_connections[ip] = self.client_connections.get(ip, 0) + 1
+            return True
+
+    def release(self, client_address):
+        ip = client_address[0]
+        with self.connections_lock:
+            self.active_connections -= 1
+            count = self.client_connections.get(ip, 0) - 1
+            if count > 0:
+                self.client_connections[ip] = count
+            else:
+                self.client_connections.pop(ip, None)
+
+    def reject(self, request):
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Retry-After: 1\r\nContent-Length: 0\r\n"
+                            b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.admit(client_address):
+            self.reject(request)
+            return
+        self.pool.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.release(client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class AsyncioHTTPServer(ThreadPoolHTTPServer):
+    """Accepts connections on an asyncio event loop and hands them to the worker pool"""
+
+    def serve_forever(self, poll_interval=0.5):
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.stopping = asyncio.Event()
+        self.socket.setblocking(False)
+        accept_task = None
+        while not self.stopping.is_set():
+            accept_task = loop.create_task(loop.sock_accept(self.socket))
+            stop_task = loop.create_task(self.stopping.wait())
+            done, _ = await asyncio.wait({accept_task, stop_task},
+                                         return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+            if accept_task not in done:
+                accept_task.cancel()
+                break
+            request, client_address = accept_task.result()
+            request.setblocking(True)
+            if not self.admit(client_address):
+                self.reject(request)
+                continue
+            loop.run_in_executor(self.pool, self.process_request_worker,
+                                 request, client_address)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+
+def create_server(server_address, handler_class, mode="threaded", workers=32,
+                  max_connections=256, max_per_client=32):
+    """Create the HTTP server for the selected concurrency mode"""
+    if mode == "single":
+        return HTTPServer(server_address, handler_class)
+    server_class = AsyncioHTTPServer if mode == "asyncio" else ThreadPoolHTTPServer
+    return server_class(server_address, handler_class, workers=workers,
+                        max_connections=max_connections, max_per_client=max_per_client)
+
+
+class Janitor:
+    """Background thread that deletes rooms and files whose lifetime is over.
+
+    Each pass first writes the last access times of the rooms this process
+    served to the registry. The process that expires (the only one, or
+    worker 0 with --processes) then removes expired rooms, files and
+    upload sessions, JANITOR_BATCH at a time with a pause in between, so
+    request threads are never kept waiting for the disk or the registry.
+    Other workers drop the rooms it removed from their caches.
+    """
+    
+    def __init__(self, handler_class, expire=True, interval=JANITOR_INTERVAL):
+        self.handler_class = handler_class
+        self.expire = expire
+        self.interval = interval
+        self.last_run = None
+    
+    def start(self):
+        threading.Thread(target=self.loop, name="janitor", daemon=True).start()
+    
+    def loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Janitor: {e}")
+    
+    def run_once(self):
+        started = time.perf_counter()
+        self.flush_access()
+        if self.expire:
+            rooms, files, freed = self.expire_rooms()
+            count, size = self.expire_files()
+            self.handler_class.expire_upload_sessions()
+            if rooms or count:
+                print(f"Janitor: removed {rooms} rooms, {files + count} files, {freed + size} bytes")
+        self.last_run = time.time()
+        METRICS.observe("fx_janitor_duration_seconds", (), time.perf_counter() - started)
+    
+    def loaded_rooms(self):
+        with self.handler_class.rooms_lock:
+            return list(self.handler_class.rooms.values())
+    
+    def flush_access(self):
+        rooms = self.loaded_rooms()
+        touched = [(room, room.accessed) for room in rooms if room.accessed > room.flushed]
+        if touched:
+            Room.registry.touch([(accessed, room.room_id) for room, accessed in touched])
+            for room, accessed in touched:
+                room.flushed = accessed
+        if not self.expire and rooms:
+            existing = Room.registry.existing(room.room_id for room in rooms)
+            with self.handler_class.rooms_lock:
+                for room in rooms:
+                    if room.room_id not in existing and self.handler_class.rooms.get(room.room_id) is room:
+                        del self.handler_class.rooms[room.room_id]
+    
+    def remove(self, path):
+        """Delete one file, returns its size, None if it was gone already"""
+        try:
+            st = os.stat(path)
+            os.remove(path)
+        except OSError:
+            return None
+        blobs = self.handler_class.blobs
+        if blobs and st.st_nlink > 1:
+            blobs.release(st)
+        return st.st_size
+    
+    def expire_rooms(self):
+        """Remove rooms not accessed for their TTL, returns (rooms, files, bytes)"""
+        removed = files = freed = 0
+        while True:
+            now = time.time()
+            batch = Room.registry.expired_rooms(now, Room.default_ttl, JANITOR_BATCH)
+            for room_id in batch:
+                if not Room.registry.remove_room(room_id, now, Room.default_ttl):
+                    continue
+                with self.handler_class.rooms_lock:
+                    self.handler_class.rooms.pop(room_id, None)
+                folder = room_path(room_id)
+                try:
+                    with os.scandir(folder) as it:
+                        entries = [entry for entry in it if entry.is_file(follow_symlinks=False)]
+                except FileNotFoundError:
+                    entries = []
+                for entry in entries:
+                    size = self.remove(entry.path)
+                    if size is not None and entry.name not in RESERVED_NAMES \
+                            and not entry.name.startswith(UPLOAD_PREFIX):
+                        files += 1
+                        freed += size
+                shutil.rmtree(folder, ignore_errors=True)
+                try:
+                    folder.parent.rmdir()
+                except OSError:
+                    pass
+                removed += 1
+            if len(batch) < JANITOR_BATCH:
+                break
+            time.sleep(JANITOR_PAUSE)
+        if removed:
+            METRICS.inc("fx_expired_total", (("kind", "room"),), removed)
+            METRICS.inc("fx_expired_bytes_total", (), freed)
+        return removed, files, freed
+    
+    def expire_files(self):
+        """Remove files past their own TTL, returns (files, bytes)"""
+        removed = freed = 0
+        while True:
+            batch = Room.registry.expired_files(time.time(), JANITOR_BATCH)
+            for room_id, name, mtime_ns in batch:
+                path = room_path(room_id) / name
+                try:
+                    # Файл, загруженный поверх без срока жизни, не трогаем
+                    if os.stat(path).st_mtime_ns != mtime_ns:
+                        continue
+                except OSError:
+                    continue
+                size = self.remove(path)
+                if size is None:
+                    continue
+                with self.handler_class.rooms_lock:
+                    room = self.handler_class.rooms.get(room_id)
+                if room:
+                    room.index.remove(name)
+                removed += 1
+                freed += size
+            Room.registry.unschedule_files(batch)
+            if len(batch) < JANITOR_BATCH:
+                break
+            time.sleep(JANITOR_PAUSE)
+        if removed:
+            METRICS.inc("fx_expired_total", (("kind", "file"),), removed)
+            METRICS.inc("fx_expired_bytes_total", (), freed)
+        return removed, freed
+    
+    def metrics(self):
+        usage = shutil.disk_usage(SERVERS_FOLDER)
+        samples = [("fx_disk_total_bytes", (), usage.total),
+                   ("fx_disk_free_bytes", (), usage.free)]
+        if self.last_run:
+            samples.append(("fx_janitor_last_run_timestamp", (), self.last_run))
+        return samples
+
+def start_worker(args, worker=None):
+    """Open the per-process state: registry connection, access log,
+    compression cache and blob store. With --processes this runs in each
+    worker after the fork, so no connection or thread is shared."""
+    Room.registry = RoomRegistry()
+    # Секрет токенов общий для всех процессов, токены переживают перезапуск
+    secret = Room.registry.setting("session_secret", secrets.token_hex(32))
+    FileExchangeHandler.tokens = SessionTokens(bytes.fromhex(secret))
+    FileExchangeHandler.limiter = Limiter(args.processes)
+    FileExchangeHandler.limiter.refresh()
+    FileExchangeHandler.admin_token = args.admin_token
+    log_path = None if args.access_log == "off" else args.access_log
+    if log_path and log_path != "-" and worker is not None:
+        # У каждого процесса свой журнал, иначе ротации мешают друг другу
+        root, ext = os.path.splitext(log_path)
+        log_path = f"{root}-{worker}{ext}"
+    FileExchangeHandler.access_log = AccessLog(log_path)
+    if args.compression_cache_mb > 0:
+        FileExchangeHandler.compression_cache = CompressionCache(max_size=args.compression_cache_mb * 1024 ** 2)
+    if args.dedup:
+        FileExchangeHandler.blobs = BlobStore()
+        FileExchangeHandler.blobs.run_collector()
+    if args.preview_workers > 0:
+        Room.previews = PreviewService(PreviewCache(max_size=args.preview_cache_mb * 1024 ** 2),
+                                       args.preview_workers)
+    # Срок жизни проверяет один процесс, остальные только сообщают о своих обращениях
+    FileExchangeHandler.janitor = Janitor(FileExchangeHandler, expire=not worker, interval=args.janitor_interval)
+    FileExchangeHandler.janitor.start()
+    METRICS.add("fx_startup_seconds", value=time.time() - STARTED)
+
+def stop_on_sigterm():
+    """Turn SIGTERM into KeyboardInterrupt so it shuts down like Ctrl+C"""
+    def handler(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handler)
+
+def serve_prefork(httpd, processes, args):
+    """Fork worker processes that all accept on httpd's listening socket.
+
+    The parent serves nothing itself: it restarts workers that die and
+    stops them all on Ctrl+C or SIGTERM.
+    """
+    children = {}  # pid -> номер процесса
+    
+    def spawn(worker):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                start_worker(args, worker)
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"Worker {worker} failed: {e}")
+                code = 1
+            finally:
+                if FileExchangeHandler.access_log:
+                    FileExchangeHandler.access_log.close()
+                if Room.previews:
+                    Room.previews.close()
+                sys.stdout.flush()
+                os._exit(code)
+        children[pid] = worker
+    
+    stop_on_sigterm()
+    for worker in range(processes):
+        spawn(worker)
+    try:
+        while True:
+            pid, status = os.wait()
+            worker = children.pop(pid, None)
+            if worker is not None:
+                print(f"Worker {worker} (pid {pid}) exited with status {status}, restarting")
+                time.sleep(1)
+                spawn(worker)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="File Exchanger web server")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--mode", choices=["threaded", "asyncio", "single"], default="threaded",
+                        help="concurrency model of the server core")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="worker threads handling requests (per process)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port and the room registry (Unix only)")
+    parser.add_argument("--max-connections", type=int, default=256,
+                        help="open connections before new ones get 503")
+    parser.add_argument("--max-per-client", type=int, default=32,
+                        help="open connections allowed from one client IP")
+    parser.add_argument("--max-upload-mb", type=int, default=MAX_UPLOAD_SIZE // 1024 ** 2,
+                        help="default per-room maximum upload size")
+    parser.add_argument("--dedup", action="store_true",
+                        help="store identical files once in a shared blob store")
+    parser.add_argument("--compression-cache-mb", type=int, default=COMPRESSION_CACHE_SIZE // 1024 ** 2,
+                        help="disk space for cached compressed downloads, 0 disables the cache")
+    parser.add_argument("--preview-workers", type=int, default=1,
+                        help="processes building image thumbnails and text previews, 0 disables previews")
+    parser.add_argument("--preview-cache-mb", type=int, default=PREVIEW_CACHE_SIZE // 1024 ** 2,
+                        help="disk space for cached previews")
+    parser.add_argument("--access-log", default="access.log",
+                        help='access log file, "-" for stdout, "off" to disable')
+    parser.add_argument("--trace-spans", action="store_true",
+                        help="time directory scans, hashing and disk I/O per request")
+    limits = parser.add_argument_group("limits", "0 disables a limit; omitted ones keep the value "
+                                                 "last set through PUT /api/limits")
+    limits.add_argument("--room-quota-mb", type=float, help="storage quota per room")
+    limits.add_argument("--client-requests-per-sec", type=float, help="request rate per client IP")
+    limits.add_argument("--room-requests-per-sec", type=float, help="request rate per room")
+    limits.add_argument("--client-mb-per-sec", type=float, help="upload + download rate per client IP")
+    limits.add_argument("--room-mb-per-sec", type=float, help="upload + download rate per room")
+    limits.add_argument("--egress-mb-per-sec", type=float,
+                        help="total download rate, shared fairly between active downloads")
+    lifetime = parser.add_argument_group("lifetime", "rooms and files that set no lifetime of their own "
+                                                     "at creation or upload use these; 0 keeps them forever")
+    lifetime.add_argument("--room-ttl-hours", type=float, default=0,
+                          help="delete rooms nobody has opened for this long")
+    lifetime.add_argument("--file-ttl-hours", type=float, default=0,
+                          help="delete files this long after they were uploaded")
+    lifetime.add_argument("--janitor-interval", type=float, default=JANITOR_INTERVAL,
+                          help="seconds between passes of the cleanup thread")
+    parser.add_argument("--admin-token", help="token for PUT /api/limits (X-Admin-Token); "
+                                              "without it limits can be changed from localhost only")
+    parser.add_argument("--migrate", action="store_true",
+                        help="move rooms from the flat servers_data/{ID} layout into the registry and exit")
+    args = parser.parse_args()
+    if args.processes > 1 and not hasattr(os, "fork"):
+        parser.error("--processes needs os.fork(), which this platform does not have")
+    return args
+
 if __name__ == "__main__":
-    PORT = 8888
+    args = parse_args()
+    PORT = args.port
+    Room.max_upload_size = args.max_upload_mb * 1024 ** 2
+    Room.default_ttl = args.room_ttl_hours * 3600 or None
+    Room.default_file_ttl = args.file_ttl_hours * 3600 or None
+    # Потоки событий занимают не больше половины рабочих потоков (в single-режиме нельзя)
+    FileExchangeHandler.event_slots = threading.Semaphore(0 if args.mode == "single" else max(1, args.workers // 2))
     server_address = ("0.0.0.0", PORT)
+    METRICS.spans_enabled = args.trace_spans
     
-    # Загружаем существующие комнаты
-    for room_folder in SERVERS_FOLDER.iterdir():
-        if room_folder.is_dir():
-            room_info_file = room_folder / '.room_info'
-            if room_info_file.exists():
-                with open(room_info_file, 'r') as f:
-                    room_info = json.load(f)
-                    FileExchangeHandler.rooms[room_info['room_id']] = Room(
-                        room_info['room_id'],
-                        room_info['password_hash']
-                    )
+    # Комнаты читаются из реестра при первом обращении; старую раскладку переносим
+    registry = RoomRegistry()
+    migrated = migrate_rooms(registry)
+    room_count = registry.count()
+    # Ограничения из командной строки заменяют сохранённые, остальные остаются
+    flags = {name: getattr(args, name) for name in LIMIT_DEFAULTS if getattr(args, name) is not None}
+    limits = json.loads(registry.update_setting(
+        "limits", "{}", lambda current: json.dumps(merge_limits(json.loads(current), flags))))
+    registry.close()
+    if args.migrate:
+        print(f"Migrated {migrated} rooms to {ROOMS_FOLDER} and {REGISTRY_PATH}")
+        sys.exit(0)
     
-    httpd = HTTPServer(server_address, FileExchangeHandler)
+    httpd = create_server(server_address, FileExchangeHandler, mode=args.mode,
+                          workers=args.workers, max_connections=args.max_connections,
+                          max_per_client=args.max_per_client)
     
     local_ip = get_local_ip()
     
@@ -362,12 +4530,37 @@ if __name__ == "__main__":
     print(f"\nAccess from:")
     print(f"  → http://{local_ip}:{PORT}")
     print(f"  → http://localhost:{PORT} (local)")
-    print(f"\nActive rooms: {len(FileExchangeHandler.rooms)}")
+    print(f"\nRooms: {room_count}" + (f" ({migrated} migrated)" if migrated else ""))
+    print(f"Startup: {(time.time() - STARTED) * 1000:.0f} ms")
+    print(f"Mode: {args.mode}, workers: {args.workers}" +
+          (f" threads x {args.processes} processes" if args.processes > 1 else ""))
+    print(f"Compression: {', '.join(ENCODINGS)}")
+    print(f"Access log: {args.access_log}, metrics: /api/metrics")
+    active = [f"{name}={value:g}" for name, value in limits.items() if name in LIMIT_DEFAULTS and value]
+    if active or limits.get("rooms"):
+        print(f"Limits: {', '.join(active) or 'none'}" +
+              (f", {len(limits['rooms'])} rooms with their own" if limits.get("rooms") else ""))
+    if args.dedup:
+        print(f"Deduplication: on ({BLOBS_FOLDER})")
+    if args.preview_workers > 0:
+        print(f"Previews: {args.preview_workers} processes, thumbnails " +
+              ("on" if Image else "off (pip install Pillow)"))
+    if Room.default_ttl or Room.default_file_ttl:
+        print(f"Lifetime: rooms {args.room_ttl_hours:g} h idle, files {args.file_ttl_hours:g} h (0 = forever)")
     print(f"\nPress Ctrl+C to stop")
     print("="*60 + "\n")
     
+    if args.processes > 1:
+        serve_prefork(httpd, args.processes, args)
+        print("\n\n✗ Server stopped")
+        sys.exit(0)
+    
+    start_worker(args)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
+        FileExchangeHandler.access_log.close()
+        if Room.previews:
+            Room.previews.close()
         print("\n\n✗ Server stopped")
         sys.exit(0)